@@ -1,3 +1,5 @@
+from dna.node import StateNode
+
 class Component:
     def __init__(self,model,name):
         self.model = model
@@ -8,7 +10,7 @@ class Component:
 
     def ensureNodeExists(self,index):
         if not index in self.model.nodes:
-            self.model.nodes[index] = {}
+            self.model.nodes[index] = StateNode()
 
     def addInlet(self,index):
         self.ensureNodeExists(index)
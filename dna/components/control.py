@@ -1,9 +1,12 @@
 import warnings
+
+import numpy as np
 import scipy
+import scipy.optimize
 
 from dna.states import state
 from dna.component import Component
-from dna.iterate import IterateParamHelper
+from dna.engine import InputError
 
 class Valve(Component):
 
@@ -130,20 +133,33 @@ class Splitter(Component):
 
 class DoubleSplitMix(Component):
     '''
-    This model has two inputs and two outputs, but actually is built up
-    from 4 components: two splitters (for the inlets) and two mixers (for the outlets)
+    This model has inputs and outputs, but actually is built up from
+    splitters (one per inlet) and mixers (one per outlet).
     The inlet conditions have to be perfectly known
-    For one of the outlets, a desired mdot and y should be specified. The other outlet is found.
+    For two inlets and outlets, a desired mdot and y should be specified for one
+    of the outlets. The other outlet is found.
     If the desired mdot and y cannot be satisfied, a warning will be issued and the closest
     possible value is used instead
 
     Best to provide mdot and y for the stream with lowest y
+
+    Any other number of inlets and outlets takes nodes([inlets], [outlets]).
+    The split is then the bounded least squares fit to the mdot and y of all
+    outlets that specify them, at most one outlet without them takes the rest.
     '''
-    def nodes(self, in1, in2, out1, out2):
-        self.addInlet(in1)
-        self.addInlet(in2)
-        self.addOutlet(out1)
-        self.addOutlet(out2)
+    def nodes(self, *args):
+        if len(args) == 2 and isinstance(args[0], (list, tuple)):
+            inlets, outlets = args
+        else:
+            inlets, outlets = args[:2], args[2:]
+
+        for i in inlets:
+            self.addInlet(i)
+
+        for o in outlets:
+            self.addOutlet(o)
+
+        return self
 
     def checkBounds(self, n1, n2, n3):
         min_y = min(n1['y'], n2['y'])
@@ -158,134 +174,156 @@ class DoubleSplitMix(Component):
 
         return self
 
-    def iterate(self):
-
-        n = self.getNodes()
-
-        n1 = n['i'][0]
-        n2 = n['i'][1]
-        n3 = n['o'][0]
-        n4 = n['o'][1]
+    def split(self, inlets, outlets):
+        '''
+        Mass flow from each inlet to each outlet, as a matrix
+        '''
+        if len(inlets) == 2 and len(outlets) == 2:
+            return self.splitTwo(inlets, outlets)
+
+        return self.splitLeastSquares(inlets, outlets)
+
+    def splitTwo(self, inlets, outlets):
+        '''
+        The lean outlet takes a from the lean inlet and b from the rich one.
+        Its mass and ammonia balance, a + b = mdot and a*y_lean + b*y_rich =
+        mdot*y, are linear, so solve them directly and clamp to what the
+        inlets have. The rich outlet gets the rest.
+        '''
+        n1, n2 = inlets
+        n3, n4 = outlets
 
         # Find inlet node with lowest nh3 mass fraction
-        if n1['y'] < n2['y']:
-            ni_rich = n2
-            ni_lean = n1
-        else:
-            ni_rich = n1
-            ni_lean = n2
+        lean, rich = (0, 1) if n1['y'] < n2['y'] else (1, 0)
 
         # Find outlet node with lowest nh3 mass fraction
-        if n3['y'] < n4['y']:
-            no_rich = n4
-            no_lean = n3
-        else:
-            no_rich = n3
-            no_lean = n4
-
-        i = 0
+        out_lean, out_rich = (0, 1) if n3['y'] < n4['y'] else (1, 0)
 
-        # Iterate mass fraction left. Start with 50/50 split
+        ni_lean = inlets[lean]
+        ni_rich = inlets[rich]
+        no_lean = outlets[out_lean]
 
-        currIter = IterateParamHelper()
-        currIter.tol = 0.01
+        if ni_rich['y'] > ni_lean['y']:
+            a = no_lean['mdot'] * (ni_rich['y'] - no_lean['y']) / (ni_rich['y'] - ni_lean['y'])
+        else:
+            # Same composition, any split will do
+            a = no_lean['mdot'] * ni_lean['mdot'] / (ni_lean['mdot'] + ni_rich['mdot'])
 
-        while abs(currIter.delta) > currIter.tol and i < 10:
-            # Try finding solution on the lean side
-            ni_lean_a = ni_lean.copy()
-            ni_rich_a = ni_rich.copy()
+        # Don't exceed what the inlets have
+        a = min(max(a, 0), ni_lean['mdot'], no_lean['mdot'])
+        b = no_lean['mdot'] - a
 
-            # Guess better mdot for lean_a/rich_a
+        if b > ni_rich['mdot']:
+            b = ni_rich['mdot']
+            a = min(no_lean['mdot'] - b, ni_lean['mdot'])
 
-            if len(currIter.x) > 0:
-                ratio = currIter.optimize(ratio, manual = True)
+        if a + b > 0 and abs((a * ni_lean['y'] + b * ni_rich['y']) / (a + b) - no_lean['y']) > 1e-9:
+            warnings.warn('Requested y: ' + str(no_lean['y']) + ' cannot be met with the inlet flows', RuntimeWarning)
 
-            else:
-                # Manual guess
-                ratio = no_lean['mdot'] / (ni_lean['mdot'] + ni_rich['mdot'])
-            #else:
-            #    ratio = 0.5
+        flows = np.zeros((2, 2))
+        flows[lean, out_lean] = a
+        flows[rich, out_lean] = b
+        flows[lean, out_rich] = ni_lean['mdot'] - a
+        flows[rich, out_rich] = ni_rich['mdot'] - b
 
-            if ratio > 1:
-                ratio = 1
+        return flows
 
-            ni_lean_a['mdot'] = ni_lean['mdot'] * ratio
+    def splitLeastSquares(self, inlets, outlets):
+        '''
+        Fit the flows to the outlet mdot and ammonia flow (mdot*y) of the
+        outlets that specify them, with every flow between zero and its
+        inlet mdot. The inlet mass balances are weighted heavily, and made
+        exact afterwards. The outlet without them is then fixed by the inlet
+        balances, more than one would leave their split open.
+        '''
+        N = len(inlets)
+        M = len(outlets)
 
-            ni_rich_a['mdot'] = no_lean['mdot'] - ni_lean_a['mdot']
+        free = [node for node in outlets if not ('mdot' in node and 'y' in node)]
 
-            if ni_rich_a['mdot'] > ni_rich['mdot']:
-                # Don't exceed max
-                ni_rich_a['mdot'] = ni_rich['mdot']
-                ni_lean_a['mdot'] = no_lean['mdot'] - ni_rich_a['mdot']
-                ratio = ni_lean_a['mdot'] / ni_lean['mdot']
+        if len(free) > 1:
+            raise InputError('DoubleSplitMix', 'mdot and y are needed for all outlets but one, {} have none'.format(len(free)))
 
-            _no_lean = no_lean.copy()
-            _no_lean['y'] = (ni_lean_a['mdot'] * ni_lean_a['y'] + ni_rich_a['mdot'] * ni_rich_a['y']) / _no_lean['mdot']
+        m = np.array([node['mdot'] for node in inlets])
+        y = np.array([node['y'] for node in inlets])
 
-            delta = _no_lean['y'] - no_lean['y']
+        rows = []
+        targets = []
 
-            print('Ratio: {}, delta: {}'.format(ratio, delta))
+        # Unknowns are the flows, inlet by inlet: flows[i, j] = x[i*M + j]
+        for i in range(N):
+            row = np.zeros(N * M)
+            row[i*M:(i+1)*M] = 1e3
+            rows.append(row)
+            targets.append(1e3 * m[i])
 
-            currIter.delta = delta
-            currIter.append(ratio, delta)
+        for j, node in enumerate(outlets):
+            if 'mdot' in node and 'y' in node:
+                row = np.zeros(N * M)
+                row[j::M] = 1
+                rows.append(row)
+                targets.append(node['mdot'])
 
-            i = i + 1
+                row = np.zeros(N * M)
+                row[j::M] = y
+                rows.append(row)
+                targets.append(node['mdot'] * node['y'])
 
-        # Found split ratio, solve splitters and mixers
+        result = scipy.optimize.lsq_linear(np.array(rows), np.array(targets), bounds = (0, np.repeat(m, M)))
 
-        ni_lean_a = ni_lean.copy()
-        ni_lean_b = ni_lean.copy()
-        ni_rich_a = ni_rich.copy()
-        ni_rich_b = ni_rich.copy()
+        flows = result.x.reshape(N, M)
+        total = flows.sum(axis = 1, keepdims = True)
 
-        # Splitter for lean:
-        ni_lean_a['mdot'] = ni_lean['mdot'] * ratio
-        ni_lean_b['mdot'] = ni_lean['mdot'] - ni_lean_a['mdot']
+        return np.where(total > 0, flows * m[:, None] / np.where(total > 0, total, 1), 1 / M * m[:, None])
 
-        # Splitter for rich:
-        ni_rich_a['mdot'] = no_lean['mdot'] - ni_lean_a['mdot']
-        ni_rich_b['mdot'] = ni_rich['mdot'] - ni_rich_a['mdot']
+    def calc(self):
+        n = self.getNodes()
 
-        # Mass fraction / enthalpy balance for lean:
-        no_lean['y'] = (ni_lean_a['mdot']*ni_lean_a['y'] + ni_rich_a['mdot']*ni_rich_a['y'] )/no_lean['mdot']
-        no_lean['h'] = (ni_lean_a['mdot']*ni_lean_a['h'] + ni_rich_a['mdot']*ni_rich_a['h'] )/no_lean['mdot']
+        inlets = n['i']
+        outlets = n['o']
 
-        # Mass fraction / enthalpy balance for rich:
-        no_rich['y'] = (ni_lean_b['mdot']*ni_lean_b['y'] + ni_rich_b['mdot']*ni_rich_b['y'] )/no_rich['mdot']
-        no_rich['h'] = (ni_lean_b['mdot']*ni_lean_b['h'] + ni_rich_b['mdot']*ni_rich_b['h'] )/no_rich['mdot']
+        media = inlets[0]['media']
 
-        # Get states:
-        state(no_lean)
-        state(no_rich)
+        for node in inlets:
+            if node['media'] != media:
+                raise NotImplementedError('Only same-media mixing is supported')
 
-        return self
+            if node['p'] != inlets[0]['p']:
+                raise InputError('mixer','pressure of inlets must be equal')
 
-    def calc(self):
-        n = self.getNodes()
+        for node in outlets:
+            node['media'] = media
+            node['p'] = inlets[0]['p']
 
-        n1 = n['i'][0]
-        n2 = n['i'][1]
-        n3 = n['o'][0]
-        n4 = n['o'][1]
+        # Be sure to have full information of inputs:
+        for node in inlets:
+            state(node)
 
-        if n1['media'] != n2['media']:
-            raise NotImplementedError('Only same-media mixing is supported')
+        min_y = min(node['y'] for node in inlets)
+        max_y = max(node['y'] for node in inlets)
 
-        n4['media'] = n3['media'] = n1['media']
+        for node in outlets:
+            if 'y' in node:
+                # Make sure the requested y is in bounds
+                self.checkBounds({'y': min_y}, {'y': max_y}, node)
 
-        if n1['p'] != n2['p']:
-            raise InputError('mixer','pressure of inlets must be equal')
+        # Simulate splitters and mixers inline
+        flows = self.split(inlets, outlets)
 
-        n4['p'] = n3['p'] = n2['p'] = n1['p']
+        # Mass fraction / enthalpy balance per outlet
+        for j, node in enumerate(outlets):
+            mdot = flows[:, j].sum()
 
-        # Be sure to have full information of inputs:
-        state(n1)
-        state(n2)
+            node['mdot'] = mdot
 
-        self.checkBounds(n1, n2, n3) # Make sure n3['y'] is in bounds
-        self.checkBounds(n1, n2, n4) # Make sure n4['y'] is in bounds
+            if mdot > 0:
+                node['y'] = sum(flows[i, j] * inlet['y'] for i, inlet in enumerate(inlets)) / mdot
+                node['h'] = sum(flows[i, j] * inlet['h'] for i, inlet in enumerate(inlets)) / mdot
+            else:
+                node['y'] = inlets[0]['y']
+                node['h'] = inlets[0]['h']
 
-        # Simulate splitters and mixers inline
-        self.iterate()
+            # Get states:
+            state(node)
 
-        return self
\ No newline at end of file
+        return self
@@ -1,12 +1,20 @@
+import collections
+import contextlib
+import functools
+import threading
+
+import numpy as np
 import scipy
 import scipy.optimize
 import warnings
 
 # Some short-hands:
-from dna.states import state
-from dna.iterate import IterateParamHelper
+from dna.states import state, states_array, tbub, usermedia, engineFor
 from dna.component import Component
-from dna.vendor import refprop as rp
+from dna.engine import EngineError, InputError
+
+# Dead state for exergy, models can override t with cond['t_dead']
+deadState = {'t': 15, 'p': 1.01325}
 
 class ConvergenceError(Exception):
     def __init__(self, value):
@@ -15,61 +23,55 @@ class ConvergenceError(Exception):
         return repr(self.value)
 
 class PinchCalc:
-    def __init__ (self, n1, n2, n3, n4, Nseg, dTmin):
+    def __init__ (self, n1, n2, n3, n4, Nseg, dTmin, adaptive = False, tol = 0.05, T0 = deadState['t']):
         self.n1 = n1
         self.n2 = n2
         self.n3 = n3
         self.n4 = n4
         self.Nseg = Nseg
         self.dTmin = dTmin
+        self.adaptive = adaptive
+        self.tol = tol
+        self.T0 = T0
 
-    def check(self, n1, n2, n3, n4):
-
-        dH_H = (n1['h']-n2['h'])/self.Nseg
-        dH_C = (n4['h']-n3['h'])/self.Nseg
-
-        dT_left = n1['t'] - n4['t']
-        dT_right = n2['t'] - n3['t']
+        # Saturation enthalpies per (media, p, y), for the adaptive profile
+        self.saturation = {}
 
-        dT_pinch = min(dT_left, dT_right)
-        pinch_pos = 0
+        # Results of check(), reused when the same profile is asked again
+        self.checked = {}
 
-        Th = []
-        Tc = []
+    def check(self, n1, n2, n3, n4):
+        '''
+        Temperature profiles Th and Tc of both streams over Nseg equal
+        enthalpy steps, from the hot inlet side, and the smallest temperature
+        difference between them. Each profile takes one states_array() call.
+        In adaptive mode, the steps follow from profile() instead. x is the
+        fraction of the duty at each point.
+        '''
+        key = tuple((n['p'], n['h'], n['y'], n.get('mdot')) for n in (n1, n2, n3, n4))
 
-        n1_2 = {
-            'media': n1['media'],
-            'y': n1['y'],
-            'cp': n1['cp'],
-            'p': n1['p'],
-            'h': n1['h']
-        }
+        if not key in self.checked:
+            self.checked[key] = self._check(n1, n2, n3, n4)
 
-        n3_4 = {
-            'media': n3['media'],
-            'y': n3['y'],
-            'cp': n3['cp'],
-            'p': n3['p'],
-            'h': n4['h'] # Note n4 usage
-        }
+        return self.checked[key]
 
-        for i in range(self.Nseg+1):
-            # Be explicit about the copying
-            n2_ = n1_2.copy()
-            n3_ = n3_4.copy()
+    def _check(self, n1, n2, n3, n4):
+        dT_left = n1['t'] - n4['t']
+        dT_right = n2['t'] - n3['t']
 
-            n2_['h'] = n1['h'] - dH_H*i
-            n3_['h'] = n4['h'] - dH_C*i
+        x, hot, cold = self.profiles(n1, n2, n3, n4)
 
-            T2_ = state(n2_)['t']
-            Th.append(T2_)
+        Th = hot['t']
+        Tc = cold['t']
 
-            T3_ = state(n3_)['t']
-            Tc.append(T3_)
+        dT = Th - Tc
+        pinch_pos = int(np.argmin(dT))
 
-            if T2_ - T3_ < dT_pinch:
-                pinch_pos = i
-                dT_pinch = T2_ - T3_
+        if dT[pinch_pos] < min(dT_left, dT_right):
+            dT_pinch = float(dT[pinch_pos])
+        else:
+            dT_pinch = min(dT_left, dT_right)
+            pinch_pos = 0
 
         # Get effectiveness from NTU method
 
@@ -85,182 +87,527 @@ class PinchCalc:
         else:
             eff = 0
 
-        return {'dTmin':dT_pinch, 'Th':Th, 'Tc':Tc, 'percent': pinch_pos / self.Nseg, 'eff': eff, 'Q': Q}
+        # Conductance, to rate the same exchanger at other conditions
+        UA = self.conductance(Q, x, Th, Tc)
+
+        # Exergy destruction from the entropy generated in each segment. The
+        # hot profile runs from inlet to outlet, the cold one from outlet to inlet.
+        S_gen = n1['mdot'] * np.diff(hot['s']) - n3['mdot'] * np.diff(cold['s'])
+        Exd = (self.T0 + 273.15) * S_gen
 
-    def iterate(self, side=1):
+        return {'dTmin':dT_pinch, 'Th':Th, 'Tc':Tc, 'x': x, 'percent': float(x[pinch_pos]), 'eff': eff, 'Q': Q,
+            'UA': float(np.sum(UA)), 'UAseg': UA, 'Exd': float(np.sum(Exd)), 'Exdseg': Exd}
+
+    def profiles(self, n1, n2, n3, n4):
         '''
-        Try to find optimal configuration of heat exchanger which satisfies
-        pinch point and has the exergy loss as low as possible.
-        Ideally, the pinch point is close to the hot side, so the cold flow
-        is heated up maximally.
+        Duty fractions x and the hot and cold profiles along both streams,
+        dicts with arrays of t and s. Only the enthalpies of the outlets n2
+        and n4 are used.
         '''
-        dTmin = self.dTmin
+        if self.adaptive:
+            return self.profile(n1, n2, n3, n4)
 
-        # Try pinch at cold side (cold in, hot out)
+        dH_H = (n1['h']-n2['h'])/self.Nseg
+        dH_C = (n4['h']-n3['h'])/self.Nseg
 
+        segments = np.arange(self.Nseg+1)
 
-        # Iteration params
-        tol = 0.1
-        delta = 1
-        convergence = 1
+        hot, cold = self.flash(n1, n3, n1['h'] - dH_H*segments, n4['h'] - dH_C*segments) # Note n4 usage
 
-        currIter = IterateParamHelper()
+        return segments / self.Nseg, hot, cold
 
-        i = 0
+    def flash(self, n1, n3, hh, hc):
+        '''
+        Temperatures and entropies of the hot and cold stream at enthalpies
+        hh and hc
+        '''
+        hot = states_array(n1['p'], hh, n1['y'], media = n1['media'])
+        cold = states_array(n3['p'], hc, n3['y'], media = n3['media'])
+
+        return [dict((k, result[k]) for k in ('t', 's')) for result in (hot, cold)]
 
-        dT_left = dTmin
+    def profile(self, n1, n2, n3, n4, maxiter = 20):
+        '''
+        Adaptive profiles: Nseg coarse segments plus the bubble and dew points
+        of both streams, bisected where the pinch could hide. An interval is
+        split when linear interpolation of the temperature difference, judged
+        from its curvature, may be off by more than tol and the interval may
+        hold a point below the current minimum. The curvature is not taken
+        across the kinks at the phase boundaries.
+        '''
+        dH_H = n1['h'] - n2['h']
+        dH_C = n4['h'] - n3['h']
 
-        result = {}
+        kinks = np.union1d(self.phaseBreaks(n1, n1['h'], n2['h']), self.phaseBreaks(n3, n4['h'], n3['h']))
 
-        find_mdot = False
-        find_mdot1 = False
-        find_mdot3 = False
+        x = np.union1d(np.linspace(0, 1, self.Nseg+1), kinks)
+        hot, cold = self.flash(n1, n3, n1['h'] - dH_H*x, n4['h'] - dH_C*x)
 
-        # If enough info is known about the heat transfer, we can deduct an mdot
-        if not 'mdot' in self.n1:
-            find_mdot = find_mdot1 = True
-            #
-        elif not 'mdot' in self.n3:
-            find_mdot = find_mdot3 = True
-            #
+        for i in range(maxiter):
+            dT = hot['t'] - cold['t']
+            w = np.diff(x)
 
-        print('n1 = ', self.n1['t'])
-        print('n3 = ', self.n3['t'])
+            # Second derivative at the inner points, from divided differences
+            curvature = np.zeros(len(x))
+            curvature[1:-1] = 2*np.abs(np.diff(np.diff(dT) / w)) / (w[:-1] + w[1:])
+            curvature[np.isin(x, kinks)] = 0
 
-        # Tolerance of 0.01 K is close enough
-        # do NOT alter convergence rate parameter. Too high value breaks design
-        while abs(delta) > tol and  i < 20:
-            # Make local copies of input
-            _n1 = self.n1.copy()
-            _n2 = self.n2.copy()
-            _n3 = self.n3.copy()
-            _n4 = self.n4.copy()
+            error = np.maximum(curvature[:-1], curvature[1:]) * w**2 / 8
 
-            if not find_mdot and (_n1['mdot'] <= 0 or _n3['mdot'] <= 0):
-                # No iteration possible, early return
-                result['pinch'] = self.check(_n1, _n2, _n3, _n4)
-                return result['pinch']
+            split = (error > self.tol) & (np.minimum(dT[:-1], dT[1:]) - error < dT.min())
 
-            if len(currIter.x) > 0:
-                dT_left = currIter.optimize(dT_left, manual = True)
-            else:
-                if side == 1:
-                    dT_left = - 0.25 * (_n1['t'] - _n3['t'])
+            if not split.any():
+                break
+
+            xn = x[:-1][split] + w[split] / 2
+            hotn, coldn = self.flash(n1, n3, n1['h'] - dH_H*xn, n4['h'] - dH_C*xn)
+
+            order = np.argsort(np.concatenate((x, xn)))
+            x = np.concatenate((x, xn))[order]
+
+            for profile, new in ((hot, hotn), (cold, coldn)):
+                for k in profile:
+                    profile[k] = np.concatenate((profile[k], new[k]))[order]
+
+        return x, hot, cold
+
+    def phaseBreaks(self, node, h_start, h_end):
+        '''
+        Duty fractions at which the stream from h_start to h_end crosses its
+        bubble or dew point
+        '''
+        if node['media'] in usermedia or h_start == h_end:
+            return []
+
+        key = (node['media'], node['p'], node['y'])
+
+        if not key in self.saturation:
+            try:
+                self.saturation[key] = [state({'media': node['media'], 'p': node['p'], 'y': node['y'], 'q': q})['h'] for q in (0, 1)]
+            except EngineError:
+                # Supercritical, no phase change
+                self.saturation[key] = []
+
+        return [(h_start - h) / (h_start - h_end) for h in self.saturation[key]
+            if min(h_start, h_end) < h < max(h_start, h_end)]
+
+    def solve(self, tol = 0.01, guess = None):
+        '''
+        Find the outlets for known inlets and mass flow rates, such that the
+        pinch equals dTmin. The pinch narrows with the duty Q and closes
+        completely at the energy balance limit, where the hot outlet reaches
+        the cold inlet temperature or the cold outlet the hot inlet
+        temperature. So the root lies between no duty and that limit and is
+        found with Brent's method, within tol [K]. Only the profiles are
+        evaluated during the search, the outlets are flashed at the end.
+        A guess for Q, like the duty of a previous solution, narrows the
+        bracket down first.
+        '''
+        n1 = self.n1
+        n3 = self.n3
+
+        @functools.lru_cache(maxsize = None)
+        def pinch(Q):
+            if Q == 0:
+                # Both profiles are flat
+                return n1['t'] - n3['t'] - self.dTmin
+
+            n2, n4 = self.outlets(Q)
+            x, hot, cold = self.profiles(n1, n2, n3, n4)
+
+            return np.min(hot['t'] - cold['t']) - self.dTmin
+
+        Q_max = self.limit()
+
+        if Q_max <= 0 or pinch(0) <= 0:
+            # Inlets are already within dTmin, no heat exchange
+            Q = 0
+        else:
+            lower = 0
+            upper = Q_max
+
+            if guess is not None and 0 < guess < Q_max:
+                # Narrow the bracket down around the guess. The first step is
+                # a bit more than the distance to the root at the mean slope
+                # from no duty to the limit, where the pinch is at most zero.
+                step = 1.5 * abs(pinch(guess)) * Q_max / (pinch(0) + self.dTmin) + 1e-6 * Q_max
+
+                if pinch(guess) > 0:
+                    lower, upper = guess, min(guess + step, Q_max)
+
+                    while pinch(upper) > 0:
+                        step = 2 * step
+                        lower, upper = upper, min(upper + step, Q_max)
                 else:
-                    dT_left = dTmin
+                    lower, upper = max(guess - step, 0), guess
+
+                    while pinch(lower) <= 0:
+                        step = 2 * step
+                        lower, upper = max(lower - step, 0), lower
+
+            # Tolerance on Q from the slope of the pinch over the bracket
+            Q = scipy.optimize.brentq(pinch, lower, upper, xtol = tol * (upper - lower) / (pinch(lower) - pinch(upper)))
+
+        return self.finish(Q)
+
+    def rate(self, UA, tol = 1e-6):
+        '''
+        Find the outlets for known inlets and mass flow rates in an exchanger
+        of given total UA [kW/K]. As dQ = U dA dT along the exchanger, the sum
+        of dQ/dT over the profile equals the total UA. That sum grows with the duty
+        from zero up to the limit of solve(), so the duty is bracketed and
+        found with Brent's method within tol relative to the limit.
 
-            if side == 1:
-                # Side 1 is hot side, 1 and 4
-                _n4['t'] = _n1['t'] + dT_left
+        With one UA per section, from the hot inlet side, see march().
+        '''
+        n1 = self.n1
+        n3 = self.n3
 
-                if _n4['t'] > _n1['t']:
-                    _n4['t'] = _n1['t'] - 2*dTmin
-                    dT_left = -2*dTmin
+        if np.ndim(UA) > 0:
+            return self.rateSections(np.asarray(UA, dtype = float), tol)
 
-                state(_n4)
+        UA = float(UA)
+        Q_max = self.limit()
 
-                print('n4 = ', _n4['t'])
+        @functools.lru_cache(maxsize = None)
+        def excess(Q):
+            # Scaled to stay finite when the profiles touch
+            if Q == 0:
+                return -0.5
 
-                _n2['h'] = (_n1['h'] * _n1['mdot'] - (_n3['mdot'] * (_n4['h'] - _n3['h']))) / _n1['mdot']
-                state(_n2)
+            if Q == Q_max:
+                return 0.5
 
-                if _n2['t'] < _n3['t']:
-                    print('Pretty sure this should be analysed from side 2')
+            n2, n4 = self.outlets(Q)
+            x, hot, cold = self.profiles(n1, n2, n3, n4)
+            required = np.sum(self.conductance(Q, x, hot['t'], cold['t']))
 
-                print('n2 = ', _n2['t'])
+            return 0.5 if np.isinf(required) else required / (required + UA) - 0.5
 
-                # Update looping parameters
-                delta = _n2['t'] - (_n3['t'] + dTmin)
-            elif side == 2:
-                # Side 2 is cold side, 2 and 3
-                _n2['t'] = _n3['t'] - dT_left
+        if Q_max <= 0 or UA <= 0:
+            Q = 0
+        else:
+            Q = scipy.optimize.brentq(excess, 0, Q_max, xtol = tol * Q_max)
 
-                if _n2['t'] < _n3['t']:
-                    _n2['t'] = _n3['t'] - dTmin
-                    dT_left = dTmin
+        return self.finish(Q)
 
-                state(_n2)
+    def rateSections(self, UA, tol, N = 1000):
+        '''
+        Rating for a fixed UA per section. The duty the sections pass when the
+        cold stream leaves at duty Q falls as Q grows, as the cold outlet
+        closes in on the hot inlet. The duty where both agree is found with
+        Brent's method within tol relative to the limit. Both streams are
+        flashed once, over N steps and their phase boundaries, from the hot
+        inlet down to the cold inlet temperature and from the cold inlet up
+        to the hot inlet temperature.
+        '''
+        n1 = self.n1
+        n3 = self.n3
 
-                print('n2 = ', _n2['t'])
+        Q_max = self.limit()
 
-                _n4['h'] = (_n3['h'] * _n3['mdot'] + (_n1['mdot'] * (_n1['h'] - _n2['h']))) / _n3['mdot']
-                state(_n4)
+        hot_limit = state({'media': n1['media'], 'p': n1['p'], 'y': n1['y'], 't': n3['t']})['h']
+        cold_limit = state({'media': n3['media'], 'p': n3['p'], 'y': n3['y'], 't': n1['t']})['h']
 
-                print('n4 = ', _n4['t'])
+        curves = []
 
-                if _n4['t'] > _n1['t']:
-                    print('Pretty sure this should be analysed from side 1')
+        for node, lo, hi in ((n1, hot_limit, n1['h']), (n3, n3['h'], cold_limit)):
+            breaks = hi - np.array(self.phaseBreaks(node, hi, lo)) * (hi - lo)
+            h = np.union1d(np.linspace(lo, hi, N+1), breaks)
 
-                # Update looping parameters
-                delta = _n1['t'] - (_n4['t'] + dTmin)
-            else:
-                # Assume one side is fixed, depending on if find_mdot1 or find_mdot3 is set
-                if find_mdot1:
-                    # t2 and m1 unknown
-                    _n2['t'] = _n3['t'] - dT_left
+            curves.append((h, states_array(node['p'], h, node['y'], media = node['media'])['t']))
+
+        @functools.lru_cache(maxsize = None)
+        def excess(Q):
+            return min(self.march(Q, UA, *curves, tol = tol) - Q, Q_max)
+
+        if Q_max <= 0 or np.sum(UA) <= 0:
+            Q = 0
+        elif excess(Q_max) >= 0:
+            # Large enough to reach the limit
+            Q = Q_max
+        else:
+            Q = scipy.optimize.brentq(excess, 0, Q_max, xtol = tol * Q_max)
 
-                    if _n2['t'] < _n3['t']:
-                        _n2['t'] = _n3['t'] - dTmin
-                        dT_left = dTmin
+        return self.finish(Q)
 
-                    if 'tmin' in _n1 and _n2['t'] < _n1['tmin']:
-                        _n2['t'] = _n1['tmin']
-                        dT_left = _n3['t'] - _n2['t']
+    def march(self, Q, UA, hot, cold, tol = 1e-6):
+        '''
+        Duty [kW] passed by sections of given UA, marching from the hot inlet
+        with the cold stream leaving at duty Q. hot and cold are (h, t) curves
+        of both streams. The duty of each section follows from its log mean
+        temperature difference, like conductance(), so the sections of a
+        design result, UAseg, reproduce its profile. Infinite if the sections
+        pass all of Q before the last one.
+        '''
+        n1 = self.n1
+        n3 = self.n3
 
-                    state(_n2)
+        def temperatures(hh, hc):
+            return np.interp(hh, *hot), np.interp(hc, *cold)
 
-                    _n1['mdot'] = ((_n4['h'] - _n3['h']) * _n3['mdot']) / (_n1['h'] - _n2['h'])
+        hh = n1['h']
+        hc = n3['h'] + Q / n3['mdot']
+        Th, Tc = temperatures(hh, hc)
 
-                    delta = _n1['t'] - (_n4['t'] + dTmin)
+        total = 0
 
-                elif find_mdot3:
-                    # t4 and m3 unknown
-                    raise Exception('Not implemented')
-                    #n3['mdot'] = ((n1['h'] - n2['h']) * n1['mdot']) / (n4['h'] - n3['h'])
-                else:
-                    print(_n1)
-                    print(_n2)
-                    print(_n3)
-                    print(_n4)
-
-                    raise Exception('Wrong unknowns')
-
-            # Only accept positive delta for internal pinch calculation
-            if delta >= 0 - tol:
-                # At least the pinch at in/outlets is ok. Now check
-                # it internally
-                try:
-                    # Check internal pinch too
-                    result['pinch'] = self.check(_n1, _n2, _n3, _n4)
-                except rp.RefpropError as e:
-                    # Ignore me
-                    print(e)
-                    print('Next')
-                else:
-                    # Calculation succeeded
-                    delta = result['pinch']['dTmin'] - dTmin
+        for ua in UA:
+            if ua <= 0 or Th <= Tc:
+                continue
+
+            def required(dQ):
+                # Conductance needed to pass dQ, minus what the section has
+                Tho, Tco = temperatures(hh - dQ / n1['mdot'], hc - dQ / n3['mdot'])
+
+                return self.conductance(dQ, np.array([0, 1]), np.array([Th, Tho]), np.array([Tc, Tco]))[0] - ua
+
+            # Not past the cold inlet
+            upper = (hc - n3['h']) * n3['mdot']
+
+            if upper <= 0 or required(upper) < 0:
+                return np.inf
+
+            dQ = scipy.optimize.brentq(required, 0, upper, xtol = tol * upper)
+
+            hh = hh - dQ / n1['mdot']
+            hc = hc - dQ / n3['mdot']
+            Th, Tc = temperatures(hh, hc)
+
+            total = total + dQ
+
+        return total
+
+    def conductance(self, Q, x, Th, Tc):
+        '''
+        UA [kW/K] of each segment of the profiles at duty Q, from its log mean
+        temperature difference. Infinite where the profiles touch or cross.
+        '''
+        dT = Th - Tc
+
+        a = dT[:-1]
+        b = dT[1:]
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            lmtd = np.where(np.abs(a - b) > 1e-9 * np.abs(a), (a - b) / np.log(a / b), a)
+            lmtd = np.where((a > 0) & (b > 0), lmtd, 0)
+
+            dQ = Q * np.diff(x)
+
+            return np.where(dQ == 0, 0, dQ / lmtd)
 
-            currIter.delta = delta # commented out to prevent IterateParamHelper from guessing
-            currIter.append(dT_left, delta)
+    def outlets(self, Q):
+        '''
+        Outlets of the hot and cold stream at duty Q, as enthalpy only
+        '''
+        return {'h': self.n1['h'] - Q / self.n1['mdot']}, {'h': self.n3['h'] + Q / self.n3['mdot']}
+
+    def limit(self):
+        '''
+        Largest duty the energy balance allows: the hot stream leaving at the
+        cold inlet temperature, or the cold stream at the hot inlet temperature
+        '''
+        n1 = self.n1
+        n3 = self.n3
+
+        hot_limit = state({'media': n1['media'], 'p': n1['p'], 'y': n1['y'], 't': n3['t']})['h']
+        cold_limit = state({'media': n3['media'], 'p': n3['p'], 'y': n3['y'], 't': n1['t']})['h']
+
+        return min(n1['mdot'] * (n1['h'] - hot_limit), n3['mdot'] * (cold_limit - n3['h']))
 
-            i = i + 1
+    def finish(self, Q):
+        '''
+        Flash the outlets at duty Q and check the profiles
+        '''
+        h2, h4 = self.outlets(Q)
 
-            print('Iteration: ', i, '. Residual: ', currIter.y[-1])
+        self.n2['h'] = h2['h']
+        self.n4['h'] = h4['h']
 
-        if abs(delta) > tol:
-            print(delta, convergence, i)
-            raise ConvergenceError('No convergence reached')
+        state(self.n2)
+        state(self.n4)
 
-        if not 'pinch' in result:
-            warnings.warn('No pinch solution found', RuntimeWarning)
-            return False
+        return self.check(self.n1, self.n2, self.n3, self.n4)
+
+    def findMdot(self, tol = 0.01):
+        '''
+        Find the mass flow rate and outlet of the stream that has neither,
+        for a fully known other stream, such that the pinch equals dTmin. The
+        free stream takes as little flow as it can, so its outlet approaches
+        the inlet temperature of the other stream, or its own tmin or tmax.
+        More flow flattens its profile and widens the pinch, so the root lies
+        between that outlet and infinite flow, where the profile is flat at
+        its inlet temperature. It is found with Brent's method, within tol [K].
+        The temperature difference at the inlet of the free stream does not
+        depend on its flow, so it is left out of the search.
+        '''
+        n1 = self.n1
+        n2 = self.n2
+        n3 = self.n3
+        n4 = self.n4
+
+        if not 'mdot' in n1 and 'mdot' in n3 and 'h' in n4:
+            # t2 and m1 unknown, the hot inlet is at x = 0
+            free, outlet, inner = n1, n2, slice(1, None)
+            Q = n3['mdot'] * (n4['h'] - n3['h'])
+            t = max(n3['t'], n1.get('tmin', n3['t']))
+            profiles = lambda h: self.profiles(n1, {'h': h}, n3, n4)
+        elif not 'mdot' in n3 and 'mdot' in n1 and 'h' in n2:
+            # t4 and m3 unknown, the cold inlet is at x = 1
+            free, outlet, inner = n3, n4, slice(None, -1)
+            Q = n1['mdot'] * (n1['h'] - n2['h'])
+            t = min(n1['t'], n3.get('tmax', n1['t']))
+            profiles = lambda h: self.profiles(n1, n2, n3, {'h': h})
         else:
-            self.n1.update(_n1)
-            self.n2.update(_n2)
-            self.n3.update(_n3)
-            self.n4.update(_n4)
+            raise InputError('PinchHex', 'finding a mass flow rate needs the other stream fully known')
 
-            return result['pinch']
+        @functools.lru_cache(maxsize = None)
+        def pinch(h):
+            x, hot, cold = profiles(h)
+
+            return np.min((hot['t'] - cold['t'])[inner]) - self.dTmin
+
+        if Q <= 0:
+            h = free['h']
+        elif pinch(free['h']) <= 0:
+            raise InputError('PinchHex', 'dTmin cannot be met for any mass flow rate')
+        else:
+            limit = state({'media': free['media'], 'p': free['p'], 'y': free['y'], 't': t})['h']
+
+            if pinch(limit) >= 0:
+                h = limit
+            else:
+                h = scipy.optimize.brentq(pinch, limit, free['h'], xtol = tol * abs(free['h'] - limit) / (pinch(free['h']) - pinch(limit)))
+
+        outlet['h'] = h
+        state(outlet)
+
+        free['mdot'] = 0 if Q <= 0 else Q / abs(free['h'] - h)
+        outlet['mdot'] = free['mdot']
+
+        return self.check(n1, n2, n3, n4)
+
+class PinchMemo:
+    '''
+    Solutions of PinchHex.calc per component. IterateModel builds a new model
+    every iteration, so they are kept here, by model class and component
+    name. Solutions are keyed on the inputs of the inlets and the specified
+    outlet quantities, an exact hit restores the solved nodes and profile.
+    Otherwise the duty of the last solution with the same specification
+    starts the pinch search. Disabled by default, see pinchMemo. Solutions
+    are shared by all threads, but the memo is enabled per thread.
+    '''
+    def __init__(self, maxsize = 16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.near = 0
+        self.misses = 0
+        self._data = collections.defaultdict(collections.OrderedDict)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return getattr(self._local, 'enabled', False)
+
+    @enabled.setter
+    def enabled(self, value):
+        self._local.enabled = value
+
+    def key(self, nodes, *args):
+        inputs = tuple(tuple(sorted((k, v) for k, v in node.items() if not k in ('from', 'to')))
+            for node in nodes)
+
+        return (engineFor(nodes[0]).name, engineFor(nodes[1]).name, inputs) + args
+
+    def get(self, component, key):
+        with self._lock:
+            solutions = self._data[component]
+
+            if key in solutions:
+                solutions.move_to_end(key)
+                self.hits = self.hits + 1
+                return solutions[key]
+
+            return None
+
+    def duty(self, component, key):
+        '''
+        Duty of the last solution for the same outlet specification and
+        settings, which only had other inlet values
+        '''
+        shape = self.shape(key)
+
+        with self._lock:
+            for other in reversed(self._data[component]):
+                if self.shape(other) == shape:
+                    self.near = self.near + 1
+                    return self._data[component][other]['duty']
+
+            self.misses = self.misses + 1
+            return None
+
+    def shape(self, key):
+        inlets = tuple(tuple(k for k, v in inputs) for inputs in key[2][:2])
+
+        return key[:2] + (inlets,) + key[2][2:] + key[3:]
+
+    def put(self, component, key, nodes, result):
+        duty = nodes[0]['mdot'] * (nodes[0]['h'] - nodes[2]['h']) if 'mdot' in nodes[0] else None
+
+        solution = {
+            'nodes': [dict((k, v) for k, v in node.items() if not k in ('from', 'to')) for node in nodes],
+            'result': result,
+            'duty': duty
+        }
+
+        with self._lock:
+            solutions = self._data[component]
+            solutions[key] = solution
+
+            while len(solutions) > self.maxsize:
+                solutions.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.near = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'near': self.near,
+                'misses': self.misses,
+                'components': len(self._data)
+            }
+
+memo = PinchMemo()
+
+@contextlib.contextmanager
+def pinchMemo(enabled = True, clear = False):
+    '''
+    Reuse pinch solutions across model runs for a block of code:
+
+        with pinchMemo():
+            model = IterateModel(MyModel, cond).run()
+
+    The previous setting is restored on exit, solutions are kept unless
+    clear is set. Only the current thread is affected.
+    '''
+    previous = memo.enabled
+
+    if clear:
+        memo.clear()
+
+    memo.enabled = enabled
+
+    try:
+        yield memo
+    finally:
+        memo.enabled = previous
 
 class PinchHex(Component):
     def nodes(self, in1, out1, in2, out2):
@@ -271,7 +618,53 @@ class PinchHex(Component):
 
         return self
 
-    def calc(self, Nseg = 11, dTmin = 5, Q = False):
+    def calc(self, Nseg = 11, dTmin = 5, Q = False, adaptive = False, tol = 0.05, UA = None):
+        '''
+        With adaptive, Nseg only sets the coarse profile, which is refined
+        around the phase boundaries and the pinch until the pinch is found
+        within tol [K]. Solutions are reused from memo when it is enabled.
+
+        With UA [kW/K], the exchanger is rated instead: for known inlets and
+        mass flow rates, the outlets follow from its UA and dTmin is not
+        enforced. UA is either the total or one value per section, from the
+        hot inlet side. The UA found in design mode is in the result, so
+
+            UA = model.result['recup']['UA']
+
+        rates the same exchanger at other conditions. UAseg holds the UA of
+        each segment of the design profile, which keeps the distribution over
+        the exchanger, at the cost of flashing section by section.
+        '''
+        if UA is not None and np.ndim(UA) > 0:
+            UA = tuple(UA)
+
+        if not memo.enabled:
+            return self._calc(Nseg, dTmin, Q, adaptive, tol, UA)
+
+        n = self.getNodes()
+        nodes = n['i'] + n['o']
+
+        component = (type(self.model).__name__, self.name)
+        key = memo.key(nodes, Nseg, dTmin, Q, adaptive, tol, UA, self.model.cond.get('t_dead'))
+
+        solution = memo.get(component, key)
+
+        if solution is not None:
+            for node, solved in zip(nodes, solution['nodes']):
+                node.update(solved)
+
+            if solution['result'] is not None:
+                self.storeResult(solution['result'])
+
+            return self
+
+        self._calc(Nseg, dTmin, Q, adaptive, tol, UA, guess = memo.duty(component, key))
+
+        memo.put(component, key, nodes, self.model.result.get(self.name))
+
+        return self
+
+    def _calc(self, Nseg, dTmin, Q, adaptive, tol, UA, guess = None):
         n = self.getNodes()
 
         n1 = n['i'][0]
@@ -338,7 +731,8 @@ class PinchHex(Component):
             state(n4) # Cold outlet
 
         # Initiate pincher for later use
-        pincher = PinchCalc(n1, n2, n3, n4, Nseg, dTmin)
+        pincher = PinchCalc(n1, n2, n3, n4, Nseg, dTmin, adaptive = adaptive, tol = tol,
+            T0 = self.model.cond.get('t_dead', deadState['t']))
 
         if 'h' in n1 and 'h' in n2 and 'mdot' in n1:
             Q = n1['mdot'] * (n1['h'] - n2['h'])
@@ -347,7 +741,19 @@ class PinchHex(Component):
             Q = n3['mdot'] * (n4['h'] - n3['h'])
 
         # Find any unknown inputs:
-        if not 't' in n2 and not 't' in n4:
+        if UA is not None:
+            # Rating, for given mass flow rates and inlet temperatures
+            calc = True
+
+            if 't' in n2 or 't' in n4 or not 'mdot' in n1 or not 'mdot' in n3:
+                raise InputError('PinchHex', 'rating `{}` needs both mass flow rates and no outlet temperatures'.format(self.name))
+
+            pincher.rate(UA)
+
+            print('Rating - {} - following outlet temperatures found:'.format(self.name))
+            print('T2: ', n2['t'], ' T4: ', n4['t'])
+
+        elif not 't' in n2 and not 't' in n4:
             # Find pinch by iteration, for given mass flow rates and inlet temperatures
             calc = True
 
@@ -359,73 +765,38 @@ class PinchHex(Component):
                 n4['t'] = n3['t']
                 state(n4)
             else:
-                # First try one side of the HEX
-                try:
-                    pinch = pincher.iterate(side = 1)
-                except RuntimeError as e:
-                    print('First side failed, trying second. Reason:')
-                    print(e)
-
-                    # If that failed, try from the other
-                    try:
-                        pinch = pincher.iterate(side = 2)
-                    except rp.RefpropError as e:
-                        print('Second side iteration also failed.')
-                        raise Exception(e)
-                except rp.RefpropError as e:
-                    print('First side failed, trying second. Reason:')
-                    print(e)
-
-                    # If that failed, try from the other
-                    try:
-                        pinch = pincher.iterate(side = 2)
-                    except rp.RefpropError as e:
-                        print('Second side iteration also failed.')
-                        raise Exception(e)
-                except ConvergenceError as e:
-                    print('Convergence failed, trying other side', e)
-
-                    try:
-                        pinch = pincher.iterate(side = 2)
-                    except rp.RefpropError as e:
-                        print('Second side iteration also failed.')
-                        raise Exception(e)
-                except Exception as e:
-                    print('Unexpected exception: ', e)
-                    raise(e)
-                finally:
-                    print('Pinch - {} - following outlet temperatures found:'.format(self.name))
-                    print('T2: ', n2['t'], ' T4: ', n4['t'])
+                pinch = pincher.solve(guess = guess)
+
+                print('Pinch - {} - following outlet temperatures found:'.format(self.name))
+                print('T2: ', n2['t'], ' T4: ', n4['t'])
 
         elif not 'h' in n4:
             # Calculate T4 for given mass flow rates and other temperatures
             calc = True
 
+            if Q and not 'mdot' in n1:
+                n1['mdot'] = Q / (n1['h'] - n2['h'])
+
             if 'mdot' in n1 and 'mdot' in n3:
                 n4['h'] = (n3['h'] * n3['mdot'] + (n1['mdot'] * (n1['h'] - n2['h']))) / n3['mdot']
                 state(n4)
             else:
-                n1['mdot'] = Q / (n1['h'] - n2['h'])
-
-                try:
-                    pinch = pincher.iterate(side = False)
-                except Exception as e:
-                    raise(e)
+                # t4 and m3 from the pinch
+                pinch = pincher.findMdot()
 
         elif not 'h' in n2:
             # Calculate T2 for given mass flow rates and other temperatures
             calc = True
 
+            if Q and not 'mdot' in n3:
+                n3['mdot'] = Q / (n4['h'] - n3['h'])
+
             if 'mdot' in n1 and 'mdot' in n3:
                 n2['h'] = (n1['h'] * n1['mdot'] - (n3['mdot'] * (n4['h'] - n3['h']))) / n1['mdot']
                 state(n2)
             else:
-                n3['mdot'] = Q / (n4['h'] - n3['h'])
-
-                try:
-                    pinch = pincher.iterate(side = False)
-                except Exception as e:
-                    raise(e)
+                # t2 and m1 from the pinch
+                pinch = pincher.findMdot()
 
         if not 'mdot' in n3:
             # Calculate m3 for given m1 or Q, and given temperatures
@@ -455,11 +826,209 @@ class PinchHex(Component):
 
         self.storeResult(pinch)
 
-        if abs(pinch['dTmin'] - dTmin) > 0.1:
+        if UA is None and abs(pinch['dTmin'] - dTmin) > 0.1:
             print('Pinch - {} - value {:.2f} not enforced, found {:.2f} from conditions'.format(self.name, dTmin, pinch['dTmin']))
 
         return self
 
+class MultiStreamHex(Component):
+    '''
+    Heat exchanger between any number of hot and cold streams, analysed on
+    their composite curves with a single global dTmin:
+
+        hx = self.addComponent(comp.MultiStreamHex, 'discharge').nodes(hot = [(8, 11)], cold = [(1, 4), (21, 22)])
+
+    Each stream needs its inlet state. Outlets are either specified (t, q or
+    h) or free. Supported are:
+    - one free stream on each side, all mass flow rates known: the duty is
+      solved such that the pinch equals dTmin
+    - one free stream, all mass flow rates known: its outlet follows from
+      the energy balance
+    - no free streams, one unknown mass flow rate: it follows from the
+      energy balance
+    '''
+    def nodes(self, hot, cold):
+        self.hot = len(hot)
+
+        for inlet, outlet in list(hot) + list(cold):
+            self.addInlet(inlet)
+            self.addOutlet(outlet)
+
+        return self
+
+    def streams(self):
+        n = self.getNodes()
+        pairs = list(zip(n['i'], n['o']))
+
+        return pairs[:self.hot], pairs[self.hot:]
+
+    def calc(self, Nseg = 11, dTmin = 5, tol = 0.01):
+        hot, cold = self.streams()
+
+        for inlet, outlet in hot + cold:
+            state(inlet)
+
+            for k in ('media', 'p', 'y', 'cp'):
+                if k in inlet:
+                    outlet[k] = inlet[k]
+
+            if 'mdot' in outlet and not 'mdot' in inlet:
+                inlet['mdot'] = outlet['mdot']
+
+            if 't' in outlet or 'q' in outlet or 'h' in outlet:
+                state(outlet)
+
+        free = [[(i, o) for i, o in side if not 'h' in o] for side in (hot, cold)]
+        unknown = [(i, o) for i, o in hot + cold if not 'mdot' in i]
+
+        def duty(streams):
+            return sum(abs(i['mdot'] * (i['h'] - o['h'])) for i, o in streams if 'h' in o and 'mdot' in i)
+
+        if unknown:
+            if len(unknown) > 1 or free[0] or free[1]:
+                raise InputError('MultiStreamHex', '`{}` can only find one mass flow rate, for specified outlets'.format(self.name))
+
+            inlet, outlet = unknown[0]
+            side = hot if any(inlet is i for i, o in hot) else cold
+            other = cold if side is hot else hot
+
+            inlet['mdot'] = (duty(other) - duty(side)) / abs(inlet['h'] - outlet['h'])
+
+        elif len(free[0]) > 1 or len(free[1]) > 1:
+            raise InputError('MultiStreamHex', '`{}` can have only one free outlet per side'.format(self.name))
+
+        elif free[0] and free[1]:
+            self.solve(hot, cold, free[0][0], free[1][0], Nseg, dTmin, tol)
+
+        elif free[0] or free[1]:
+            # The other side sets the duty
+            inlet, outlet = (free[0] or free[1])[0]
+            fixed = duty(cold) - duty(hot) if free[0] else duty(hot) - duty(cold)
+
+            if fixed < 0:
+                raise InputError('MultiStreamHex', 'energy balance of `{}` cannot be closed'.format(self.name))
+
+            sign = -1 if free[0] else 1
+            outlet['h'] = inlet['h'] + sign * fixed / inlet['mdot']
+            state(outlet)
+
+            if not inlet.get('tmin', -np.inf) <= outlet['t'] <= inlet.get('tmax', np.inf):
+                raise InputError('MultiStreamHex', 'free outlet of `{}` at {:.2f} C is outside tmin and tmax'.format(self.name, outlet['t']))
+
+        else:
+            print('Model overly specified for heatex `{}`'.format(self.name))
+
+        for inlet, outlet in hot + cold:
+            outlet['mdot'] = inlet['mdot']
+
+        result = self.check(hot, cold, Nseg)
+
+        self.storeResult(result)
+
+        if abs(result['dTmin'] - dTmin) > 0.1:
+            print('Pinch - {} - value {:.2f} not enforced, found {:.2f} from conditions'.format(self.name, dTmin, result['dTmin']))
+
+        return self
+
+    def solve(self, hot, cold, free_hot, free_cold, Nseg, dTmin, tol):
+        '''
+        Find the duty at which the pinch of the composite curves equals
+        dTmin. Both free streams take what the specified streams leave of the
+        duty. It is bracketed between no duty for a free stream and the free
+        hot stream leaving at the coldest cold inlet, or the free cold stream
+        at the hottest hot inlet, where the curves touch. Free streams do not
+        leave below their tmin or above their tmax, so the duty stops there
+        if the pinch is still wider than dTmin.
+        '''
+        fixed_hot = sum(i['mdot'] * (i['h'] - o['h']) for i, o in hot if not i is free_hot[0])
+        fixed_cold = sum(i['mdot'] * (o['h'] - i['h']) for i, o in cold if not i is free_cold[0])
+
+        def outlets(Q):
+            (hi, ho), (ci, co) = free_hot, free_cold
+
+            ho['h'] = hi['h'] - (Q - fixed_hot) / hi['mdot']
+            co['h'] = ci['h'] + (Q - fixed_cold) / ci['mdot']
+
+        @functools.lru_cache(maxsize = None)
+        def pinch(Q):
+            outlets(Q)
+
+            return self.composite(hot, cold, Nseg)[3] - dTmin
+
+        (hi, ho), (ci, co) = free_hot, free_cold
+
+        t_hot = max(min(i['t'] for i, o in cold), hi.get('tmin', -273.15))
+        t_cold = min(max(i['t'] for i, o in hot), ci.get('tmax', np.inf))
+
+        coldest = state({'media': hi['media'], 'p': hi['p'], 'y': hi['y'], 't': t_hot})['h']
+        hottest = state({'media': ci['media'], 'p': ci['p'], 'y': ci['y'], 't': t_cold})['h']
+
+        lower = max(fixed_hot, fixed_cold)
+        upper = min(fixed_hot + hi['mdot'] * (hi['h'] - coldest), fixed_cold + ci['mdot'] * (hottest - ci['h']))
+
+        if upper < lower:
+            raise InputError('MultiStreamHex', 'free outlets of `{}` cannot stay within tmin and tmax'.format(self.name))
+
+        if upper == lower or pinch(lower) <= 0:
+            # Specified streams alone already close the pinch
+            Q = lower
+        elif pinch(upper) >= 0:
+            # A free stream reached its tmin or tmax first
+            Q = upper
+        else:
+            Q = scipy.optimize.brentq(pinch, lower, upper, xtol = tol * (upper - lower) / (pinch(lower) - pinch(upper)))
+
+        outlets(Q)
+
+        state(ho)
+        state(co)
+
+    def composite(self, hot, cold, Nseg):
+        '''
+        Hot and cold composite curves on a common duty axis from the cold end:
+        duty Q [kW], temperatures Th and Tc, and the pinch. Every stream is
+        evaluated in one states_array() call over Nseg enthalpy steps, the
+        composite is interpolated from those profiles.
+        '''
+        def curve(streams):
+            profiles = []
+
+            for inlet, outlet in streams:
+                h0, h1 = sorted((inlet['h'], outlet['h']))
+                h = np.linspace(h0, h1, Nseg+1)
+
+                T = states_array(inlet['p'], h, inlet['y'], media = inlet['media'])['t']
+                profiles.append((T, inlet['mdot'] * (h - h0)))
+
+            T = np.unique(np.concatenate([T for T, H in profiles]))
+            H = sum(np.interp(T, Ti, Hi) for Ti, Hi in profiles)
+
+            return T, H
+
+        Th, Hh = curve(hot)
+        Tc, Hc = curve(cold)
+
+        Q = np.union1d(Hh, Hc)
+        Q = Q[Q <= min(Hh[-1], Hc[-1])]
+
+        Th = np.interp(Q, Hh, Th)
+        Tc = np.interp(Q, Hc, Tc)
+
+        return Q, Th, Tc, float(np.min(Th - Tc))
+
+    def check(self, hot, cold, Nseg):
+        Q, Th, Tc, dT = self.composite(hot, cold, Nseg)
+
+        x = Q / Q[-1] if Q[-1] > 0 else np.linspace(0, 1, len(Q))
+        pinch_pos = int(np.argmin(Th - Tc))
+
+        # Exergy destruction from the entropy generated over all streams
+        T0 = self.model.cond.get('t_dead', deadState['t'])
+        S_gen = sum(i['mdot'] * (o['s'] - i['s']) for i, o in hot + cold)
+
+        return {'dTmin': dT, 'Th': Th, 'Tc': Tc, 'x': x, 'percent': float(x[pinch_pos]), 'Q': float(Q[-1]),
+            'Exd': (T0 + 273.15) * S_gen}
+
 class Condenser(Component):
     def nodes(self, in1, out1):
         self.addInlet(in1)
@@ -480,7 +1049,7 @@ class Condenser(Component):
         n2['mdot'] = n1['mdot']
 
         # If it is subcooled liquid entering the condenser, pass it through unamended
-        Tsat = state({'p': n1['p'], 'y': n1['y'], 'q': 0})['t']
+        Tsat = tbub(n1['p'], n1['y'])
         if Tsat > n1['t']:
             n2['t'] = n1['t']
         else:
@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class DiskCache:
+    '''
+    Flash results in an SQLite file, shared between runs and processes. It
+    sits behind the in-memory StateCache and uses its keys. The engine's
+    fingerprint is added, so entries from another fluid model or reference
+    state are never used. The least recently used entries are evicted beyond
+    maxsize, and entries older than maxage [s] (if given) are dropped.
+
+    Writes are collected and committed every batch entries, and on flush() or
+    close(). Other processes see them from then on. Each thread uses its own
+    connection, pending writes are shared by the threads of a process.
+    '''
+    def __init__(self, path, maxsize = 1000000, maxage = None, batch = 200):
+        self.path = path
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.batch = batch
+        self.hits = 0
+        self.misses = 0
+
+        self._pid = None
+        self._connections = []
+        self._pending = {}
+        self._used = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connection(self):
+        # Connections do not survive a fork, and sqlite3 ties them to the
+        # thread that opened them, so every process and thread opens its own
+        db = getattr(self._local, 'db', None)
+
+        if db is not None and self._local.pid == os.getpid() and db in self._connections:
+            return db
+
+        # Closed from another thread (in close()), so they may not be tied to it
+        db = sqlite3.connect(self.path, timeout = 60, check_same_thread = False)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS states_used ON states (used)')
+        db.commit()
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Pending entries and connections of the parent are not ours
+                self._pid = os.getpid()
+                self._connections = []
+                self._pending = {}
+                self._used = set()
+
+            self._connections.append(db)
+
+        self._local.pid = os.getpid()
+        self._local.db = db
+
+        return db
+
+    def key(self, fingerprint, key):
+        return fingerprint + '|' + repr(key)
+
+    def get(self, fingerprint, key):
+        key = self.key(fingerprint, key)
+
+        with self._lock:
+            if key in self._pending:
+                self.hits = self.hits + 1
+                return self._pending[key]
+
+        row = self.connection().execute('SELECT value, created FROM states WHERE key = ?', (key,)).fetchone()
+
+        with self._lock:
+            if row is None or (self.maxage is not None and row[1] < time.time() - self.maxage):
+                self.misses = self.misses + 1
+                return None
+
+            self.hits = self.hits + 1
+            self._used.add(key)
+
+        return json.loads(row[0])
+
+    def put(self, fingerprint, key, value):
+        self.connection()
+
+        with self._lock:
+            self._pending[self.key(fingerprint, key)] = value
+            full = len(self._pending) >= self.batch
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        '''
+        Commit pending entries and usage, evict what is beyond the limits
+        '''
+        if self._pid != os.getpid():
+            return
+
+        with self._lock:
+            pending, used = self._pending, self._used
+            self._pending = {}
+            self._used = set()
+
+        db = self.connection()
+        now = time.time()
+
+        with db:
+            db.executemany('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)',
+                [(k, json.dumps(v), now, now) for k, v in pending.items()])
+            db.executemany('UPDATE states SET used = ? WHERE key = ?', [(now, k) for k in used])
+
+            if self.maxage is not None:
+                db.execute('DELETE FROM states WHERE created < ?', (now - self.maxage,))
+
+            excess = db.execute('SELECT COUNT(*) FROM states').fetchone()[0] - self.maxsize
+
+            if excess > 0:
+                # Evict a tenth more than needed, so this does not run every flush
+                db.execute('DELETE FROM states WHERE key IN (SELECT key FROM states ORDER BY used LIMIT ?)',
+                    (excess + self.maxsize // 10,))
+
+    def clear(self):
+        with self.connection() as db:
+            db.execute('DELETE FROM states')
+
+        with self._lock:
+            self._pending = {}
+            self._used = set()
+            self.hits = 0
+            self.misses = 0
+
+    def close(self):
+        if self._pid == os.getpid():
+            self.flush()
+
+            with self._lock:
+                for db in self._connections:
+                    db.close()
+
+        with self._lock:
+            self._pid = None
+            self._connections = []
+
+    def info(self):
+        size = self.connection().execute('SELECT COUNT(*) FROM states').fetchone()[0]
+
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / total if total > 0 else 0,
+                'size': size + len(self._pending),
+                'maxsize': self.maxsize,
+                'path': self.path
+            }
@@ -0,0 +1,126 @@
+from dna.node import StateNode, mask
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+    pass
+
+class InputError(Error):
+    """Exception raised for errors in the input.
+
+    Attributes:
+        expr -- input expression in which the error occurred
+        msg  -- explanation of the error
+    """
+
+    def __init__(self, expr, msg):
+        self.expr = expr
+        self.msg = msg
+
+class EngineError(Error):
+    """Exception raised when a property engine can not find a state."""
+    pass
+
+# Flash modes sorted by priority: (mode, first input, second input)
+flashModes = [
+    ('ph', 'p', 'h'),
+    ('pe', 'p', 'e'),
+    ('ps', 'p', 's'),
+    ('pq', 'p', 'q'),
+    ('tp', 't', 'p'),
+    ('tq', 't', 'q')
+]
+
+# Bitmasks of both inputs for StateNode.known
+flashMasks = [(mode, mask(mode[1], mode[2])) for mode in flashModes]
+
+def flashMode(node):
+    '''
+    Figure out which inputs to use for a flash. Returns (mode, in1, in2) with
+    the keys of both inputs, or None if the node is underspecified
+    '''
+    if type(node) is StateNode:
+        known = node.known
+
+        for mode, m in flashMasks:
+            if known & m == m:
+                return mode
+
+        return None
+
+    for mode in flashModes:
+        if mode[1] in node and mode[2] in node:
+            return mode
+
+    return None
+
+class Engine:
+    '''
+    Base class for property engines. Engines are registered per media in
+    dna.states, and work in the units used throughout the model:
+
+        t [C], p [bar], h, e [kJ/kg], s, cp [kJ/kg*K], D [kg/m3]
+        y, yliq, yvap [kg NH3/kg], q [kg vapour/kg]
+    '''
+
+    name = 'engine'
+
+    # Whether flash results only depend on the flash inputs, so they can be
+    # cached and tabulated
+    cacheable = True
+
+    def flash(self, node):
+        '''
+        Find the state for the inputs in node. Returns a dict with the properties
+        '''
+        raise NotImplementedError
+
+    def state(self, node):
+        node.update(self.flash(node))
+
+        return node
+
+    def fingerprint(self):
+        '''
+        Identifies the setup of the engine, so results stored for another
+        fluid model or reference state are not reused
+        '''
+        return '{}.{}:{}'.format(type(self).__module__, type(self).__qualname__, self.name)
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        '''
+        Vectorized flash for arrays of both inputs of mode and y. Returns a dict
+        of property arrays
+        '''
+        raise NotImplementedError
+
+    def sat(self, y, p = None, t = None, q = 0):
+        '''
+        Saturated state at either pressure or temperature. q = 0 gives the
+        bubble point, q = 1 the dew point
+        '''
+        node = {'y': y, 'q': q}
+
+        if p is not None:
+            node['p'] = p
+        else:
+            node['t'] = t
+
+        return self.state(node)
+
+    def crit(self, y):
+        '''
+        Critical point for mass fraction y: dict with tcrit, pcrit (and Dcrit)
+        '''
+        raise NotImplementedError
+
+    def toMole(self, y):
+        '''
+        Mass fraction to (mole fraction, molar mass [kg/kmol])
+        '''
+        raise NotImplementedError
+
+    def toMass(self, x):
+        '''
+        Mole fraction to (mass fraction, molar mass [kg/kmol])
+        '''
+        raise NotImplementedError
@@ -0,0 +1,511 @@
+'''
+Ammonia-water mixture properties from the Gibbs energy formulation of Ibrahim
+and Klein (1993), vectorized with numpy.
+
+The pure components follow Ziegler and Trepp, the liquid mixture adds an excess
+Gibbs energy and the vapour is taken as an ideal mixture of real gases. The
+correlation covers about 230-600 K and up to 110 bar. Enthalpy and entropy use
+the reference state of the correlation, which is not the REFPROP reference
+state: only differences can be compared between engines.
+'''
+
+import hashlib
+
+import numpy as np
+
+from dna.engine import Engine, EngineError, InputError, flashMode
+
+R = 8.314 # kJ/kmol*K
+Tb = 100 # K, reducing temperature
+pb = 10 # bar, reducing pressure
+
+# Molar mass [kg/kmol]
+Ma = 17.03026
+Mw = 18.01528
+
+# Reduced temperature range searched by the flashes
+Tmin = 2.0
+Tmax = 10.0
+
+ammonia = {
+    'name': 'ammonia',
+    'A1': 3.971423e-2, 'A2': -1.790557e-5, 'A3': -1.308905e-2, 'A4': 3.752836e-3,
+    'B1': 16.34519, 'B2': -6.508119, 'B3': 1.448937,
+    'C1': -1.049377e-2, 'C2': -8.288224, 'C3': -664.7257, 'C4': -3045.352,
+    'D1': 3.673647, 'D2': 9.989629e-2, 'D3': 3.617622e-2,
+    'hL0': 4.878573, 'hG0': 26.468873, 'sL0': 1.644773, 'sG0': 8.339026,
+    'T0': 3.2252, 'p0': 2.0
+}
+
+water = {
+    'name': 'water',
+    'A1': 2.748796e-2, 'A2': -1.016665e-5, 'A3': -4.452025e-3, 'A4': 8.389246e-4,
+    'B1': 12.14557, 'B2': -1.898065, 'B3': 0.2911966,
+    'C1': 2.136131e-2, 'C2': -31.69291, 'C3': -46346.11, 'C4': 0,
+    'D1': 4.019170, 'D2': -5.175550e-2, 'D3': 1.951939e-2,
+    'hL0': 21.821141, 'hG0': 60.965058, 'sL0': 5.733498, 'sG0': 13.453430,
+    'T0': 5.0705, 'p0': 3.0
+}
+
+# Excess Gibbs energy coefficients E1..E16, as (E0 + E1*p + (E2 + E3*p)*T + E4/T + E5/T**2)
+# for each of the three terms of the expansion in (2x - 1)
+excess = [
+    (-41.733398, 0.02414, 6.702285, -0.011475, 63.608967, -62.490768),
+    (1.761064, 0.008626, 0.387983, -0.004772, -4.648107, 0.836376),
+    (-3.553627, 0.000904, 0, 0, 24.361723, -20.736547)
+]
+
+# Pure component critical points [K, bar]. The mixture critical point is
+# interpolated linearly in mole fraction, which is only a rough estimate.
+critical = {
+    'ammonia': (405.40, 113.33),
+    'water': (647.096, 220.64)
+}
+
+class AmmoniaWater(Engine):
+    '''
+    Ammonia-water mixture properties without REFPROP. All methods work on
+    numpy arrays as well as on single nodes.
+    '''
+
+    name = 'ammoniawater'
+
+    def flash(self, node):
+        mode = flashMode(node)
+
+        if mode is None:
+            raise InputError('state', 'Missing inputs for node {}'.format(node))
+
+        mode, in1, in2 = mode
+
+        result = self.stateArray([node[in1]], [node[in2]], [node['y']], mode)
+
+        return dict((k, float(v[0])) for k, v in result.items())
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        in1, in2, y = (np.array(a, dtype = float) for a in np.broadcast_arrays(in1, in2, y))
+
+        with np.errstate(all = 'ignore'):
+            result = ammoniaWaterArray(in1, in2, y, mode)
+
+        failed = np.isnan(result['t']) | np.isnan(result['h'])
+
+        if failed.any():
+            raise EngineError('No {} state for {:d} of {:d} inputs, first at {}={}, {}={}, y={}'.format(
+                mode, failed.sum(), failed.size, mode[0], in1[failed][0], mode[1], in2[failed][0], y[failed][0]))
+
+        return result
+
+    def fingerprint(self):
+        # Changes to the coefficients invalidate stored results
+        coefficients = repr((R, Tb, pb, Ma, Mw, sorted(ammonia.items()), sorted(water.items()), excess, critical))
+
+        return 'ammoniawater:' + hashlib.sha1(coefficients.encode('utf-8')).hexdigest()
+
+    def crit(self, y):
+        x, _ = self.toMole(y)
+
+        tcrit = x * critical['ammonia'][0] + (1 - x) * critical['water'][0]
+        pcrit = x * critical['ammonia'][1] + (1 - x) * critical['water'][1]
+
+        return {'y': y, 'tcrit': tcrit - 273.15, 'pcrit': pcrit}
+
+    def toMole(self, y):
+        return toMole(y)
+
+    def toMass(self, x):
+        return toMass(x)
+
+def toMole(y):
+    '''
+    Mass fraction to (mole fraction, molar mass [kg/kmol])
+    '''
+    x = (y / Ma) / (y / Ma + (1 - y) / Mw)
+
+    return x, x * Ma + (1 - x) * Mw
+
+def toMass(x):
+    '''
+    Mole fraction to (mass fraction, molar mass [kg/kmol])
+    '''
+    M = x * Ma + (1 - x) * Mw
+
+    return x * Ma / M, M
+
+def _xlogx(x):
+    return np.where(x > 0, x * np.log(np.where(x > 0, x, 1)), 0)
+
+def _liquid(c, T, p):
+    '''
+    Reduced g, h, s, v and cp of a pure liquid
+    '''
+    T0, p0 = c['T0'], c['p0']
+
+    h = (c['hL0'] + c['B1']*(T - T0) + c['B2']/2*(T**2 - T0**2) + c['B3']/3*(T**3 - T0**3)
+        + (c['A1'] - c['A4']*T**2)*(p - p0) + c['A2']/2*(p**2 - p0**2))
+    s = (c['sL0'] + c['B1']*np.log(T/T0) + c['B2']*(T - T0) + c['B3']/2*(T**2 - T0**2)
+        - (c['A3'] + 2*c['A4']*T)*(p - p0))
+    v = c['A1'] + c['A3']*T + c['A4']*T**2 + c['A2']*p
+    cp = c['B1'] + c['B2']*T + c['B3']*T**2 - 2*c['A4']*T*(p - p0)
+
+    return h - T*s, h, s, v, cp
+
+def _gas(c, T, p):
+    '''
+    Reduced g, h, s, v and cp of a pure gas
+    '''
+    T0, p0 = c['T0'], c['p0']
+
+    h = (c['hG0'] + c['D1']*(T - T0) + c['D2']/2*(T**2 - T0**2) + c['D3']/3*(T**3 - T0**3)
+        + c['C1']*(p - p0) + 4*c['C2']*(p/T**3 - p0/T0**3) + 12*c['C3']*(p/T**11 - p0/T0**11)
+        + 4*c['C4']*(p**3/T**11 - p0**3/T0**11))
+    s = (c['sG0'] + c['D1']*np.log(T/T0) + c['D2']*(T - T0) + c['D3']/2*(T**2 - T0**2)
+        - np.log(p/p0) + 3*c['C2']*(p/T**4 - p0/T0**4) + 11*c['C3']*(p/T**12 - p0/T0**12)
+        + 11/3*c['C4']*(p**3/T**12 - p0**3/T0**12))
+    v = T/p + c['C1'] + c['C2']/T**3 + c['C3']/T**11 + c['C4']*p**2/T**11
+    cp = (c['D1'] + c['D2']*T + c['D3']*T**2 - 12*c['C2']*p/T**4 - 132*c['C3']*p/T**12
+        - 44*c['C4']*p**3/T**12)
+
+    return h - T*s, h, s, v, cp
+
+def _excess(x, T, p):
+    '''
+    Reduced excess Gibbs energy of the liquid with its derivatives to x, T, T
+    (twice) and p
+    '''
+    u = 2*x - 1
+
+    F = []
+
+    for e in excess:
+        F.append((
+            e[0] + e[1]*p + (e[2] + e[3]*p)*T + e[4]/T + e[5]/T**2,
+            e[2] + e[3]*p - e[4]/T**2 - 2*e[5]/T**3,
+            2*e[4]/T**3 + 6*e[5]/T**4,
+            e[1] + e[3]*T
+        ))
+
+    P = [F[0][i] + F[1][i]*u + F[2][i]*u**2 for i in range(4)]
+
+    ge = x*(1 - x)*P[0]
+    gex = (1 - 2*x)*P[0] + x*(1 - x)*(2*F[1][0] + 4*F[2][0]*u)
+
+    return ge, gex, x*(1 - x)*P[1], x*(1 - x)*P[2], x*(1 - x)*P[3]
+
+def _liquidMixture(x, T, p):
+    '''
+    Liquid mixture h, s, v and cp in dna units for mole fraction x
+    '''
+    _, ha, sa, va, cpa = _liquid(ammonia, T, p)
+    _, hw, sw, vw, cpw = _liquid(water, T, p)
+    ge, _, geT, geTT, gep = _excess(x, T, p)
+
+    h = x*ha + (1 - x)*hw + ge - T*geT
+    s = x*sa + (1 - x)*sw - geT - _xlogx(x) - _xlogx(1 - x)
+    v = x*va + (1 - x)*vw + gep
+    cp = x*cpa + (1 - x)*cpw - T*geTT
+
+    return _toMass(x, h, s, v, cp)
+
+def _gasMixture(y, T, p):
+    '''
+    Gas mixture h, s, v and cp in dna units for mole fraction y
+    '''
+    _, ha, sa, va, cpa = _gas(ammonia, T, p)
+    _, hw, sw, vw, cpw = _gas(water, T, p)
+
+    h = y*ha + (1 - y)*hw
+    s = y*sa + (1 - y)*sw - _xlogx(y) - _xlogx(1 - y)
+    v = y*va + (1 - y)*vw
+    cp = y*cpa + (1 - y)*cpw
+
+    return _toMass(y, h, s, v, cp)
+
+def _toMass(x, h, s, v, cp):
+    '''
+    Reduced molar properties to kJ/kg, kJ/kg*K and m3/kg
+    '''
+    _, M = toMass(x)
+
+    return {
+        'h': h*R*Tb/M,
+        's': s*R/M,
+        'v': v*R*Tb/pb/100/M,
+        'cp': cp*R/M
+    }
+
+def _lnK(x, T, p, dga, dgw):
+    '''
+    Logarithm of the equilibrium ratios y/x of ammonia and water for a liquid of
+    mole fraction x. dga and dgw are the pure liquid minus gas Gibbs energies.
+    '''
+    ge, gex, _, _, _ = _excess(x, T, p)
+
+    return (dga + ge + (1 - x)*gex) / T, (dgw + ge - x*gex) / T
+
+def _illinois(f, a, b, tol = 1e-12, maxiter = 100):
+    '''
+    Vectorized Illinois (modified regula falsi) root finder for f on the brackets
+    [a, b]. Gives NaN where a bracket holds no sign change.
+    '''
+    a, b = (np.array(_, dtype = float) for _ in np.broadcast_arrays(a, b))
+    fa, fb = f(a), f(b)
+
+    ok = fa * fb <= 0
+
+    for i in range(maxiter):
+        done = ~ok | (fb == 0) | (np.abs(b - a) <= tol * (1 + np.abs(b)))
+
+        if done.all():
+            break
+
+        c = b - fb * (b - a) / (fb - fa)
+
+        # Bisect where the secant step leaves the bracket
+        outside = ~np.isfinite(c) | ((c - a) * (c - b) > 0)
+        c = np.where(outside, (a + b) / 2, c)
+        c = np.where(done, b, c)
+
+        fc = f(c)
+
+        flip = fc * fb < 0
+
+        a, fa = np.where(flip, b, a), np.where(flip, fb, np.where(done, fa, fa / 2))
+        b, fb = c, np.where(done, fb, fc)
+
+    return np.where(ok, b, np.nan)
+
+def _scan(f, grid, shape):
+    '''
+    Bracket the first sign change of f along the values in grid
+    '''
+    F = np.array([f(np.full(shape, g)) for g in grid])
+
+    change = np.sign(F[:-1]) * np.sign(F[1:]) <= 0
+    first = np.argmax(change, axis = 0)
+    found = change.any(axis = 0)
+
+    lo = np.where(found, np.take(grid, first), np.nan)
+    hi = np.where(found, np.take(grid, first + 1), np.nan)
+
+    return lo, hi
+
+def _tsat(c, p):
+    '''
+    Reduced saturation temperature of a pure component at reduced pressure p.
+    The gas correlation turns unphysical far below the boiling point, so the
+    root is searched downwards from the critical temperature.
+    '''
+    def f(T):
+        return _liquid(c, T, p)[0] - _gas(c, T, p)[0]
+
+    tcrit, _ = critical[c['name']]
+
+    return _illinois(f, *_scan(f, np.linspace(tcrit / Tb, Tmin, 33), p.shape))
+
+def _lnpsat(c, T):
+    '''
+    Logarithm of the reduced saturation pressure of a pure component at reduced
+    temperature T, searched upwards from the gas side
+    '''
+    def f(lnp):
+        p = np.exp(lnp)
+        return _liquid(c, T, p)[0] - _gas(c, T, p)[0]
+
+    _, pcrit = critical[c['name']]
+
+    return _illinois(f, *_scan(f, np.linspace(np.log(1e-5), np.log(pcrit / pb), 33), T.shape))
+
+def _lnpsatExtrapolated(c, T):
+    '''
+    Vapour pressure beyond the critical temperature, linear in 1/T as from
+    Clausius-Clapeyron
+    '''
+    tcrit, pcrit = critical[c['name']]
+
+    Tc = np.array([0.9, 0.99]) * tcrit / Tb
+    lnp = _lnpsat(c, Tc)
+
+    slope = (lnp[1] - lnp[0]) / (1 / Tc[1] - 1 / Tc[0])
+
+    return lnp[1] + slope * (1 / T - 1 / Tc[1])
+
+def _equilibrium(T, p):
+    '''
+    Liquid and vapour mole fractions in equilibrium at reduced T, p. Below the
+    ammonia boiling point both are 1, above the water boiling point both are 0.
+    '''
+    dga = _liquid(ammonia, T, p)[0] - _gas(ammonia, T, p)[0]
+    dgw = _liquid(water, T, p)[0] - _gas(water, T, p)[0]
+
+    def f(x):
+        lnKa, lnKw = _lnK(x, T, p, dga, dgw)
+        return np.logaddexp(np.log(x) + lnKa, np.log(1 - x) + lnKw)
+
+    x = _illinois(f, np.zeros_like(T), np.ones_like(T))
+    x = np.where(np.isnan(x), np.where(f(np.ones_like(T)) < 0, 1.0, 0.0), x)
+    y = np.clip(x * np.exp(_lnK(x, T, p, dga, dgw)[0]), 0, 1)
+
+    return x, y
+
+def _properties(T, p, z, Ta, Tw):
+    '''
+    All properties in dna units at reduced T, p for the bulk mole fraction z.
+    Ta and Tw are the boiling points of ammonia and water at p.
+    '''
+    x, y = _equilibrium(T, p)
+
+    # Far from the boiling points the correlation is not reliable, so use them
+    x = np.where(T <= Ta, 1.0, np.where(T >= Tw, 0.0, x))
+    y = np.where(T <= Ta, 1.0, np.where(T >= Tw, 0.0, y))
+
+    liquid = (T <= Ta) | ((z <= x) & (T < Tw))
+    vapour = ~liquid & (z >= y)
+    twophase = ~liquid & ~vapour
+
+    xl = np.where(twophase, x, z)
+    xv = np.where(twophase, y, z)
+
+    yz, _ = toMass(z)
+    yl, _ = toMass(xl)
+    yv, _ = toMass(xv)
+
+    # Lever rule in mass fractions gives the mass quality
+    with np.errstate(all = 'ignore'):
+        q = np.where(liquid, 0.0, np.where(vapour, 1.0, (yz - yl) / (yv - yl)))
+
+    L = _liquidMixture(xl, T, p)
+    V = _gasMixture(xv, T, p)
+
+    result = _mix(L, V, q)
+    result['cp'] = np.where(liquid, L['cp'], np.where(vapour, V['cp'], np.nan))
+    result['yliq'] = yl
+    result['yvap'] = yv
+
+    return result
+
+def _mix(L, V, q):
+    '''
+    Two-phase properties from the saturated phases and the mass quality
+    '''
+    result = dict((k, (1 - q)*L[k] + q*V[k]) for k in ['h', 's', 'v'])
+
+    result['q'] = q
+    result['cp'] = np.full_like(q, np.nan)
+
+    return result
+
+def _withEnergy(result, p):
+    result['e'] = result['h'] - p*pb*100*result['v'] # bar*m3/kg > kJ/kg
+    return result
+
+def _solveT(key, target, p, z, Ta, Tw):
+    '''
+    Temperature where property key (h, s or e) reaches target at reduced
+    pressure p. For pure components the temperature stays at the boiling point
+    in the two-phase region, so there the quality follows from the lever rule.
+    '''
+    def f(T):
+        return _withEnergy(_properties(T, p, z, Ta, Tw), p)[key] - target
+
+    T = _illinois(f, np.full_like(p, Tmin), np.full_like(p, Tmax))
+
+    result = _withEnergy(_properties(T, p, z, Ta, Tw), p)
+
+    missed = np.abs(result[key] - target) > 1e-6 * (1 + np.abs(target))
+
+    if missed.any():
+        L = _withEnergy(_liquidMixture(z, T, p), p)
+        V = _withEnergy(_gasMixture(z, T, p), p)
+
+        q = np.clip((target - L[key]) / (V[key] - L[key]), 0, 1)
+
+        mixed = _withEnergy(_mix(L, V, q), p)
+
+        for k in result:
+            if k in mixed:
+                result[k] = np.where(missed, mixed[k], result[k])
+
+    return T, result
+
+def _saturated(T, p, z, q, Ta, Tw):
+    '''
+    Two-phase properties for mass quality q, where T, p is on the saturation
+    line for z. Pure components need the lever rule since x = y = z there.
+    '''
+    result = _properties(T, p, z, Ta, Tw)
+
+    pure = (z == 0) | (z == 1)
+
+    if pure.any():
+        mixed = _mix(_liquidMixture(z, T, p), _gasMixture(z, T, p), q)
+
+        for k in result:
+            if k in mixed:
+                result[k] = np.where(pure, mixed[k], result[k])
+
+    return _withEnergy(result, p)
+
+def _qResidual(q, yz, T, p):
+    '''
+    Mass balance residual for quality q, zero on the saturation line
+    '''
+    x, y = _equilibrium(T, p)
+    yl, _ = toMass(x)
+    yv, _ = toMass(y)
+
+    return (yz - yl) - q * (yv - yl)
+
+def ammoniaWaterArray(in1, in2, y, mode):
+    '''
+    Flash arrays of inputs of mode in dna units. Failed flashes give NaN
+    '''
+    z, _ = toMole(y)
+
+    if mode == 'tp':
+        T, p = (in1 + 273.15) / Tb, in2 / pb
+        result = _withEnergy(_properties(T, p, z, _tsat(ammonia, p), _tsat(water, p)), p)
+    elif mode in ['ph', 'ps', 'pe']:
+        p = in1 / pb
+        T, result = _solveT(mode[1], in2, p, z, _tsat(ammonia, p), _tsat(water, p))
+    elif mode == 'pq':
+        p, q = in1 / pb, np.clip(in2, 0, 1)
+
+        Ta = _tsat(ammonia, p)
+        Tw = _tsat(water, p)
+
+        T = _illinois(lambda T: _qResidual(q, y, T, p), Ta, Tw)
+        T = np.where(z == 1, Ta, np.where(z == 0, Tw, T))
+
+        result = _saturated(T, p, z, q, Ta, Tw)
+    elif mode == 'tq':
+        T, q = (in1 + 273.15) / Tb, np.clip(in2, 0, 1)
+
+        lnpa = _lnpsat(ammonia, T)
+        lnpw = _lnpsat(water, T)
+
+        # Above the ammonia critical temperature, extrapolate its vapour pressure
+        # but stay below the critical pressure of water
+        lnpc = np.minimum(_lnpsatExtrapolated(ammonia, T), np.log(critical['water'][1] / pb))
+        lnpa = np.where(np.isnan(lnpa) & (z < 1), lnpc, lnpa)
+
+        lnp = _illinois(lambda lnp: _qResidual(q, y, T, np.exp(lnp)), lnpw, lnpa)
+        p = np.exp(np.where(z == 1, lnpa, np.where(z == 0, lnpw, lnp)))
+
+        result = _saturated(T, p, z, q, _tsat(ammonia, p), _tsat(water, p))
+    else:
+        raise InputError('state', 'Flash mode {} is not supported'.format(mode))
+
+    return {
+        't': T * Tb - 273.15,
+        'p': p * pb,
+        'h': result['h'],
+        's': result['s'],
+        'q': result['q'],
+        'D': 1 / result['v'],
+        'e': result['e'],
+        'cp': result['cp'],
+        'y': y,
+        'yliq': result['yliq'],
+        'yvap': result['yvap']
+    }
@@ -0,0 +1,190 @@
+import functools
+
+import numpy as np
+
+from dna.engine import Engine, InputError
+
+# cp is either a constant or the coefficients of a polynomial in t [°C]:
+# cp = c0 + c1*t + c2*t**2 + ... [kJ/kgK]
+usermedia = {
+    'hitecxl': {'cp': 1.447, 'tmin': 130, 'tmax': 490},
+    'hitec': {'cp': 1.5617, 'tmin': 180, 'tmax': 560},
+    # Solar salt (60% NaNO3, 40% KNO3), Zavoico, SAND2001-2100
+    'solarsalt': {'cp': (1.443, 1.72e-4), 'tmin': 260, 'tmax': 600}
+}
+
+class CpBased(Engine):
+    '''
+    Constant or polynomial cp media, like molten salts. Media parameters are
+    taken from usermedia, see dna.states.checkMediaAndEngine
+    '''
+
+    name = 'cpbased'
+
+    # Cheaper to calculate than to look up
+    cacheable = False
+
+    def flash(self, node):
+        return cpBasedState(node.copy())
+
+    def state(self, node):
+        return cpBasedState(node)
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        return cpBasedArray(in1, in2, mode, usermedia[media]['cp'])
+
+class CpPolynomial:
+    '''
+    Closed form h(t) and s(t) for cp = c0 + c1*t + c2*t**2 + ..., with h = 0
+    and s = 0 at t = 0. t(h) and t(s) are found by Newton iteration, which
+    works on whole arrays at once.
+    '''
+    def __init__(self, coefs):
+        self.cp = np.polynomial.Polynomial(coefs)
+        self.h = self.cp.integ()
+
+        # Entropy integrates cp/T, so write cp in T = t + 273.15: b0 + T*rest(T)
+        cpT = self.cp(np.polynomial.Polynomial([-273.15, 1]))
+        self.b0 = cpT.coef[0]
+        self.rest = np.polynomial.Polynomial(cpT.coef[1:]).integ()
+        self.s0 = self.rest(273.15)
+
+    def s(self, t):
+        T = np.asarray(t) + 273.15
+        return self.b0 * np.log(T / 273.15) + self.rest(T) - self.s0
+
+    def tFromH(self, h, tol = 1e-10, maxiter = 50):
+        h = np.asarray(h, dtype = float)
+        t = h / self.cp.coef[0]
+
+        for i in range(maxiter):
+            step = (self.h(t) - h) / self.cp(t)
+            t = t - step
+
+            if np.all(np.abs(step) < tol):
+                break
+
+        return t
+
+    def tFromS(self, s, tol = 1e-10, maxiter = 50):
+        s = np.asarray(s, dtype = float)
+        t = 273.15 * np.expm1(s / self.cp.coef[0])
+
+        for i in range(maxiter):
+            step = (self.s(t) - s) * (t + 273.15) / self.cp(t)
+            t = t - step
+
+            if np.all(np.abs(step) < tol):
+                break
+
+        return t
+
+@functools.lru_cache(maxsize = None)
+def cpPolynomial(coefs):
+    return CpPolynomial(coefs)
+
+def cpBasedState(node):
+    '''
+    This does not consider:
+    p,cv,q,y,yvap,yliq
+    But it considers:
+    e,h,s,t,cp
+    Reference point is: h = 0 and s = 0 at t=0 [C]
+    '''
+
+    # Make sure object has often-requested properties defined
+    if not 'p' in node:
+        node['p'] = 0
+
+    if not 'q' in node:
+        node['q'] = 0
+
+    if not 'y' in node:
+        node['y'] = 0
+
+    cp = usermedia[node['media']]['cp'] if node.get('media') in usermedia else node['cp']
+
+    if isinstance(cp, tuple):
+        return polynomialState(node, cpPolynomial(cp))
+
+    # Calculation, s = cp ln(T/273.15) as ds = cp dT/T
+    if 'h' in node:
+        node['t'] = node['h'] / node['cp']
+        node['s'] = float(node['cp'] * np.log1p(node['t'] / 273.15))
+
+    elif 't' in node:
+        node['h'] = node['cp'] * node['t']
+        node['s'] = float(node['cp'] * np.log1p(node['t'] / 273.15))
+    elif 's' in node:
+        node['t'] = float(273.15 * np.expm1(node['s'] / node['cp']))
+        node['h'] = node['cp'] * node['t']
+
+    return node
+
+def polynomialState(node, poly):
+    '''
+    cpBasedState for a polynomial cp, which also sets cp at the state
+    '''
+    if 'h' in node:
+        node['t'] = float(poly.tFromH(node['h']))
+    elif 's' in node and not 't' in node:
+        node['t'] = float(poly.tFromS(node['s']))
+
+    t = node['t']
+
+    if not 'h' in node:
+        node['h'] = float(poly.h(t))
+
+    node['s'] = float(poly.s(t))
+    node['cp'] = float(poly.cp(t))
+
+    return node
+
+def cpBasedArray(in1, in2, mode, cp):
+    '''
+    Vectorized equivalent of cpBasedState for all flash modes
+    '''
+    result = {
+        'p': in1 if mode[0] == 'p' else in2 if mode[1] == 'p' else np.zeros(in1.shape),
+        'q': np.zeros(in1.shape),
+        'y': np.zeros(in1.shape)
+    }
+
+    inputs = {mode[0]: in1, mode[1]: in2}
+
+    if isinstance(cp, tuple):
+        poly = cpPolynomial(cp)
+
+        if 'h' in inputs:
+            result['t'] = poly.tFromH(inputs['h'])
+        elif 't' in inputs:
+            result['t'] = np.asarray(inputs['t'], dtype = float)
+        elif 's' in inputs:
+            result['t'] = poly.tFromS(inputs['s'])
+        else:
+            raise InputError('states_array', 'Mode ' + mode + ' not supported for cp based media')
+
+        result['h'] = inputs['h'] if 'h' in inputs else poly.h(result['t'])
+        result['s'] = inputs['s'] if 's' in inputs else poly.s(result['t'])
+        result['cp'] = poly.cp(result['t'])
+
+        return result
+
+    if 'h' in inputs:
+        result['h'] = inputs['h']
+        result['t'] = inputs['h'] / cp
+    elif 't' in inputs:
+        result['t'] = inputs['t']
+        result['h'] = cp * inputs['t']
+    elif 's' in inputs:
+        result['t'] = 273.15 * np.expm1(inputs['s'] / cp)
+        result['h'] = cp * result['t']
+    else:
+        raise InputError('states_array', 'Mode ' + mode + ' not supported for cp based media')
+
+    if not 's' in inputs:
+        result['s'] = cp * np.log1p(result['t'] / 273.15)
+    else:
+        result['s'] = inputs['s']
+
+    return result
@@ -0,0 +1,255 @@
+import multiprocessing as mp
+import threading
+from multiprocessing import connection, shared_memory
+
+import numpy as np
+
+from dna.engine import Engine, EngineError
+
+# Properties returned by stateArray, in the order of the rows in shared memory
+keys = ('t', 'p', 'h', 's', 'q', 'D', 'e', 'cp', 'y', 'yliq', 'yvap')
+
+class PoolEngine(Engine):
+    '''
+    Persistent pool of worker processes, each with its own property engine
+    made by factory. Arrays of states are split over the workers, inputs and
+    results go through a block of shared memory per worker, so only a short
+    message passes through the pipes:
+
+        with PoolEngine(RefpropEngine, workers = 4) as pool, useEngine(pool):
+            result = states_array(p, h, y)
+
+    Without a factory, workers use the default engine of dna.states. Single
+    flashes go to a worker too, so batch them with states() or
+    states_array() where possible.
+
+    The pool takes the name, fingerprint and cacheable flag of the engine in
+    the workers, so cached states are shared with that engine, and not with
+    pools of other engines.
+
+    Threads can share a pool, their calls take turns. Each stateArray call
+    already uses all workers.
+    '''
+
+    def __init__(self, factory = None, workers = None, capacity = 4096):
+        self.capacity = capacity
+
+        self.workers = []
+        self.next = 0
+
+        # Pipes and shared memory serve one call at a time
+        self._lock = threading.Lock()
+
+        for i in range(workers or mp.cpu_count()):
+            inputs = shared_memory.SharedMemory(create = True, size = 3 * capacity * 8)
+            outputs = shared_memory.SharedMemory(create = True, size = len(keys) * capacity * 8)
+
+            parent, child = mp.Pipe()
+
+            process = mp.Process(target = _worker, args = (factory, inputs.name, outputs.name, capacity, child), daemon = True)
+            process.start()
+
+            self.workers.append(Worker(process, parent, inputs, outputs, capacity))
+
+        # Wait for all engines to be set up
+        try:
+            setups = set(worker.receive() for worker in self.workers)
+        except EngineError:
+            self.close()
+            raise
+
+        if len(setups) > 1:
+            self.close()
+            raise EngineError('Workers set up different engines: {}'.format(sorted(setups)))
+
+        self.name, self._fingerprint, self.cacheable = setups.pop()
+
+    def fingerprint(self):
+        return self._fingerprint
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for worker in self.workers:
+                worker.close()
+
+            self.workers = []
+
+    def call(self, method, *args):
+        '''
+        Call method of the engine in the next worker
+        '''
+        with self._lock:
+            self.next = (self.next + 1) % len(self.workers)
+
+            worker = self.workers[self.next]
+            worker.send(('call', method, args))
+
+            return worker.receive()
+
+    def flash(self, node):
+        return self.call('flash', dict(node))
+
+    def crit(self, y):
+        return self.call('crit', y)
+
+    def toMole(self, y):
+        return self.call('toMole', y)
+
+    def toMass(self, x):
+        return self.call('toMass', x)
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        with self._lock:
+            return self._stateArray(in1, in2, y, mode, media)
+
+    def _stateArray(self, in1, in2, y, mode, media):
+        in1, in2, y = np.broadcast_arrays(*[np.asarray(v, dtype = float).ravel() for v in (in1, in2, y)])
+
+        n = len(in1)
+        result = dict((k, np.full(n, np.nan)) for k in keys)
+        found = set()
+
+        # Chunks of at most capacity, spread evenly over the workers
+        size = min(self.capacity, max(1, -(-n // len(self.workers))))
+        chunks = [slice(i, min(i + size, n)) for i in range(0, n, size)]
+
+        busy = {}
+        error = None
+
+        while chunks or busy:
+            for worker in self.workers:
+                if chunks and not worker.conn in busy:
+                    chunk = chunks.pop(0)
+                    worker.submit(in1[chunk], in2[chunk], y[chunk], mode, media)
+                    busy[worker.conn] = (worker, chunk)
+
+            for conn in connection.wait(list(busy)):
+                worker, chunk = busy.pop(conn)
+
+                try:
+                    present, out = worker.collect(chunk.stop - chunk.start)
+                except EngineError as e:
+                    # Let the other workers finish first
+                    error = e
+                    chunks = []
+                    continue
+
+                found.update(present)
+
+                for j, k in enumerate(keys):
+                    result[k][chunk] = out[j]
+
+        if error is not None:
+            raise error
+
+        return dict((k, v) for k, v in result.items() if k in found or n == 0)
+
+class Worker:
+    '''
+    Parent side of a worker process: its pipe and shared memory blocks
+    '''
+    def __init__(self, process, conn, inputs, outputs, capacity):
+        self.process = process
+        self.conn = conn
+        self.inputs = inputs
+        self.outputs = outputs
+        self.inview = np.ndarray((3, capacity), dtype = float, buffer = inputs.buf)
+        self.outview = np.ndarray((len(keys), capacity), dtype = float, buffer = outputs.buf)
+
+    def send(self, message):
+        self.conn.send(message)
+
+    def receive(self):
+        status, value = self.conn.recv()
+
+        if status == 'error':
+            raise EngineError(value)
+
+        return value
+
+    def submit(self, in1, in2, y, mode, media):
+        n = len(in1)
+
+        self.inview[0, :n] = in1
+        self.inview[1, :n] = in2
+        self.inview[2, :n] = y
+
+        self.send(('array', mode, media, n))
+
+    def collect(self, n):
+        present = self.receive()
+
+        return present, self.outview[:, :n].copy()
+
+    def close(self):
+        try:
+            self.send(None)
+            self.process.join(5)
+        except (BrokenPipeError, EOFError, OSError):
+            pass
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+        # Views have to go before the memory can be released
+        del self.inview, self.outview
+
+        for block in (self.inputs, self.outputs):
+            block.close()
+            block.unlink()
+
+def _worker(factory, inputs, outputs, capacity, conn):
+    '''
+    Worker process: set up the engine, then serve requests until None comes in
+    '''
+    inputs = shared_memory.SharedMemory(name = inputs)
+    outputs = shared_memory.SharedMemory(name = outputs)
+
+    inview = np.ndarray((3, capacity), dtype = float, buffer = inputs.buf)
+    outview = np.ndarray((len(keys), capacity), dtype = float, buffer = outputs.buf)
+
+    try:
+        if factory is None:
+            from dna import states
+            engine = states.engineFor({})
+        else:
+            engine = factory()
+    except Exception as e:
+        conn.send(('error', 'Could not set up engine: {}'.format(e)))
+        return
+
+    conn.send(('ok', (engine.name, engine.fingerprint(), engine.cacheable)))
+
+    while True:
+        message = conn.recv()
+
+        if message is None:
+            break
+
+        try:
+            if message[0] == 'array':
+                mode, media, n = message[1:]
+
+                result = engine.stateArray(inview[0, :n], inview[1, :n], inview[2, :n], mode = mode, media = media)
+
+                for j, k in enumerate(keys):
+                    outview[j, :n] = result[k] if k in result else np.nan
+
+                conn.send(('ok', [k for k in keys if k in result]))
+            else:
+                method, args = message[1:]
+
+                conn.send(('ok', getattr(engine, method)(*args)))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+    del inview, outview
+
+    inputs.close()
+    outputs.close()
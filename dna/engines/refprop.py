@@ -0,0 +1,615 @@
+import contextlib
+import functools
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from dna.engine import Engine, EngineError, InputError, flashMode
+from dna.profile import profile
+from dna.vendor import refprop as rp
+
+if rp is None:
+    raise ImportError('REFPROP library is not available')
+
+class RefpropEngineError(EngineError, rp.RefpropError):
+    """Refprop failed to find a state, also after the workarounds."""
+    pass
+
+# REFPROP keeps its setup in the library, so there is one per process. Engines
+# take turns through the lock, the last one to set it up is active
+lock = threading.RLock()
+active = None
+
+class RefpropEngine(Engine):
+    '''
+    Ammonia-water mixture properties from REFPROP. Each engine keeps its own
+    reference state, and sets up the library again when another engine used
+    it in between. Calls from several threads are serialized.
+    '''
+
+    name = 'refprop'
+
+    def __init__(self, hrf = 'def', ixflag = 1):
+        self.hrf = hrf
+        self.ixflag = ixflag
+
+        # Cached states depend on the reference state
+        if hrf.lower() != 'def':
+            self.name = 'refprop-' + hrf.lower()
+
+        with self.library():
+            pass
+
+    def fingerprint(self):
+        # Setup of the library, and the fluid files it read
+        files = []
+
+        for fluid in ('ammonia.fld', 'water.fld', 'hmx.bnc'):
+            try:
+                stat = os.stat(os.path.join(rp._fpath, 'fluids', fluid))
+                files.append((fluid, stat.st_size, int(stat.st_mtime)))
+            except OSError:
+                files.append((fluid, None))
+
+        setup = repr(('ammonia', 'water', self.hrf.lower(), self.ixflag, files))
+
+        return 'refprop:' + hashlib.sha1(setup.encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def library(self):
+        '''
+        Hold the library, set up for this engine
+        '''
+        global active
+
+        with lock:
+            if active is not self:
+                rp.setup(self.hrf, 'ammonia', 'water')
+                rp.setref(hrf = self.hrf, ixflag = self.ixflag)
+
+                # Conversions depend on the fluids set up
+                massComposition.cache_clear()
+                moleComposition.cache_clear()
+
+                active = self
+
+            yield self
+
+    def flash(self, node):
+        try:
+            with self.library():
+                return refpropFlash(node)
+        except rp.RefpropError as e:
+            raise RefpropEngineError(str(e)) from e
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        try:
+            with self.library():
+                return _refpropArray(in1, in2, y, mode)
+        except rp.RefpropError as e:
+            raise RefpropEngineError(str(e)) from e
+
+    def crit(self, y):
+        try:
+            with self.library():
+                return fromRefprop(rp.critp(massComposition(y).vector))
+        except rp.RefpropError as e:
+            raise RefpropEngineError(str(e)) from e
+
+    def toMole(self, y):
+        with self.library():
+            comp = massComposition(y)
+
+        return comp.x, comp.wmix
+
+    def toMass(self, x):
+        with self.library():
+            comp = moleComposition(x)
+
+        return comp.y, comp.wmix
+
+class Composition:
+    '''
+    Ammonia-water composition: mass fraction y, mole fraction x, molar mass
+    wmix [g/mol] and the composition vector REFPROP takes
+    '''
+
+    def __init__(self, y, x, wmix):
+        self.y = y
+        self.x = x
+        self.wmix = wmix
+        self.vector = [x, 1 - x]
+
+# Models only see a handful of compositions, so convert each in REFPROP once
+@functools.lru_cache(maxsize = 4096)
+def massComposition(y):
+    prop = rp.xmole([y, 1 - y])
+
+    return Composition(y, float(prop['x'][0]), prop['wmix'])
+
+@functools.lru_cache(maxsize = 4096)
+def moleComposition(x):
+    prop = rp.xmass([x, 1 - x])
+
+    return Composition(float(prop['xkg'][0]), x, prop['wmix'])
+
+class RefpropWarmStart:
+    '''
+    Flashes along a stream at constant p and y, like the profiles of a heat
+    exchanger. The bubble and dew point of the stream tell the phase of a ph
+    or ps input up front, so single phase states are found with the phase
+    specific routines, starting from the temperature and density of the
+    previous state in the same phase. Two-phase states and failures are left
+    to the general flash, see _refpropArray.
+    '''
+
+    # Newton steps on temperature before giving up on the previous state
+    maxiter = 8
+
+    def __init__(self, p, y):
+        self.p = p
+        self.y = y
+
+        comp = massComposition(y)
+
+        self.x = comp.vector
+        self.wmix = comp.wmix
+
+        # (h, s) at bubble and dew point, found on first use
+        self.band = None
+
+        # Last (t, D) found per phase, 1 = liquid, 2 = vapour
+        self.last = {}
+
+    def _band(self):
+        if self.band is None:
+            try:
+                bub = _flash('pq', self.p*100, 0, self.x)
+                dew = _flash('pq', self.p*100, 1, self.x)
+            except rp.RefpropError:
+                # Supercritical or out of range: no single phase shortcut
+                self.band = False
+            else:
+                self.band = {'h': (bub['h'], dew['h']), 's': (bub['s'], dew['s'])}
+
+        return self.band
+
+    def flash(self, var, value):
+        '''
+        Properties like _flash at h or s [J/mol], or None for two-phase
+        states and failures
+        '''
+        band = self._band()
+
+        if not band:
+            return None
+
+        lo, hi = band[var]
+
+        if value < lo:
+            kph = 1
+        elif value > hi:
+            kph = 2
+        else:
+            return None
+
+        try:
+            prop = self._singlePhase(var, value, kph)
+        except rp.RefpropError:
+            profile.count('fallbacks', 'p' + var)
+            self.last.pop(kph, None)
+            return None
+
+        self.last[kph] = (prop['t'], prop['D'])
+
+        prop['x'] = prop['xliq'] = prop['xvap'] = self.x
+        prop['q'] = 0 if kph == 1 else 1
+
+        return prop
+
+    def _singlePhase(self, var, value, kph):
+        '''
+        Single phase state at p and h or s. Newton on temperature from the
+        previous state, with tprho for the density at each step
+        '''
+        p = self.p*100 # bar > kPa
+        x = self.x
+
+        if kph in self.last:
+            t, D = self.last[kph]
+
+            fast.setx(x)
+
+            for i in range(self.maxiter):
+                D = fast.tprho(t, p, kph, D)
+                _, e, h, s, cv, cp, w, hjt = fast.therm(t, D)
+
+                # dh = cp*dT and ds = cp/T*dT at constant p
+                if var == 'h':
+                    dt = (value - h) / cp
+                else:
+                    dt = (value - s) * t / cp
+
+                if abs(dt) < 1e-8:
+                    return {'t': t, 'p': p, 'D': D, 'e': e, 'h': h, 's': s, 'cv': cv, 'cp': cp, 'w': w}
+
+                t = t + dt
+
+        # No usable previous state: phase specific flash
+        return _phaseFlash(var, p, value, x, kph)
+
+# Buffers and library symbols for the fast call path, set up once
+fast = rp.FastPath()
+
+def _flash(mode, in1, in2, x):
+    '''
+    General flash through the fast call path for the modes dna uses, other
+    modes go through rp.flsh. Returns the properties like rp.flsh
+    '''
+    fast.setx(x)
+
+    if mode == 'tp':
+        t, p = in1, in2
+        D, Dliq, Dvap, q, e, h, s, cv, cp, w = fast.tpflsh(t, p)
+    elif mode == 'ph':
+        p, h = in1, in2
+        t, D, Dliq, Dvap, q, e, s, cv, cp, w = fast.phflsh(p, h)
+    elif mode == 'ps':
+        p, s = in1, in2
+        t, D, Dliq, Dvap, q, e, h, cv, cp, w = fast.psflsh(p, s)
+    elif mode == 'pq':
+        p, q = in1, in2
+        t, D, Dliq, Dvap, e, h, s, cv, cp, w = fast.pqflsh(p, q)
+    elif mode == 'tq':
+        t, q = in1, in2
+        p, D, Dliq, Dvap, e, h, s, cv, cp, w = fast.tqflsh(t, q)
+    else:
+        return rp.flsh(mode, in1, in2, x)
+
+    if 0 < q < 1:
+        xliq, xvap = fast.xliq[:2], fast.xvap[:2]
+    else:
+        # Single phase
+        xliq = xvap = x
+
+    return {
+        't': t, 'p': p, 'D': D, 'Dliq': Dliq, 'Dvap': Dvap, 'q': q,
+        'e': e, 'h': h, 's': s, 'cv': cv, 'cp': cp, 'w': w,
+        'x': x, 'xliq': xliq, 'xvap': xvap
+    }
+
+def qmass(q, xliq, xvap):
+    '''
+    Molar quality and phase compositions to (quality, yliq, yvap) on mass basis
+    '''
+    liq = moleComposition(float(xliq[0]))
+    vap = moleComposition(float(xvap[0]))
+
+    qkg = q * vap.wmix / (q * vap.wmix + (1 - q) * liq.wmix)
+
+    return qkg, liq.y, vap.y
+
+def qmole(qkg, yliq, yvap):
+    '''
+    Mass quality and phase compositions to (quality, xliq, xvap) on mole basis
+    '''
+    liq = massComposition(yliq)
+    vap = massComposition(yvap)
+
+    q = (qkg / vap.wmix) / (qkg / vap.wmix + (1 - qkg) / liq.wmix)
+
+    return q, liq.vector, vap.vector
+
+def toRefprop(node):
+    comp = massComposition(node['y'])
+
+    prop = {'x': comp.vector, 'wmix': comp.wmix}
+
+    molWmix = comp.wmix
+
+    if 'mdot' in node:
+        prop['mdot'] = node['mdot']
+
+    if 'p' in node:
+        prop['p'] = node['p']*100 # hPa > kPa
+
+    if 'e' in node:
+        prop['e'] = node['e']*molWmix # kJ/kg > J/mol
+
+    if 'h' in node:
+        prop['h'] = node['h']*molWmix # kJ/kg*K > J/mol*K
+
+    if 'D' in node:
+        prop['D'] = node['D']/molWmix*1000 # kg/m3 > mol/L
+
+    if 's' in node:
+        prop['s'] = node['s']*molWmix # kJ/kg*K > J/mol*K
+
+    if 't' in node:
+        prop['t'] = node['t'] + 273.15 # C > K
+
+    if 'cv' in node:
+        prop['cv'] = node['cv']*molWmix # kJ/kg*K > J/mol*K
+
+    if 'cp' in node:
+        prop['cp'] = node['cp']*molWmix # kJ/kg*K > J/mol*K
+
+    if 'q' in node:
+        q = max(0, min(1, node['q']))
+        if not 'yvap' in node or not 'yliq' in node:
+            if q == 0:
+                node['yliq'] = node['y']
+                node['yvap'] = 0
+            elif q == 1:
+                node['yvap'] = node['y']
+                node['yliq'] = 0
+            else:
+                raise ValueError('Can not support this value for q')
+
+        prop['q'], prop['xliq'], prop['xvap'] = qmole(q, node['yliq'], node['yvap'])
+
+    return prop
+
+def fromRefprop(prop):
+    node = {}
+
+    comp = moleComposition(float(prop['x'][0]))
+
+    node['y'] = comp.y
+
+    molWmix = comp.wmix
+
+    if 'mdot' in prop:
+        node['mdot'] = prop['mdot']
+
+    # Convert mol to kg, K to C, kPa to hPa
+    if 'p' in prop:
+        node['p'] = prop['p']/100 # kPa > hPa
+
+    if 'pcrit' in prop:
+        node['pcrit'] = prop['pcrit']/100 # kPa > hPa
+
+    if 'e' in prop:
+        node['e'] = prop['e']/molWmix # J/mol > kJ/kg
+
+    if 'h' in prop:
+        node['h'] = prop['h']/molWmix # J/mol > kJ/kg
+
+    if 'D' in prop:
+        node['D'] = prop['D']*molWmix/1000 # mol/L > kg/m3
+
+    if 'Dcrit' in prop:
+        node['Dcrit'] = prop['Dcrit']*molWmix/1000 # mol/L > kg/m3
+
+    if 's' in prop:
+        node['s'] = prop['s']/molWmix # J/mol*K > kJ/kg*K
+
+    if 't' in prop:
+        node['t'] = prop['t'] - 273.15 # K > C
+
+    if 'tcrit' in prop:
+        node['tcrit'] = prop['tcrit'] - 273.15 # K > C
+
+    if 'cv' in prop:
+        node['cv'] = prop['cv']/molWmix # J/mol*K > kJ/kg*K
+
+    if 'cp' in prop:
+        node['cp'] = prop['cp']/molWmix # J/mol*K > kJ/kg*K
+
+    if 'q' in prop and 'xvap' in prop and 'xliq' in prop:
+        node['q'], node['yliq'], node['yvap'] = qmass(max(0, min(1, prop['q'])), prop['xliq'], prop['xvap'])
+
+    return node
+
+def _phaseFlash(var, p, value, x, kph):
+    '''
+    Single phase flash at p [kPa] and h or s with a known phase, 1 = liquid
+    and 2 = vapour. Returns the properties like flsh does
+    '''
+    prop = rp.flsh1('p' + var, p, value, x, kph = kph)
+
+    t, D = prop['t'], prop['D']
+
+    prop = rp.therm(t, D, x)
+    prop.update(t = t, p = p, D = D, x = x, xliq = x, xvap = x, q = 0 if kph == 1 else 1)
+
+    return prop
+
+def _PHtwoPhase(_node, tol = 1e-6, maxiter = 50):
+    '''
+    Two-phase ph flash for when the general flash fails. Temperature is
+    bracketed by the bubble and dew point at p and y, and h(T) is solved with
+    Illinois on tp flashes. Returns the properties and the number of
+    iterations
+    '''
+    p = _node['p']
+    h = _node['h']
+    x = _node['x']
+
+    bub = _flash('pq', p, 0, x)
+    dew = _flash('pq', p, 1, x)
+
+    # Just outside the band the phase is known, so no general flash needed
+    if h < bub['h']:
+        return _phaseFlash('h', p, h, x, 1), 0
+    elif h > dew['h']:
+        return _phaseFlash('h', p, h, x, 2), 0
+
+    a, fa = bub['t'], bub['h'] - h
+    b, fb = dew['t'], dew['h'] - h
+    prop = bub if abs(fa) < abs(fb) else dew
+
+    for i in range(1, maxiter + 1):
+        if abs(prop['h'] - h) <= tol * max(1, abs(h)) or abs(b - a) <= 1e-9:
+            return prop, i - 1
+
+        c = b - fb * (b - a) / (fb - fa)
+
+        prop = _flash('tp', c, p, x)
+        fc = prop['h'] - h
+
+        # Illinois: halve the value at the end that stays, to keep it moving
+        if fc * fb < 0:
+            a, fa = b, fb
+        else:
+            fa = fa / 2
+
+        b, fb = c, fc
+
+    raise RefpropEngineError('No two-phase state found for h = {:.6g} J/mol in {} iterations'.format(h, maxiter))
+
+def refpropFlash(node):
+    '''
+    Flash the inputs of node in refprop. Returns the properties in dna units
+    '''
+
+    mode = flashMode(node)
+
+    if mode is None:
+        print(toRefprop(node))
+        raise InputError('state','Missing inputs for above node')
+
+    mode, in1, in2 = mode
+
+    # Convert input to refprop notation:
+    _node = toRefprop(node)
+
+    in1 = _node[in1]
+    in2 = _node[in2]
+
+    try:
+        # Calculate
+        prop = _flash(mode, in1, in2, _node['x'])
+    except rp.RefpropError as e:
+        profile.count('fallbacks', mode)
+
+        # Normal flsh failed, try flsh2 as well
+        try:
+            if mode == 'ph':
+                # Most likely in the 2-phase region, where h(T) is flat
+                prop, iterations = _PHtwoPhase(_node)
+                profile.count('workaround', iterations)
+            elif mode == 'tp':
+                propl = rp.flsh('tp', _node['t'] - 0.1, _node['p'], _node['x'])
+                propr = rp.flsh('tp', _node['t'] + 0.1, _node['p'], _node['x'])
+                h = (propl['h'] + propr['h']) / 2
+
+                prop = rp.flsh('ph', _node['p'], h, _node['x'])
+                print('Workaround for iteration, temperature difference {:.2e} J/mol*K'.format(in1 - _node['t']))
+            else:
+                print(node)
+                print(mode)
+                print(in1)
+                print(in2)
+                raise(e)
+
+        except Exception as e:
+            print(node)
+            raise(e)
+
+    # Convert back from refprop notation
+    return fromRefprop(prop)
+
+def refpropState(node):
+    '''
+    If the state is to be found from refprop, use this method
+    '''
+    node.update(refpropFlash(node))
+
+    return node
+
+def _refpropArray(in1, in2, y, mode):
+    '''
+    Flash arrays of states in REFPROP. Every unique input is flashed once,
+    single phase states along a stream from the previous one.
+    Qualities in between 0 and 1 are not supported: REFPROP takes a molar
+    quality, and converting a mass quality needs the phase compositions,
+    see toRefprop.
+    '''
+    n = len(in1)
+    result = dict((k, np.empty(n)) for k in ['t', 'p', 'h', 's', 'q', 'D', 'e', 'cp', 'y', 'yliq', 'yvap'])
+
+    if n == 0:
+        return result
+
+    if 'q' in mode:
+        q = np.asarray(in1 if mode[0] == 'q' else in2)
+
+        if np.any((q > 0) & (q < 1)):
+            raise InputError('states_array', 'Two-phase qualities need the phase compositions, use state() instead')
+
+    unique, inverse = np.unique(np.column_stack((in1, in2, y)), axis = 0, return_inverse = True)
+    inverse = inverse.reshape(-1)
+
+    # Units dna > refprop, per input
+    scale = {'p': (100, 0), 't': (1, 273.15), 'q': (1, 0)}
+
+    out = np.empty((len(unique), len(result)))
+    keys = list(result.keys())
+
+    # Warm starts for series of states at the same p and y, like profiles.
+    # Rows are sorted, so each series runs through h or s in order.
+    paths = {}
+
+    if mode in ('ph', 'ps'):
+        streams, counts = np.unique(unique[:, [0, 2]], axis = 0, return_counts = True)
+
+        # Finding the bubble and dew point only pays off for a few states
+        paths = dict((tuple(k), None) for k, c in zip(streams, counts) if c > 2)
+
+    for i, (a, b, _y) in enumerate(unique):
+        comp = massComposition(float(_y))
+
+        x = comp.vector
+        molWmix = comp.wmix
+
+        # Energies are per mol in refprop
+        _a = a * molWmix if mode[0] in 'hse' else a * scale[mode[0]][0] + scale[mode[0]][1]
+        _b = b * molWmix if mode[1] in 'hse' else b * scale[mode[1]][0] + scale[mode[1]][1]
+
+        prop = None
+
+        if (a, _y) in paths:
+            if paths[(a, _y)] is None:
+                paths[(a, _y)] = RefpropWarmStart(float(a), float(_y))
+
+            prop = paths[(a, _y)].flash(mode[1], _b)
+
+        try:
+            if prop is None:
+                prop = _flash(mode, _a, _b, x)
+        except rp.RefpropError:
+            # Take the slow path with all workarounds
+            node = {mode[0]: float(a), mode[1]: float(b), 'y': float(_y)}
+            refpropState(node)
+            out[i] = [node[k] for k in keys]
+            continue
+
+        q = max(0, min(1, prop['q']))
+
+        if 0 < q < 1:
+            q, yliq, yvap = qmass(q, prop['xliq'], prop['xvap'])
+        else:
+            # Single phase: both phase compositions equal the bulk
+            yvap = yliq = _y
+
+        out[i] = [
+            prop['t'] - 273.15,
+            prop['p'] / 100,
+            prop['h'] / molWmix,
+            prop['s'] / molWmix,
+            q,
+            prop['D'] * molWmix / 1000,
+            prop['e'] / molWmix,
+            prop['cp'] / molWmix,
+            _y,
+            yliq,
+            yvap
+        ]
+
+    for j, k in enumerate(keys):
+        result[k] = out[inverse, j]
+
+    return result
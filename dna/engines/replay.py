@@ -0,0 +1,226 @@
+'''
+Record the property requests of a run and serve them again later, so a model
+can run without the engine it was recorded with (and without REFPROP):
+
+    with recording('output/m3.rec'):
+        IterateModel(MyModel, cond).run()
+
+    with replaying('output/m3.rec'):
+        IterateModel(MyModel, cond).run()
+'''
+
+import contextlib
+import pickle
+
+import numpy as np
+
+from dna.engine import Engine, EngineError, flashMode
+
+class RecordingEngine(Engine):
+    '''
+    Passes everything on to engine, and appends each request with its result
+    to the file at path
+    '''
+
+    def __init__(self, engine, path):
+        self.engine = engine
+        self.name = engine.name
+        self.cacheable = engine.cacheable
+        self.file = open(path, 'wb')
+
+        self.write(('engine', engine.name, engine.fingerprint()))
+
+    def write(self, record):
+        pickle.dump(record, self.file, protocol = pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.file.close()
+
+    def fingerprint(self):
+        return self.engine.fingerprint()
+
+    def flash(self, node):
+        result = self.engine.flash(node)
+
+        self.write(('flash', requestKey(node), result))
+
+        return result
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        result = self.engine.stateArray(in1, in2, y, mode = mode, media = media)
+
+        self.write(('array', mode, np.array(in1, dtype = float), np.array(in2, dtype = float),
+            np.array(y, dtype = float), dict((k, np.array(v)) for k, v in result.items())))
+
+        return result
+
+    def call(self, method, *args):
+        result = getattr(self.engine, method)(*args)
+
+        self.write(('call', method, args, result))
+
+        return result
+
+    def crit(self, y):
+        return self.call('crit', y)
+
+    def toMole(self, y):
+        return self.call('toMole', y)
+
+    def toMass(self, x):
+        return self.call('toMass', x)
+
+class ReplayEngine(Engine):
+    '''
+    Serves the results of a recording. Requests are matched exactly, so a run
+    with the same inputs reproduces the recorded one bit for bit. With strict
+    off, a state missing from the recording gets the recorded state with the
+    nearest inputs of the same mode instead, if it is within tol (relative to
+    the spread of the recorded inputs).
+    '''
+
+    def __init__(self, path, strict = True, tol = 1e-3):
+        self.strict = strict
+        self.tol = tol
+        self.states = {}
+        self.calls = {}
+        self._nearest = {}
+
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+
+                kind = record[0]
+
+                if kind == 'engine':
+                    self.name, self.recorded = record[1:]
+                elif kind == 'flash':
+                    self.states[record[1]] = record[2]
+                elif kind == 'array':
+                    self._addArray(*record[1:])
+                elif kind == 'call':
+                    self.calls[record[1:3]] = record[3]
+
+    def _addArray(self, mode, in1, in2, y, result):
+        in1, in2, y = np.broadcast_arrays(in1, in2, y)
+
+        for i in range(in1.size):
+            key = (mode, float(in1.flat[i]), float(in2.flat[i]), float(y.flat[i]))
+            self.states.setdefault(key, dict((k, float(v.flat[i])) for k, v in result.items()))
+
+    def fingerprint(self):
+        return self.recorded
+
+    def lookup(self, key):
+        if key in self.states:
+            return self.states[key]
+
+        # Arrays are recorded without phase compositions
+        if key[:4] in self.states:
+            return self.states[key[:4]]
+
+        if self.strict:
+            raise EngineError('State {} is not in the recording'.format(key))
+
+        return self.nearest(key)
+
+    def nearest(self, key):
+        mode = key[0]
+
+        if not mode in self._nearest:
+            keys = [k for k in self.states if k[0] == mode]
+
+            if not keys:
+                raise EngineError('No {} states in the recording'.format(mode))
+
+            inputs = np.array([k[1:4] for k in keys])
+            scale = np.ptp(inputs, axis = 0)
+            scale[scale == 0] = 1
+
+            self._nearest[mode] = (keys, inputs, scale)
+
+        keys, inputs, scale = self._nearest[mode]
+
+        distance = np.abs((inputs - key[1:4]) / scale).max(axis = 1)
+        i = np.argmin(distance)
+
+        if distance[i] > self.tol:
+            raise EngineError('No state near {} in the recording'.format(key))
+
+        return self.states[keys[i]]
+
+    def flash(self, node):
+        return dict(self.lookup(requestKey(node)))
+
+    def stateArray(self, in1, in2, y, mode = 'ph', media = None):
+        in1, in2, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (in1, in2, y)])
+
+        found = [self.lookup((mode, float(a), float(b), float(c))) for a, b, c in zip(in1.flat, in2.flat, y.flat)]
+
+        if not found:
+            return {}
+
+        return dict((k, np.array([f.get(k, np.nan) for f in found]).reshape(in1.shape)) for k in found[0])
+
+    def call(self, method, *args):
+        if not (method, args) in self.calls:
+            raise EngineError('{}{} is not in the recording'.format(method, args))
+
+        return self.calls[(method, args)]
+
+    def crit(self, y):
+        return self.call('crit', y)
+
+    def toMole(self, y):
+        return self.call('toMole', y)
+
+    def toMass(self, x):
+        return self.call('toMass', x)
+
+def requestKey(node):
+    '''
+    The inputs of a flash: mode, both inputs and y, plus the phase compositions
+    for two-phase quality inputs
+    '''
+    mode = flashMode(node)
+
+    if mode is None:
+        raise EngineError('Missing inputs for node {}'.format(node))
+
+    mode, in1, in2 = mode
+    key = (mode, float(node[in1]), float(node[in2]), float(node['y']))
+
+    if 'q' in mode and 0 < node['q'] < 1 and 'yliq' in node and 'yvap' in node:
+        key = key + (float(node['yliq']), float(node['yvap']))
+
+    return key
+
+@contextlib.contextmanager
+def recording(path, media = None):
+    '''
+    Record the requests to the engine of media (the default engine if None)
+    within a block of code
+    '''
+    from dna import states
+
+    recorder = RecordingEngine(states.engineFor({'media': media}), path)
+
+    try:
+        with states.useEngine(recorder, *((media,) if media else ())):
+            yield recorder
+    finally:
+        recorder.close()
+
+@contextlib.contextmanager
+def replaying(path, media = None, strict = True, tol = 1e-3):
+    '''
+    Serve the requests to the engine of media from a recording within a block
+    of code
+    '''
+    from dna import states
+
+    with states.useEngine(ReplayEngine(path, strict = strict, tol = tol), *((media,) if media else ())) as engine:
+        yield engine
@@ -0,0 +1,606 @@
+import itertools
+
+import numpy as np
+import scipy.interpolate
+import scipy.ndimage
+
+from dna import states
+from dna.engine import EngineError
+
+class TableError(Exception):
+    pass
+
+class PropertyTable:
+    '''
+    Precomputed property table for the ammonia-water (REFPROP) media, over a
+    regular grid of the two flash inputs and the ammonia mass fraction y.
+
+    Supported modes:
+        'ph' - pressure [bar], enthalpy [kJ/kg]
+        'tp' - temperature [C], pressure [bar]
+
+    Interpolation methods:
+        'ttse'  - second order Taylor series expansion around the nearest grid
+                  node in the (in1, in2) plane, linear in y
+        'cubic' - cubic spline interpolation in all three directions
+
+    Every grid cell carries an error estimate of the method for the interpolated
+    thermal variable (t for 'ph', h for 'tp'). Cells that cross a phase boundary
+    or contain failed flashes have an infinite estimate. Lookups in cells whose
+    estimate exceeds maxerr are refused, so state() falls back to the exact flash.
+
+    Tables carry the fingerprint of the engine that filled them. state() only
+    uses a table under an engine of the same fingerprint, as engines differ in
+    their reference states.
+    '''
+
+    props = ['t', 'h', 's', 'q', 'D', 'e', 'cp', 'yliq', 'yvap']
+
+    # Margin on the error estimate
+    safety = 1.5
+
+    modes = {
+        'ph': ('p', 'h', 't'),
+        'tp': ('t', 'p', 'h')
+    }
+
+    def __init__(self, mode, in1, in2, y, data, method = 'ttse', maxerr = 0.05, fingerprint = None):
+        if not mode in self.modes:
+            raise TableError('Unsupported table mode ' + str(mode))
+
+        self.mode = mode
+        self.in1, self.in2, self.out = self.modes[mode]
+
+        self.axes = [self._axis(in1), self._axis(in2), self._axis(y)]
+        self.data = dict((k, np.asarray(data[k], dtype = float)) for k in self.props if k in data)
+
+        self.method = method
+        self.maxerr = maxerr
+        self.fingerprint = fingerprint
+
+        self.prepare()
+
+    @staticmethod
+    def _axis(values):
+        values = np.asarray(values, dtype = float)
+
+        if len(values) < 3:
+            raise TableError('Need at least 3 points per table axis')
+
+        step = values[1] - values[0]
+
+        if not np.allclose(np.diff(values), step):
+            raise TableError('Table axes have to be uniformly spaced')
+
+        return (values[0], step, len(values))
+
+    def values(self, axis):
+        start, step, n = self.axes[axis]
+        return start + step * np.arange(n)
+
+    @classmethod
+    def build(cls, mode, in1, in2, y, engine = None, **kwargs):
+        '''
+        Fill a table with exact flashes of engine, by default the engine for
+        ammonia-water. Failed flashes are stored as NaN and will always fall
+        back to the exact flash.
+        '''
+        if engine is None:
+            engine = states.engineFor({})
+
+        _in1, _in2, _ = cls.modes[mode]
+
+        shape = (len(in1), len(in2), len(y))
+        data = dict((k, np.full(shape, np.nan)) for k in cls.props)
+
+        failed = 0
+
+        for k, _y in enumerate(y):
+            for i, _a in enumerate(in1):
+                for j, _b in enumerate(in2):
+                    node = {_in1: float(_a), _in2: float(_b), 'y': float(_y)}
+
+                    try:
+                        engine.state(node)
+                    except (EngineError, RuntimeError) as e:
+                        failed = failed + 1
+                        continue
+
+                    for prop in cls.props:
+                        if prop in node:
+                            data[prop][i, j, k] = node[prop]
+
+        # Drop properties the flash does not return
+        data = dict((k, v) for k, v in data.items() if not np.isnan(v).all())
+
+        print('Built {} table with {:d} points, {:d} failed'.format(mode, np.prod(shape), failed))
+
+        return cls(mode, in1, in2, y, data, fingerprint = states.fingerprint(engine), **kwargs)
+
+    def save(self, filename):
+        data = dict(self.data)
+
+        if self.fingerprint is not None:
+            data['fingerprint'] = self.fingerprint
+
+        np.savez_compressed(filename, mode = self.mode, in1 = self.values(0),
+            in2 = self.values(1), y = self.values(2), **data)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        with np.load(filename) as f:
+            data = dict((k, f[k]) for k in cls.props if k in f)
+
+            # Tables saved without one are never used by state()
+            fingerprint = str(f['fingerprint']) if 'fingerprint' in f else None
+
+            return cls(str(f['mode']), f['in1'], f['in2'], f['y'], data, fingerprint = fingerprint, **kwargs)
+
+    def matches(self, engine):
+        '''
+        Whether the table was filled by an engine of the same setup as engine
+        '''
+        return self.fingerprint is not None and self.fingerprint == states.fingerprint(engine)
+
+    def prepare(self):
+        '''
+        Precompute derivatives, spline coefficients and the error estimate per cell
+        '''
+        d1 = self.axes[0][1]
+        d2 = self.axes[1][1]
+
+        self.deriv = {}
+        self.coeffs = {}
+
+        for prop, f in self.data.items():
+            f1, f2 = np.gradient(f, d1, d2, axis = (0, 1))
+            f11 = np.gradient(f1, d1, axis = 0)
+            f22 = np.gradient(f2, d2, axis = 1)
+            f12 = np.gradient(f1, d2, axis = 1)
+
+            self.deriv[prop] = (f1, f2, f11, f22, f12)
+
+            if self.method == 'cubic':
+                self.coeffs[prop] = scipy.ndimage.spline_filter(_fillnan(f), order = 3)
+
+        self.err = self.estimateError()
+
+    def estimateError(self):
+        '''
+        Error estimate per cell, shape (n1-1, n2-1, ny-1), of the method of the
+        table. For cubic splines it is the TTSE estimate plus the largest
+        difference between both methods at the centre and 8 inner points of the
+        cell (at 0.2 and 0.8 of each step), times safety. The difference
+        catches the spline overshooting near phase boundaries and at the edges
+        of the grid, where it converges no faster than TTSE.
+        '''
+        err = self._ttseError()
+
+        if self.method == 'cubic':
+            out = self.out
+            idx = np.indices(err.shape, dtype = float)
+            cell = list(np.indices(err.shape))
+            diff = np.zeros(err.shape)
+
+            for point in [(0.5, 0.5, 0.5)] + list(itertools.product((0.2, 0.8), repeat = 3)):
+                u = [i + x for i, x in zip(idx, point)]
+                diff = np.fmax(diff, np.abs(self._cubic(u, [out])[out] - self._ttse(u, cell, [out])[out]))
+
+            err = err + self.safety * diff
+
+        # Cells crossing a phase boundary, also between slices of y: liquid
+        # (q <= 0), two-phase, vapour (q >= 1)
+        if 'q' in self.data:
+            n1, n2, ny = self.data['q'].shape
+            phase = np.where(self.data['q'] <= 0, 0, np.where(self.data['q'] >= 1, 2, 1))
+            cells = [phase[s1:s1 + n1 - 1, s2:s2 + n2 - 1, s3:s3 + ny - 1] for s1 in (0, 1) for s2 in (0, 1) for s3 in (0, 1)]
+            mixed = np.max(cells, axis = 0) != np.min(cells, axis = 0)
+            err = np.where(mixed, np.inf, err)
+
+        return err
+
+    def _ttseError(self):
+        '''
+        TTSE error estimate per cell, as the sum of:
+        - the error of the Taylor expansions of the cell corners: the larger of
+          their spread at the cell centre and a quarter of their error at the
+          neighbouring nodes, where the exact value is known (a lookup is at
+          most half a step from its node, where the third order remainder is an
+          eighth of that)
+        - linear interpolation error in y from the second difference along y
+        times safety, since both terms are estimates from the grid itself.
+        Against exact flashes the actual error stays below 0.85 times the
+        estimate for the ammonia-water tables tested.
+        '''
+        f = self.data[self.out]
+        f1, f2, f11, f22, f12 = self.deriv[self.out]
+
+        n1, n2, ny = f.shape
+        d1 = self.axes[0][1]
+        d2 = self.axes[1][1]
+
+        def expand(sl, dx, dy):
+            return f[sl] + f1[sl]*dx + f2[sl]*dy + 0.5*f11[sl]*dx**2 + 0.5*f22[sl]*dy**2 + f12[sl]*dx*dy
+
+        corners = []
+
+        for s1, s2, c1, c2 in [(0, 0, 1, 1), (1, 0, -1, 1), (0, 1, 1, -1), (1, 1, -1, -1)]:
+            sl = (slice(s1, s1 + n1 - 1), slice(s2, s2 + n2 - 1))
+            corners.append(expand(sl, c1 * d1 / 2, c2 * d2 / 2))
+
+        spread = np.ptp(np.array(corners), axis = 0)
+
+        # Expansion of every node to its eight neighbours
+        errnode = np.zeros(f.shape)
+
+        for s1 in (-1, 0, 1):
+            for s2 in (-1, 0, 1):
+                if s1 == 0 and s2 == 0:
+                    continue
+
+                node = (slice(max(0, -s1), n1 - max(0, s1)), slice(max(0, -s2), n2 - max(0, s2)))
+                neighbour = (slice(max(0, s1), n1 - max(0, -s1)), slice(max(0, s2), n2 - max(0, -s2)))
+
+                errnode[node] = np.fmax(errnode[node], np.abs(expand(node, s1 * d1, s2 * d2) - f[neighbour]))
+
+        err2d = np.maximum(spread, _corners(errnode) / 4)
+        err2d = np.where(np.isnan(err2d), np.inf, err2d)
+
+        # Second difference along y, reused for both slices around a node
+        erry = np.zeros(f.shape)
+        erry[:, :, 1:-1] = np.abs(f[:, :, 2:] - 2*f[:, :, 1:-1] + f[:, :, :-2]) / 8
+        # Extrapolate to the edges, as the curvature may keep growing
+        erry[:, :, 0] = np.maximum(erry[:, :, 1], 2*erry[:, :, 1] - erry[:, :, 2])
+        erry[:, :, -1] = np.maximum(erry[:, :, -2], 2*erry[:, :, -2] - erry[:, :, -3])
+        erry = np.where(np.isnan(erry), np.inf, erry)
+        erry = _corners(erry)
+
+        return self.safety * (np.maximum(err2d[:, :, :-1], err2d[:, :, 1:]) + np.maximum(erry[:, :, :-1], erry[:, :, 1:]))
+
+    def lookupArray(self, in1, in2, y):
+        '''
+        Interpolate the table for arrays of inputs. Returns (result, ok) where result
+        is a dict of property arrays and ok marks entries within the error bound.
+        '''
+        in1, in2, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (in1, in2, y)])
+
+        # Fractional grid indices
+        u = [(v - start) / step for v, (start, step, n) in zip((in1, in2, y), self.axes)]
+
+        ok = np.ones(in1.shape, dtype = bool)
+        for ui, (start, step, n) in zip(u, self.axes):
+            ok &= (ui >= 0) & (ui <= n - 1)
+
+        # Cell indices, clipped so out-of-range input can still be evaluated
+        cell = [np.clip(np.floor(ui).astype(int), 0, n - 2) for ui, (start, step, n) in zip(u, self.axes)]
+
+        ok &= self.err[cell[0], cell[1], cell[2]] <= self.maxerr
+
+        result = {self.in1: in1, self.in2: in2, 'y': y}
+        props = [prop for prop in self.data if not prop in result]
+
+        if self.method == 'cubic':
+            result.update(self._cubic(u, props))
+        else:
+            result.update(self._ttse(u, cell, props))
+
+        return result, ok
+
+    def _cubic(self, u, props):
+        '''
+        Cubic spline interpolation of props at fractional grid indices u
+        '''
+        shape = u[0].shape
+        coords = np.array([np.clip(ui, 0, n - 1) for ui, (start, step, n) in zip(u, self.axes)])
+
+        return dict((prop, scipy.ndimage.map_coordinates(self.coeffs[prop], coords.reshape(3, -1), order = 3,
+            prefilter = False, mode = 'nearest').reshape(shape)) for prop in props)
+
+    def _ttse(self, u, cell, props):
+        '''
+        TTSE of props at fractional grid indices u: around the nearest node in
+        the (in1, in2) plane, linear in y between the slices of cell
+        '''
+        i = np.clip(np.rint(u[0]).astype(int), 0, self.axes[0][2] - 1)
+        j = np.clip(np.rint(u[1]).astype(int), 0, self.axes[1][2] - 1)
+        k = cell[2]
+        wy = np.clip(u[2] - k, 0, 1)
+
+        dx = (u[0] - i) * self.axes[0][1]
+        dy = (u[1] - j) * self.axes[1][1]
+
+        result = {}
+
+        for prop in props:
+            f = self.data[prop]
+            f1, f2, f11, f22, f12 = self.deriv[prop]
+            value = []
+
+            for _k in (k, k + 1):
+                idx = (i, j, _k)
+                value.append(f[idx] + f1[idx]*dx + f2[idx]*dy + 0.5*f11[idx]*dx**2 + 0.5*f22[idx]*dy**2 + f12[idx]*dx*dy)
+
+            result[prop] = (1 - wy) * value[0] + wy * value[1]
+
+        return result
+
+    def lookup(self, node):
+        '''
+        Find the state of a single node from the table. Returns False if the node
+        has to be flashed exactly instead.
+        '''
+        mode = states.flashMode(node)
+
+        if mode is None or mode[0] != self.mode:
+            return False
+
+        result, ok = self.lookupArray(node[self.in1], node[self.in2], node['y'])
+
+        if not ok:
+            return False
+
+        for prop in self.props:
+            if prop in result and prop != self.in1 and prop != self.in2:
+                node[prop] = float(result[prop])
+
+        return node
+
+class SaturationTable:
+    '''
+    Bubble and dew curves of ammonia-water over a grid of pressure and the
+    ammonia mass fraction y.
+
+    Along pressure both curves are monotone, so every grid line of y holds PCHIP
+    splines of t(ln p) and of its inverse ln p(t). Between grid lines of y the
+    interpolation is linear. Its error is estimated at each lookup, from the
+    second differences along y of the curves at the lookup point. To that is
+    added the spline error of the cell, which is the difference with a cubic
+    spline at the cell midpoint. For pressures, that spline error is converted
+    with d(ln p)/dt. Temperatures are refused when the estimate exceeds maxerr
+    [K]. Pressures are refused when it exceeds maxrel, the relative pressure
+    error. Refused lookups give NaN, and so do lookups outside the grid or
+    beyond failed flashes (near the critical point). The caller can then
+    flash exactly instead.
+
+    The error along y falls with the square of the step, so the grid density
+    decides how much the table serves. For ammonia-water over y = 0.3-0.9 and
+    1-100 bar on 41 log-spaced pressures:
+    - a y step of 0.05 serves almost nothing;
+    - a y step of 0.025 serves about 90% of bubble and 75% of dew
+      temperatures, and half of the pressures;
+    - a y step of 0.01 serves nearly all of them.
+    build() prints the share of cells the table serves.
+    '''
+
+    kinds = {'bub': 0, 'dew': 1}
+
+    # Margin on the error estimates
+    safety = 1.5
+
+    def __init__(self, p, y, tbub, tdew, maxerr = 0.05, maxrel = 1e-3):
+        self.p = np.asarray(p, dtype = float)
+        self.y = np.asarray(y, dtype = float)
+
+        if len(self.p) < 3 or len(self.y) < 3:
+            raise TableError('Need at least 3 points per table axis')
+
+        if np.any(np.diff(self.p) <= 0) or np.any(np.diff(self.y) <= 0):
+            raise TableError('Table axes have to be increasing')
+
+        self.data = {
+            'bub': np.asarray(tbub, dtype = float),
+            'dew': np.asarray(tdew, dtype = float)
+        }
+
+        self.maxerr = maxerr
+        self.maxrel = maxrel
+
+        self.prepare()
+
+    @classmethod
+    def build(cls, p, y, engine = None, **kwargs):
+        '''
+        Flash the bubble and dew points for all combinations of p and y with
+        engine, by default the engine for ammonia-water
+        '''
+        if engine is None:
+            engine = states.engineFor({})
+
+        p = np.asarray(p, dtype = float)
+
+        data = {}
+        failed = 0
+
+        for kind, q in cls.kinds.items():
+            data[kind] = np.full((len(p), len(y)), np.nan)
+
+            for j, _y in enumerate(y):
+                try:
+                    data[kind][:, j] = engine.stateArray(p, np.full(len(p), q), np.full(len(p), _y), mode = 'pq')['t']
+                    continue
+                except (EngineError, RuntimeError) as e:
+                    pass
+
+                # Flash point by point to find out which ones fail
+                for i, _p in enumerate(p):
+                    try:
+                        data[kind][i, j] = engine.state({'p': float(_p), 'q': q, 'y': float(_y)})['t']
+                    except (EngineError, RuntimeError) as e:
+                        failed = failed + 1
+
+        table = cls(p, y, data['bub'], data['dew'], **kwargs)
+
+        # Try the cell centres to report the coverage
+        pc = np.sqrt(p[:-1] * p[1:])[:, None]
+        yc = (np.asarray(y[:-1]) + np.asarray(y[1:]))[None, :] / 2
+        served = np.mean([~np.isnan(table.temperature(kind, pc, yc)) for kind in cls.kinds])
+
+        print('Built saturation table with {:d} points, {:d} failed, {:.0%} of the cells within maxerr'.format(
+            2 * len(p) * len(y), failed, served))
+
+        return table
+
+    def save(self, filename):
+        np.savez_compressed(filename, p = self.p, y = self.y, tbub = self.data['bub'], tdew = self.data['dew'])
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        with np.load(filename) as f:
+            return cls(f['p'], f['y'], f['tbub'], f['tdew'], **kwargs)
+
+    def prepare(self):
+        '''
+        Fit the splines per grid line of y, and find their error per cell,
+        shape (np-1, ny-1), and d(ln p)/dt to convert it to pressure
+        '''
+        lnp = np.log(self.p)
+        mid = (lnp[:-1] + lnp[1:]) / 2
+
+        self.forward = {}
+        self.inverse = {}
+        self.err = {}
+        self.slope = {}
+
+        for kind, t in self.data.items():
+            self.forward[kind] = []
+            self.inverse[kind] = []
+
+            # Spline error at the cell midpoints along pressure
+            errp = np.full((len(self.p) - 1, len(self.y)), np.inf)
+
+            for j in range(len(self.y)):
+                valid = ~np.isnan(t[:, j])
+
+                # Keep the monotone part, the inverse needs increasing t
+                valid &= np.concatenate(([True], np.diff(np.fmax.accumulate(t[:, j])) > 0))
+
+                if valid.sum() < 2:
+                    self.forward[kind].append(None)
+                    self.inverse[kind].append(None)
+                    continue
+
+                forward = scipy.interpolate.PchipInterpolator(lnp[valid], t[valid, j], extrapolate = False)
+
+                self.forward[kind].append(forward)
+                self.inverse[kind].append(scipy.interpolate.PchipInterpolator(t[valid, j], lnp[valid], extrapolate = False))
+
+                if valid.sum() > 3:
+                    cubic = scipy.interpolate.CubicSpline(lnp[valid], t[valid, j], extrapolate = False)
+                    cells = valid[:-1] & valid[1:]
+                    errp[cells, j] = np.abs(forward(mid[cells]) - cubic(mid[cells]))
+
+            self.err[kind] = np.maximum(errp[:, :-1], errp[:, 1:])
+
+            slope = np.abs(np.diff(lnp)[:, None] / np.diff(t, axis = 0))
+            slope = np.where(np.isnan(slope), np.inf, slope)
+            self.slope[kind] = np.maximum(slope[:, :-1], slope[:, 1:])
+
+    def temperature(self, kind, p, y):
+        '''
+        Bubble ('bub') or dew ('dew') temperature [C] at pressure p [bar]
+        '''
+        lnp, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (np.log(p), y)])
+
+        result, erry, j = self._lookup(self.forward[kind], lnp, y)
+
+        err = self.safety * (erry + self._cellError(kind, lnp, j))
+        result[~(err <= self.maxerr)] = np.nan
+
+        return result
+
+    def pressure(self, kind, t, y):
+        '''
+        Bubble ('bub') or dew ('dew') pressure [bar] at temperature t [C]
+        '''
+        t, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (t, y)])
+
+        lnp, erry, j = self._lookup(self.inverse[kind], t, y)
+
+        # Error in ln p, which is the relative pressure error
+        err = self.safety * (erry + self._cellError(kind, lnp, j, self.slope[kind]))
+        lnp[~(err <= self.maxrel)] = np.nan
+
+        return np.exp(lnp)
+
+    def _lookup(self, curves, x, y):
+        '''
+        Interpolate linearly in y between the curves of the grid lines around
+        y. Returns the result, its interpolation error from the second
+        difference along y of the curves at x, and the cell index in y.
+        '''
+        result = np.full(x.shape, np.nan)
+        err = np.full(x.shape, np.inf)
+
+        ny = len(self.y)
+
+        j = np.clip(np.searchsorted(self.y, y, side = 'right') - 1, 0, ny - 2)
+        w = (y - self.y[j]) / (self.y[j + 1] - self.y[j])
+
+        inside = (y >= self.y[0]) & (y <= self.y[-1])
+
+        for _j in np.unique(j[inside]):
+            m = inside & (j == _j)
+
+            # Lines for the second differences at the lines of the cell and
+            # their neighbours, as a single one may pass through zero.
+            # Shifted inwards at the edges of the grid
+            lines = range(max(_j - 2, 0), min(_j + 4, ny))
+
+            if any(curves[k] is None for k in lines):
+                continue
+
+            values = dict((k, curves[k](x[m])) for k in lines)
+
+            result[m] = (1 - w[m]) * values[_j] + w[m] * values[_j + 1]
+
+            diff2 = []
+
+            for k in range(_j - 1, _j + 3):
+                k = min(max(k, 1), ny - 2)
+
+                if k in values and k - 1 in values and k + 1 in values:
+                    diff2.append(np.abs(values[k + 1] - 2*values[k] + values[k - 1]) / 8)
+
+            if diff2:
+                err[m] = np.max(diff2, axis = 0)
+
+        err = np.where(np.isnan(err), np.inf, err)
+
+        return result, err, j
+
+    def _cellError(self, kind, lnp, j, scale = None):
+        '''
+        Spline error estimate of the cell at ln p and y cell j, times scale of
+        that cell if given. Infinite where ln p is unknown.
+        '''
+        err = np.full(lnp.shape, np.inf)
+        known = ~np.isnan(lnp)
+
+        i = np.clip(np.searchsorted(self.p, np.exp(lnp[known]), side = 'right') - 1, 0, len(self.p) - 2)
+
+        err[known] = self.err[kind][i, j[known]]
+
+        if scale is not None:
+            err[known] = err[known] * scale[i, j[known]]
+
+        return err
+
+def _corners(f):
+    '''
+    Maximum of f over the four corners of each cell in the (in1, in2) plane
+    '''
+    return np.maximum.reduce([f[:-1, :-1], f[1:, :-1], f[:-1, 1:], f[1:, 1:]])
+
+def _fillnan(f):
+    '''
+    Replace NaN entries by their nearest valid neighbour, so spline
+    prefiltering does not spread them over the whole table
+    '''
+    invalid = np.isnan(f)
+
+    if not invalid.any():
+        return f
+
+    idx = scipy.ndimage.distance_transform_edt(invalid, return_distances = False, return_indices = True)
+
+    return f[tuple(idx)]
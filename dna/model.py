@@ -1,7 +1,9 @@
 import csv
 
 from dna.iterate import IterateParamHelper
-from dna.vendor import refprop as rp
+from dna.engine import EngineError
+from dna.profile import profile
+from dna.states import useEngine
 
 def is_number(s):
     try:
@@ -36,6 +38,16 @@ class DnaModel:
 
         return self
 
+    def exergyDestruction(self):
+        '''
+        Exergy destruction [kW] of the components that report it, and their
+        sum under 'total'
+        '''
+        result = dict((name, r['Exd']) for name, r in self.result.items() if isinstance(r, dict) and 'Exd' in r)
+        result['total'] = sum(result.values())
+
+        return result
+
     def export(self, filename):
 
         # Print to csv file
@@ -72,12 +84,14 @@ class IterateModel:
     '''
     My heart's a mess. Make me iterate better
     '''
-    def __init__(self, model, cond):
+    def __init__(self, model, cond, engine = None):
         self.i = 0
         self.model = model
         self.cond = cond
+        self.engine = engine
         self.iterate = []
         self.lastRun = None
+        self.profile = None
 
     def getDelta(self, res, index = None):
         '''
@@ -168,8 +182,16 @@ class IterateModel:
 
     def run(self, oldResult = False):
         '''
-        This runs an iteration to make a specific value in the model match a condition
+        This runs an iteration to make a specific value in the model match a condition.
+        With an engine given, the models in this thread use it for their properties
         '''
+        if self.engine is None:
+            return self._run(oldResult)
+
+        with useEngine(self.engine):
+            return self._run(oldResult)
+
+    def _run(self, oldResult):
 
         # FIXME: Running an iteration with False as initial guess is troublesome
 
@@ -240,7 +262,7 @@ class IterateModel:
             try:
                 # Run the model
                 model.run()
-            except rp.RefpropError as e:
+            except EngineError as e:
                 print(e)
                 raise(e)
             else:
@@ -272,6 +294,11 @@ class IterateModel:
         print('Finished iteration')
         print('*' * 60)
 
+        if profile.enabled:
+            self.profile = profile.report()
+            print(profile.table())
+            print('*' * 60)
+
         #want to see resulting deltas
 
         self.getDelta(res)
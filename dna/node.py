@@ -0,0 +1,146 @@
+import collections.abc
+
+# Properties stored in slots, each with a bit in StateNode.known
+fields = ('t', 'p', 'h', 's', 'q', 'y', 'yliq', 'yvap', 'mdot', 'media', 'cp', 'D', 'e')
+
+bits = dict((k, 1 << i) for i, k in enumerate(fields))
+
+_fieldbits = tuple(bits.items())
+
+# Plain slot access, bypassing the mapping interface
+_new = object.__new__
+_get = object.__getattribute__
+_set = object.__setattr__
+
+def mask(*keys):
+    '''
+    Bitmask for a set of properties, to test against StateNode.known
+    '''
+    result = 0
+
+    for k in keys:
+        result |= bits[k]
+
+    return result
+
+class StateNode(collections.abc.MutableMapping):
+    '''
+    Node in a model. Behaves like the plain dicts used for nodes before, but
+    keeps the common properties in slots and tracks which of them are set in
+    the bitmask known. Other keys (like 'from' and 'to') go into a dict.
+
+        node = StateNode(p = 10, h = 300, y = 0.5)
+        node['t'] = 60
+        node.known & mask('p', 'h') == mask('p', 'h')
+    '''
+
+    __slots__ = fields + ('known', 'extra')
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, 'known', 0)
+        object.__setattr__(self, 'extra', None)
+
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        bit = bits.get(key)
+
+        if bit is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+
+        if self.known & bit:
+            return object.__getattribute__(self, key)
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        bit = bits.get(key)
+
+        if bit is None:
+            if self.extra is None:
+                object.__setattr__(self, 'extra', {})
+            self.extra[key] = value
+            return
+
+        object.__setattr__(self, key, value)
+        object.__setattr__(self, 'known', self.known | bit)
+
+    def __delitem__(self, key):
+        bit = bits.get(key)
+
+        if bit is None:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            return
+
+        if not self.known & bit:
+            raise KeyError(key)
+
+        object.__delattr__(self, key)
+        object.__setattr__(self, 'known', self.known & ~bit)
+
+    def __setattr__(self, key, value):
+        # Attribute writes have to keep known up to date as well
+        self[key] = value
+
+    def __contains__(self, key):
+        bit = bits.get(key)
+
+        if bit is None:
+            return self.extra is not None and key in self.extra
+
+        return bool(self.known & bit)
+
+    def __iter__(self):
+        known = self.known
+
+        for k in fields:
+            if known & bits[k]:
+                yield k
+
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return bin(self.known).count('1') + (len(self.extra) if self.extra is not None else 0)
+
+    def __repr__(self):
+        return 'StateNode(' + repr(dict(self)) + ')'
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+
+        return default
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+
+    def copy(self):
+        node = _new(StateNode)
+        known = self.known
+
+        for k, bit in _fieldbits:
+            if known & bit:
+                _set(node, k, _get(self, k))
+
+        _set(node, 'known', known)
+        _set(node, 'extra', None if self.extra is None else self.extra.copy())
+
+        return node
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
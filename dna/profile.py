@@ -0,0 +1,180 @@
+import collections
+import contextlib
+import sys
+import threading
+
+import numpy as np
+
+from dna.component import Component
+
+class PropertyProfile:
+    '''
+    Counts and times property calls while enabled: calls and latency per flash
+    mode, failures, REFPROP fallbacks, iterations of the two-phase workaround,
+    cache hits and the component each call came from. When disabled, the only
+    cost is checking the enabled flag.
+
+    Profiling is enabled per thread, the results are shared by all threads.
+    '''
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._local = threading.local()
+        self.clear()
+
+    @property
+    def enabled(self):
+        return getattr(self._local, 'enabled', False)
+
+    @enabled.setter
+    def enabled(self, value):
+        self._local.enabled = value
+
+    def clear(self):
+        with self.lock:
+            self.times = collections.defaultdict(list)
+            self.failures = collections.Counter()
+            self.fallbacks = collections.Counter()
+            self.workaround = collections.Counter()
+            self.components = collections.defaultdict(lambda: [0, 0.0])
+            self.hits = 0
+            self.misses = 0
+
+    def count(self, counter, key):
+        '''
+        Count key in one of the counters failures, fallbacks or workaround
+        '''
+        with self.lock:
+            getattr(self, counter)[key] += 1
+
+    def lookup(self, hit):
+        '''
+        Count a state cache lookup
+        '''
+        with self.lock:
+            if hit:
+                self.hits = self.hits + 1
+            else:
+                self.misses = self.misses + 1
+
+    def caller(self):
+        '''
+        Name of the nearest component on the call stack, like "PinchHex 'recup'"
+        '''
+        frame = sys._getframe(2)
+
+        while frame is not None:
+            obj = frame.f_locals.get('self')
+
+            if isinstance(obj, Component):
+                return '{} {!r}'.format(type(obj).__name__, obj.name)
+
+            frame = frame.f_back
+
+        return '-'
+
+    def record(self, mode, seconds, n = 1, component = None):
+        with self.lock:
+            if n == 1:
+                self.times[mode].append(seconds)
+            else:
+                # One entry per state, so percentiles stay per call
+                self.times[mode].extend([seconds / n] * n)
+
+            entry = self.components[component or '-']
+            entry[0] = entry[0] + n
+            entry[1] = entry[1] + seconds
+
+    def report(self):
+        '''
+        Results as a dict
+        '''
+        with self.lock:
+            return self._report()
+
+    def _report(self):
+        calls = {}
+
+        for mode, times in self.times.items():
+            times = np.array(times)
+
+            calls[mode] = {
+                'count': len(times),
+                'total': times.sum(),
+                'mean': times.mean(),
+                'p50': np.percentile(times, 50),
+                'p90': np.percentile(times, 90),
+                'p99': np.percentile(times, 99),
+                'max': times.max()
+            }
+
+        lookups = self.hits + self.misses
+
+        return {
+            'calls': calls,
+            'failures': dict(self.failures),
+            'fallbacks': dict(self.fallbacks),
+            'workaround': dict(sorted(self.workaround.items())),
+            'cache': {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / lookups if lookups > 0 else 0
+            },
+            'components': dict((k, {'count': v[0], 'total': v[1]}) for k, v in self.components.items())
+        }
+
+    def table(self):
+        '''
+        Results as a printable table
+        '''
+        result = self.report()
+        lines = []
+
+        lines.append('{:<8}{:>10}{:>12}{:>12}{:>12}{:>12}{:>12}{:>10}{:>10}'.format(
+            'Mode', 'Calls', 'Total [s]', 'Mean [ms]', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'Failed', 'Fallback'))
+
+        for mode, c in sorted(result['calls'].items(), key = lambda item: -item[1]['total']):
+            lines.append('{:<8}{:>10d}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>10d}{:>10d}'.format(
+                mode, c['count'], c['total'], c['mean']*1e3, c['p50']*1e3, c['p90']*1e3, c['p99']*1e3,
+                result['failures'].get(mode, 0), result['fallbacks'].get(mode, 0)))
+
+        lines.append('')
+        lines.append('{:<40}{:>10}{:>12}'.format('Component', 'Calls', 'Total [s]'))
+
+        for name, c in sorted(result['components'].items(), key = lambda item: -item[1]['total']):
+            lines.append('{:<40}{:>10d}{:>12.3f}'.format(name, c['count'], c['total']))
+
+        cache = result['cache']
+
+        lines.append('')
+        lines.append('Cache: {:d} hits, {:d} misses, hit rate {:.1%}'.format(cache['hits'], cache['misses'], cache['hitrate']))
+
+        if result['workaround']:
+            lines.append('Two-phase ph workaround, iterations: ' + ', '.join('{}: {}'.format(k, v) for k, v in result['workaround'].items()))
+
+        return '\n'.join(lines)
+
+profile = PropertyProfile()
+
+@contextlib.contextmanager
+def profiling(enabled = True, clear = True):
+    '''
+    Profile property calls for a block of code:
+
+        with profiling() as p:
+            model = IterateModel(MyModel, cond).run()
+
+        print(p.table())
+
+    Only calls from the current thread are profiled.
+    '''
+    previous = profile.enabled
+
+    if clear:
+        profile.clear()
+
+    profile.enabled = enabled
+
+    try:
+        yield profile
+    finally:
+        profile.enabled = previous
@@ -1,34 +1,303 @@
-from decimal import Decimal
+import collections
+import contextlib
+import threading
+import time
+import warnings
+
+import numpy as np
+import scipy.interpolate
+
+from dna.engine import Error, InputError, EngineError, flashMode
+# profiling is re-exported, next to stateCache and diskCache
+from dna.profile import profile, profiling
+from dna.diskcache import DiskCache
+from dna.engines.ammoniawater import AmmoniaWater
+from dna.engines.cpbased import CpBased, usermedia
+
+try:
+    from dna.engines.refprop import RefpropEngine
+except ImportError:
+    RefpropEngine = None
+
+class StateCache:
+    '''
+    Bounded LRU cache for flash results. Entries are keyed on the engine, the
+    flash mode, the two inputs quantized to tol and the composition, so repeated
+    flashes become dictionary lookups.
+
+    The cache is shared by all threads, but enabled per thread.
+    '''
+    def __init__(self, maxsize = 4096, tol = 1e-6):
+        self.maxsize = maxsize
+        self.tol = tol
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return getattr(self._local, 'enabled', False)
+
+    @enabled.setter
+    def enabled(self, value):
+        self._local.enabled = value
+
+    def quantize(self, value, tol = None):
+        return int(round(value / (tol or self.tol)))
+
+    def key(self, engine, mode, in1, in2, node):
+        # The same quantized inputs mean other states at another tolerance,
+        # which matters for the disk cache, so tol is part of the key
+        tol = self.tol
+        key = (engine, mode, tol, self.quantize(in1, tol), self.quantize(in2, tol), self.quantize(node['y'], tol))
+
+        # Two-phase quality inputs also depend on the phase compositions
+        if 'q' in mode and 0 < node['q'] < 1 and 'yliq' in node and 'yvap' in node:
+            key = key + (self.quantize(node['yliq'], tol), self.quantize(node['yvap'], tol))
+
+        return key
+
+    def get(self, key):
+        with self._lock:
+            result = self._data.get(key)
+
+            if result is None:
+                self.misses = self.misses + 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits = self.hits + 1
+
+            return result
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                # Evict least recently used
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            total = self.hits + self.misses
+
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / total if total > 0 else 0,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'tol': self.tol
+            }
+
+cache = StateCache()
+
+@contextlib.contextmanager
+def stateCache(enabled = True, clear = False, maxsize = None, tol = None):
+    '''
+    Enable, disable or clear the state cache for a block of code:
+
+        with stateCache():
+            model = IterateModel(MyModel, cond).run()
+
+    Previous settings are restored on exit, cached entries are kept unless
+    clear is set. Enabling only affects the current thread, maxsize and tol
+    apply to all threads.
+    '''
+    previous = (cache.enabled, cache.maxsize, cache.tol)
+
+    if clear:
+        cache.clear()
+
+    if tol is not None and tol != cache.tol:
+        # Keys quantized with another tolerance are useless
+        with cache._lock:
+            cache.clear()
+            cache.tol = tol
+
+    if maxsize is not None:
+        cache.maxsize = maxsize
+
+    cache.enabled = enabled
+
+    try:
+        yield cache
+    finally:
+        cache.enabled, cache.maxsize, cache.tol = previous
+
+# Property engines per media, None is the default for ammonia-water
+engines = {}
+
+def registerEngine(engine, *media):
+    '''
+    Use engine for the given media, or as the default engine if no media is
+    given
+    '''
+    for m in (media or (None,)):
+        engines[m] = engine
+
+    return engine
+
+registerEngine(CpBased(), *usermedia.keys())
+
+if RefpropEngine is not None:
+    registerEngine(RefpropEngine())
+else:
+    warnings.warn('REFPROP is not available, using the ammonia-water correlation of Ibrahim and Klein')
+    registerEngine(AmmoniaWater())
+
+# Persistent cache behind the state cache, see diskCache()
+disk = None
+
+_fingerprints = {}
+
+def fingerprint(engine):
+    '''
+    Setup fingerprint of engine, found once per engine
+    '''
+    if not engine in _fingerprints:
+        _fingerprints[engine] = engine.fingerprint()
+
+    return _fingerprints[engine]
+
+@contextlib.contextmanager
+def diskCache(path, **kwargs):
+    '''
+    Keep flash results in an SQLite file for a block of code, so later runs and
+    other processes can reuse them. Keys are those of the state cache, with
+    its tolerance:
+
+        with diskCache('output/states.sqlite'), stateCache():
+            model = IterateModel(MyModel, cond).run()
+
+    Arguments go to DiskCache (maxsize, maxage, batch).
+    '''
+    global disk
+
+    previous = disk
+    disk = DiskCache(path, **kwargs)
 
-from dna.vendor import refprop as rp
+    try:
+        yield disk
+    finally:
+        disk.close()
+        disk = previous
+
+# Engines set with useEngine(), per thread, over the registered engines
+_local = threading.local()
+
+def engineFor(node):
+    '''
+    The engine that handles the media of node
+    '''
+    media = node.get('media')
+
+    scoped = getattr(_local, 'engines', None)
+
+    if scoped:
+        if media in scoped:
+            return scoped[media]
+
+        if not media in engines and None in scoped:
+            return scoped[None]
+
+    if media in engines:
+        return engines[media]
+
+    return engines[None]
+
+@contextlib.contextmanager
+def useEngine(engine, *media):
+    '''
+    Use another property engine within a block of code, for the given media or
+    as the default engine. This only affects the current thread, so models in
+    other threads can use their own engine:
+
+        with useEngine(AmmoniaWater()):
+            model = IterateModel(MyModel, cond).run()
+    '''
+    if getattr(_local, 'engines', None) is None:
+        _local.engines = {}
+
+    scoped = _local.engines
+    keys = media or (None,)
+    previous = dict((m, scoped.get(m)) for m in keys)
+
+    for m in keys:
+        scoped[m] = engine
 
-class Error(Exception):
-    """Base class for exceptions in this module."""
-    pass
+    try:
+        yield engine
+    finally:
+        for m, e in previous.items():
+            if e is None:
+                del scoped[m]
+            else:
+                scoped[m] = e
 
-class InputError(Error):
-    """Exception raised for errors in the input.
+# Property tables per media, see dna.engines.table.PropertyTable
+tables = {}
+
+@contextlib.contextmanager
+def useTable(table, media = 'kalina'):
+    '''
+    Use an interpolated property table for a media within a block of code:
 
-    Attributes:
-        expr -- input expression in which the error occurred
-        msg  -- explanation of the error
-    """
+        with useTable(PropertyTable.load('kalina-ph.npz')):
+            model = IterateModel(MyModel, cond).run()
 
-    def __init__(self, expr, msg):
-        self.expr = expr
-        self.msg = msg
+    Nodes without media are ammonia-water as well, so they use the table
+    registered for 'kalina'. States the table can not deliver within its
+    error bound are flashed exactly, and so are all states when the engine
+    differs from the one that filled the table.
+    '''
+    previous = tables.get(media)
+    tables[media] = table
 
-rp.setup('def', 'ammonia', 'water')
-rp.setref(hrf='def',ixflag=1)
+    try:
+        yield table
+    finally:
+        if previous is None:
+            del tables[media]
+        else:
+            tables[media] = previous
+
+# Saturation tables per media, see dna.engines.table.SaturationTable
+saturationTables = {}
+
+@contextlib.contextmanager
+def useSaturationTable(table, media = 'kalina'):
+    '''
+    Use precomputed bubble and dew curves for tbub, tdew, pbub and pdew within
+    a block of code, like useTable
+    '''
+    previous = saturationTables.get(media)
+    saturationTables[media] = table
 
-usermedia = {
-    'hitecxl': {'cp': 1.447, 'tmin': 130, 'tmax': 490},
-    'hitec': {'cp': 1.5617, 'tmin': 180, 'tmax': 560}
-}
+    try:
+        yield table
+    finally:
+        if previous is None:
+            del saturationTables[media]
+        else:
+            saturationTables[media] = previous
 
 def checkMediaAndEngine(node):
     if 'media' in node and node['media'] in usermedia:
-        node['cp'] = usermedia[node['media']]['cp']
+        # A polynomial cp is set by the state itself
+        if not isinstance(usermedia[node['media']]['cp'], tuple):
+            node['cp'] = usermedia[node['media']]['cp']
+
         node['tmin'] = usermedia[node['media']]['tmin']
         node['tmax'] = usermedia[node['media']]['tmax']
         return False
@@ -36,256 +305,341 @@ def checkMediaAndEngine(node):
     return True
 
 def state(node):
+    '''
+    Find the state of node
+    '''
+    if profile.enabled:
+        return _profiled(_state, node)
 
-    use_rp = checkMediaAndEngine(node)
+    return _state(node)
 
-    if use_rp:
-        return refpropState(node)
-    else:
-        return cpBasedState(node)
+def _profiled(func, node):
+    mode = flashMode(node)
+    mode = mode[0] if mode is not None else '-'
 
-def crit(node):
-    use_rp = checkMediaAndEngine(node)
+    component = profile.caller()
+
+    start = time.perf_counter()
+
+    try:
+        return func(node)
+    except Error:
+        profile.count('failures', mode)
+        raise
+    finally:
+        profile.record(mode, time.perf_counter() - start, component = component)
+
+def _state(node):
+    checkMediaAndEngine(node)
+
+    engine = engineFor(node)
+
+    if not engine.cacheable:
+        return engine.state(node)
 
-    if use_rp:
-        prop = toRefprop(node)
-        node.update(fromRefprop(rp.critp(prop['x'])))
+    table = tables.get(node.get('media', 'kalina'))
+
+    if table is not None and table.matches(engine) and table.lookup(node):
         return node
 
-    # Fallback: Return -1
-    return -1
+    if not cache.enabled and disk is None:
+        return engine.state(node)
 
-def toRefprop(node):
-    prop = rp.xmole([node['y'],1-node['y']])
+    mode = flashMode(node)
 
-    molWmix = prop['wmix']
+    if mode is None:
+        raise InputError('state', 'Missing inputs for node {}'.format(node))
 
-    if 'mdot' in node:
-        prop['mdot'] = node['mdot']
+    mode, in1, in2 = mode
 
-    if 'p' in node:
-        prop['p'] = node['p']*100 # hPa > kPa
+    key = cache.key(engine.name, mode, node[in1], node[in2], node)
+    result = cache.get(key) if cache.enabled else None
 
-    if 'e' in node:
-        prop['e'] = node['e']*molWmix # kJ/kg > J/mol
+    if profile.enabled and cache.enabled:
+        profile.lookup(result is not None)
 
-    if 'h' in node:
-        prop['h'] = node['h']*molWmix # kJ/kg*K > J/mol*K
+    if result is None and disk is not None:
+        result = disk.get(fingerprint(engine), key)
 
-    if 'D' in node:
-        prop['D'] = node['D']/molWmix*1000 # kg/m3 > mol/L
+        if result is not None and cache.enabled:
+            cache.put(key, result)
 
-    if 's' in node:
-        prop['s'] = node['s']*molWmix # kJ/kg*K > J/mol*K
+    if result is None:
+        result = engine.flash(node)
 
-    if 't' in node:
-        prop['t'] = node['t'] + 273.15 # C > K
+        if cache.enabled:
+            cache.put(key, result)
 
-    if 'cv' in node:
-        prop['cv'] = node['cv']*molWmix # kJ/kg*K > J/mol*K
+        if disk is not None:
+            disk.put(fingerprint(engine), key, result)
 
-    if 'cp' in node:
-        prop['cp'] = node['cp']*molWmix # kJ/kg*K > J/mol*K
+    node.update(result)
 
-    if 'q' in node:
-        q = max(0, min(1, node['q']))
-        if not 'yvap' in node or not 'yliq' in node:
-            if q == 0:
-                node['yliq'] = node['y']
-                node['yvap'] = 0
-            elif q == 1:
-                node['yvap'] = node['y']
-                node['yliq'] = 0
-            else:
-                raise ValueError('Can not support this value for q')
+    return node
+
+def states(nodes):
+    '''
+    Find the state of a list of nodes at once. Nodes sharing media and flash
+    mode are evaluated with a single states_array() call, results are written
+    back into the nodes like state() does.
+    '''
+    groups = collections.OrderedDict()
 
-        tmpYliq = [node['yliq'], 1 - node['yliq']]
-        tmpYvap = [node['yvap'], 1 - node['yvap']]
-        tmpInfo = rp.qmole(q, tmpYliq, tmpYvap)
+    for node in nodes:
+        checkMediaAndEngine(node)
+        mode = flashMode(node)
 
-        prop['xliq'] = tmpInfo['xliq']
-        prop['xvap'] = tmpInfo['xvap']
-        prop['q'] = tmpInfo['q']
+        if mode is None:
+            # Let state() complain or handle the cp based fallbacks
+            state(node)
+            continue
 
-    return prop
+        if engineFor(node).cacheable and 'q' in mode[0] and 0 < node['q'] < 1:
+            # Conversion of a two-phase quality needs the phase compositions
+            state(node)
+            continue
 
-def fromRefprop(prop):
-    node = {}
+        groups.setdefault((node.get('media'), mode), []).append(node)
 
-    tmpNode = rp.xmass(prop['x'])
+    for (media, (mode, in1, in2)), group in groups.items():
+        y = [node.get('y', 0) for node in group]
+        result = states_array([node[in1] for node in group], [node[in2] for node in group],
+            y, mode = mode, media = media)
 
-    node['y'] = float(tmpNode['xkg'][0])
+        for i, node in enumerate(group):
+            for k, v in result.items():
+                node[k] = float(v[i])
 
-    molWmix = tmpNode['wmix']
+    return nodes
 
-    if 'mdot' in prop:
-        node['mdot'] = prop['mdot']
+def states_array(in1, in2, y, mode = 'ph', media = None):
+    '''
+    Vectorized state evaluation. Inputs are arrays (or scalars) of the two
+    flash inputs of mode and the ammonia mass fraction. Returns a dict of arrays
+    with t, p, h, s, q and y, plus D, e, cp, yliq and yvap for ammonia-water.
 
-    # Convert mol to kg, K to C, kPa to hPa
-    if 'p' in prop:
-        node['p'] = prop['p']/100 # kPa > hPa
+    States covered by a property table are interpolated, the rest is flashed
+    by the engine of the media in one call. REFPROP refuses qualities in
+    between 0 and 1 here, as they need the phase compositions: use state().
+    '''
+    in1, in2, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (in1, in2, y)])
 
-    if 'pcrit' in prop:
-        node['pcrit'] = prop['pcrit']/100 # kPa > hPa
+    if not profile.enabled:
+        return _stateArray(in1, in2, y, mode, media)
 
-    if 'e' in prop:
-        node['e'] = prop['e']/molWmix # J/mol > kJ/kg
+    component = profile.caller()
+    start = time.perf_counter()
 
-    if 'h' in prop:
-        node['h'] = prop['h']/molWmix # J/mol > kJ/kg
+    try:
+        return _stateArray(in1, in2, y, mode, media)
+    except Error:
+        profile.count('failures', mode)
+        raise
+    finally:
+        profile.record(mode, time.perf_counter() - start, n = max(1, in1.size), component = component)
 
-    if 'D' in prop:
-        node['D'] = prop['D']*molWmix/1000 # mol/L > kg/m3
+def _stateArray(in1, in2, y, mode, media):
+    engine = engineFor({'media': media})
 
-    if 'Dcrit' in prop:
-        node['Dcrit'] = prop['Dcrit']*molWmix/1000 # mol/L > kg/m3
+    if not engine.cacheable:
+        return engine.stateArray(in1, in2, y, mode = mode, media = media)
 
-    if 's' in prop:
-        node['s'] = prop['s']/molWmix # J/mol*K > kJ/kg*K
+    table = tables.get(media or 'kalina')
 
-    if 't' in prop:
-        node['t'] = prop['t'] - 273.15 # K > C
+    if table is not None and table.mode == mode and table.matches(engine):
+        result, ok = table.lookupArray(in1, in2, y)
+        result = dict((k, np.array(v)) for k, v in result.items())
+        result['p'] = in1 if mode == 'ph' else in2
+    else:
+        result = {}
+        ok = np.zeros(in1.shape, dtype = bool)
 
-    if 'tcrit' in prop:
-        node['tcrit'] = prop['tcrit'] - 273.15 # K > C
+    if ok.all():
+        return result
 
-    if 'cv' in prop:
-        node['cv'] = prop['cv']/molWmix # J/mol*K > kJ/kg*K
+    # Flash whatever the table could not deliver
+    flashed = engine.stateArray(in1[~ok], in2[~ok], y[~ok], mode = mode, media = media)
 
-    if 'cp' in prop:
-        node['cp'] = prop['cp']/molWmix # J/mol*K > kJ/kg*K
+    for k, v in flashed.items():
+        if not k in result:
+            result[k] = np.full(in1.shape, np.nan)
+        result[k][~ok] = v
 
-    if 'q' in prop and 'xvap' in prop and 'xliq' in prop:
-        tmpInfo = rp.qmass(max(0, min(1, prop['q'])), prop['xvap'], prop['xliq'])
-        node['q'] = float(tmpInfo['qkg'])
-        node['yvap'] = float(tmpInfo['xvkg'][0])
-        node['yliq'] = float(tmpInfo['xlkg'][0])
+    return result
 
-    return node
+class CriticalCurve:
+    '''
+    Critical point of an engine as a function of y. Points are found once per
+    quantized y, and a smooth curve through N points over y in [0, 1] gives
+    tcrit(y) and pcrit(y) without calling the engine.
+    '''
+    def __init__(self, engine, N = 101, tol = 1e-6):
+        self.engine = engine
+        self.N = N
+        self.tol = tol
+        self.points = {}
+        self.curve = None
+        self.lock = threading.RLock()
+
+    def point(self, y):
+        key = int(round(y / self.tol))
+
+        with self.lock:
+            if not key in self.points:
+                result = self.engine.crit(y)
+                self.points[key] = dict((k, result[k]) for k in ('tcrit', 'pcrit', 'Dcrit') if k in result)
+
+            return self.points[key]
+
+    def prepare(self):
+        with self.lock:
+            if self.curve is None:
+                self._prepare()
+
+        return self
+
+    def _prepare(self):
+        y = np.linspace(0, 1, self.N)
+        tc = np.full(y.shape, np.nan)
+        pc = np.full(y.shape, np.nan)
+
+        for i, _y in enumerate(y):
+            try:
+                point = self.point(float(_y))
+            except EngineError:
+                continue
+
+            tc[i], pc[i] = point['tcrit'], point['pcrit']
+
+        ok = np.isfinite(tc) & np.isfinite(pc)
+
+        if ok.sum() < 2:
+            raise EngineError('No critical curve for engine {}'.format(self.engine.name))
+
+        self.curve = (
+            scipy.interpolate.PchipInterpolator(y[ok], tc[ok]),
+            scipy.interpolate.PchipInterpolator(y[ok], pc[ok])
+        )
+
+    def tcrit(self, y):
+        if self.curve is None:
+            self.prepare()
+
+        return self.curve[0](y)
+
+    def pcrit(self, y):
+        if self.curve is None:
+            self.prepare()
+
+        return self.curve[1](y)
 
-def _PHworkaround(_node, depth = 1):
+# Critical curves per engine
+criticalCurves = {}
+_criticalLock = threading.Lock()
 
-    if depth > 5:
-        print(_node)
-        raise RuntimeError('Failed to find state for node')
+def criticalCurve(media = None):
+    '''
+    The critical curve for the engine of media
+    '''
+    engine = engineFor({'media': media})
+
+    with _criticalLock:
+        if not engine in criticalCurves:
+            criticalCurves[engine] = CriticalCurve(engine)
+
+        return criticalCurves[engine]
 
-    molWmix = rp.wmol(_node['x'])
+def crit(node):
+    checkMediaAndEngine(node)
 
     try:
-        propl = rp.flsh('ph', _node['p'], _node['h'] - 25*molWmix*depth, _node['x'])
-        propr = rp.flsh('ph', _node['p'], _node['h'] + 25*molWmix*depth, _node['x'])
-        t = (propl['t'] + propr['t']) / 2
-
-        prop = rp.flsh('tp', t, _node['p'], _node['x'])
-    except rp.RefpropError as e:
-        _depth = depth + 1
-        prop = _PHworkaround(_node, depth = _depth)
-
-    return prop
-
-def refpropState(node):
-    '''
-    If the state is to be found from refprop, use this method
-    '''
-
-    mode = ''
-    in1 = 0
-    in2 = 0
-
-    # Convert input to refprop notation:
-    _node = toRefprop(node)
-
-    # Figure out which inputs to use (sorted by priority)
-    if 'p' in _node and 'h' in _node:
-        mode = 'ph'
-        in1 = _node['p']
-        in2 = _node['h']
-    elif 'p' in _node and 'e' in _node:
-        mode = 'pe'
-        in1 = _node['p']
-        in2 = _node['e']
-    elif 'p' in _node and 's' in _node:
-        mode = 'ps'
-        in1 = _node['p']
-        in2 = _node['s']
-    elif 'p' in _node and 'q' in _node:
-        mode = 'pq'
-        in1 = _node['p']
-        in2 = _node['q']
-    elif 't' in _node and 'p' in _node:
-        mode = 'tp'
-        in1 = _node['t']
-        in2 = _node['p']
-    elif 't' in _node and 'q' in _node:
-        mode = 'tq'
-        in1 = _node['t']
-        in2 = _node['q']
-    else:
-        print(_node)
-        raise InputError('state','Missing inputs for above node')
+        node.update(criticalCurve(node.get('media')).point(node['y']))
+    except NotImplementedError:
+        # Fallback: Return -1
+        return -1
+
+    return node
+
+def tcrit(y, media = None):
+    '''
+    Critical temperature [C] for ammonia mass fraction y, from the critical
+    curve. Takes scalars or arrays
+    '''
+    result = criticalCurve(media).tcrit(y)
+
+    return float(result) if np.ndim(result) == 0 else result
+
+def pcrit(y, media = None):
+    '''
+    Critical pressure [bar] for ammonia mass fraction y, see tcrit
+    '''
+    result = criticalCurve(media).pcrit(y)
+
+    return float(result) if np.ndim(result) == 0 else result
 
+def is_supercritical(node):
+    '''
+    Whether node is above the critical pressure of its composition, and above
+    the critical temperature too if t is known. Always False for media
+    without a critical point
+    '''
     try:
-        # Calculate
-        prop = rp.flsh(mode, in1, in2, _node['x'])
-    except rp.RefpropError as e:
-        # Normal flsh failed, try flsh2 as well
-        try:
-            if mode is 'ph':
-                # Assume something in the 2-phase region. temperature changes very little with enthalpy
-                prop = _PHworkaround(_node)
-                print('Workaround for iteration, enthalpy difference {:.2e} K'.format(in2 - _node['h']))
-            elif mode is 'tp':
-                propl = rp.flsh('tp', _node['t'] - 0.1, _node['p'], _node['x'])
-                propr = rp.flsh('tp', _node['t'] + 0.1, _node['p'], _node['x'])
-                h = (propl['h'] + propr['h']) / 2
-
-                prop = rp.flsh('ph', _node['p'], h, _node['x'])
-                print('Workaround for iteration, temperature difference {:.2e} J/mol*K'.format(in1 - _node['t']))
-            else:
-                print(node)
-                print(mode)
-                print(in1)
-                print(in2)
-                raise(e)
+        curve = criticalCurve(node.get('media'))
+
+        if node['p'] <= curve.pcrit(node['y']):
+            return False
+    except NotImplementedError:
+        return False
 
-        except Exception as e:
-            print(node)
-            raise(e)
+    return not 't' in node or node['t'] > curve.tcrit(node['y'])
 
-    # Convert back from refprop notation, then update node
-    node.update(fromRefprop(prop))
+def tbub(p, y, media = None, exact = False):
+    '''
+    Bubble point temperature [C] at pressure p [bar] for ammonia mass fraction
+    y. Takes scalars or arrays. Uses the saturation table of the media where
+    available, unless exact is set.
+    '''
+    return _saturation('pq', 0, p, y, media, exact)
 
-    return node
+def tdew(p, y, media = None, exact = False):
+    '''
+    Dew point temperature [C] at pressure p [bar], see tbub
+    '''
+    return _saturation('pq', 1, p, y, media, exact)
+
+def pbub(t, y, media = None, exact = False):
+    '''
+    Bubble point pressure [bar] at temperature t [C], see tbub
+    '''
+    return _saturation('tq', 0, t, y, media, exact)
 
-def cpBasedState(node):
+def pdew(t, y, media = None, exact = False):
     '''
-    This does not consider:
-    p,cv,q,y,yvap,yliq
-    But it considers:
-    e,h,s,t,cp
-    Reference point is: h = 0 at t=273
+    Dew point pressure [bar] at temperature t [C], see tbub
     '''
+    return _saturation('tq', 1, t, y, media, exact)
+
+def _saturation(mode, q, x, y, media, exact):
+    x, y = np.broadcast_arrays(*[np.asarray(v, dtype = float) for v in (x, y)])
 
-    # Make sure object has often-requested properties defined
-    if not 'p' in node:
-        node['p'] = 0
+    out = 't' if mode == 'pq' else 'p'
+    kind = 'bub' if q == 0 else 'dew'
 
-    if not 'q' in node:
-        node['q'] = 0
+    table = saturationTables.get(media or 'kalina')
 
-    if not 'y' in node:
-        node['y'] = 0
+    if table is not None and not exact:
+        if out == 't':
+            result = table.temperature(kind, x, y)
+        else:
+            result = table.pressure(kind, x, y)
+    else:
+        result = np.full(x.shape, np.nan)
 
-    # Calculation
-    if 'h' in node:
-        node['t'] = node['h'] / node['cp']
-        node['s'] = node['h'] / (node['t'] + 273.15)
+    # Refine what the table could not deliver with exact flashes
+    missing = np.isnan(result)
 
-    elif 't' in node:
-        node['h'] = node['cp'] * node['t']
-        node['s'] = node['h'] / (node['t'] + 273.15)
-    elif 's' in node:
-        node['t'] = 273.15 / ((node['cp'] / node['s']) - 1)
-        node['h'] = node['cp'] * node['t']
+    if missing.any():
+        result[missing] = states_array(x[missing], np.full(missing.sum(), q), y[missing],
+            mode = mode, media = media)[out]
 
-    return node
+    return float(result) if result.ndim == 0 else result
@@ -0,0 +1,54 @@
+'''
+Models and helpers shared by the tests
+'''
+import threading
+
+from dna.components import PinchHex
+from dna.model import DnaModel
+
+class PinchHexTest(DnaModel):
+    '''
+    Condensing ammonia-water heating a high pressure stream, like the heatex
+    test. cond holds the inlet temperatures and the arguments of calc().
+    '''
+    def run(self):
+        heatex = self.addComponent(PinchHex, 'heatex').nodes(1, 2, 3, 4)
+
+        self.nodes[1].update({
+            'media': 'kalina',
+            'y': 0.8,
+            't': self.cond.get('t_hot', 148.95),
+            'p': 4.76466,
+            'mdot': 5.5865
+        })
+
+        self.nodes[3].update({
+            'media': 'kalina',
+            'y': 0.8,
+            't': self.cond.get('t_cold', 48.884),
+            'p': 140,
+            'mdot': 5.5374
+        })
+
+        heatex.calc(**self.cond.get('calc', {}))
+
+        return self
+
+def runThreads(target, n):
+    errors = []
+
+    def run(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target = run, args = (i,)) for i in range(n)]
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    assert not errors, errors
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+from dna import states
+from dna.test.shared import runThreads
+
+def test_threads():
+    inputs = [{'t': t, 'p': 10, 'y': 0.5} for t in range(20, 120, 5)]
+    expected = [states.state(dict(node)) for node in inputs]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'states.sqlite')
+
+        def run(i = 0):
+            for node, result in zip(inputs, expected):
+                assert states.state(dict(node))['h'] == result['h']
+
+        with states.diskCache(path, batch = 7) as disk:
+            runThreads(run, 3)
+
+        # Everything was written, so a new run only reads
+        with states.diskCache(path) as disk:
+            run()
+
+            assert disk.info()['hits'] == len(inputs)
+            assert disk.info()['misses'] == 0
+
+def test_tolerance():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'states.sqlite')
+
+        # Both quantize to the same integers at these tolerances
+        with states.diskCache(path), states.stateCache(tol = 1e-3):
+            states.state({'p': 10, 'h': 300, 'y': 0.5})
+
+        with states.diskCache(path) as disk, states.stateCache(tol = 1e-6):
+            node = states.state({'p': 0.01, 'h': 0.3, 'y': 0.0005})
+
+            assert disk.info()['hits'] == 0
+
+        assert abs(node['t'] - states.state({'p': 0.01, 'h': 0.3, 'y': 0.0005})['t']) < 1e-9
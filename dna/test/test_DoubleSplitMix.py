@@ -1,4 +1,5 @@
 from dna.components import DoubleSplitMix
+from dna.engine import InputError
 from dna.model import DnaModel
 
 class DSMTest(DnaModel):
@@ -20,10 +21,10 @@ class DSMTest(DnaModel):
             'p': 5.705
         })
 
-        self.nodes[13].update({
+        self.nodes[13].update(self.cond.get(13, {
             'y': 0.4,
             'mdot': 4.6317
-        })
+        }))
 
         self.nodes[41].update({
             'y': 0.6,
@@ -60,3 +61,70 @@ class DSMTest(DnaModel):
         #print('Energy: ', n[1]['mdot'] * (n[1]['h'] - n[2]['h']),' (expected 797.812)')
 
         return self
+
+class DSMManyTest(DnaModel):
+    '''
+    Three inlets to three outlets, the last one takes the rest
+    '''
+    def run(self):
+        self.addComponent(DoubleSplitMix, 'dsm1').nodes([1, 2, 3], [4, 5, 6])
+
+        for i, (y, mdot, t) in enumerate([(0.3637, 6.4944, 24), (0.9556, 3.2995, 80), (0.5, 2, 40)]):
+            self.nodes[i + 1].update({
+                'media': 'kalina',
+                'y': y,
+                'mdot': mdot,
+                't': t,
+                'p': 5.705
+            })
+
+        self.nodes[4].update(self.cond.get(4, {'y': 0.4, 'mdot': 4}))
+        self.nodes[5].update(self.cond.get(5, {'y': 0.7, 'mdot': 3}))
+        self.nodes[6].update(self.cond.get(6, {}))
+
+        self.components['dsm1'].calc()
+
+        return self
+
+def balance(model, inlets, outlets):
+    n = model.nodes
+
+    mdot = sum(n[i]['mdot'] for i in inlets) - sum(n[o]['mdot'] for o in outlets)
+    nh3 = sum(n[i]['mdot'] * n[i]['y'] for i in inlets) - sum(n[o]['mdot'] * n[o]['y'] for o in outlets)
+
+    return mdot, nh3
+
+def test_two():
+    model = DSMTest({}).run()
+
+    assert max(abs(d) for d in balance(model, [11, 30], [13, 41])) < 1e-9
+    assert abs(model.nodes[13]['y'] - 0.4) < 1e-9
+    assert abs(model.nodes[13]['mdot'] - 4.6317) < 1e-9
+
+def test_two_empty():
+    # No division by the empty lean outlet
+    model = DSMTest({13: {'y': 0.4, 'mdot': 0}}).run()
+
+    assert model.nodes[13]['mdot'] == 0
+    assert max(abs(d) for d in balance(model, [11, 30], [13, 41])) < 1e-9
+
+def test_many():
+    model = DSMManyTest({}).run()
+    n = model.nodes
+
+    assert max(abs(d) for d in balance(model, [1, 2, 3], [4, 5, 6])) < 1e-9
+
+    for o, y, mdot in [(4, 0.4, 4), (5, 0.7, 3)]:
+        assert abs(n[o]['y'] - y) < 1e-6
+        assert abs(n[o]['mdot'] - mdot) < 1e-6
+
+    # The rest
+    assert abs(n[6]['mdot'] - (6.4944 + 3.2995 + 2 - 7)) < 1e-6
+
+    # Two outlets without targets leave their split open
+    try:
+        DSMManyTest({5: {'mdot': 3}}).run()
+    except InputError:
+        pass
+    else:
+        assert False, 'split between two outlets without targets'
@@ -0,0 +1,104 @@
+from dna.components import MultiStreamHex
+from dna.model import DnaModel
+
+def round_down(num, divisor):
+    return num - (num%divisor)
+def round_up(num, divisor):
+    return num + (num%divisor)
+
+# Actual test:
+class MultiStreamHexTest(DnaModel):
+    def run(self):
+        heatex = self.addComponent(MultiStreamHex, 'heatex').nodes(hot = [(1, 2)], cold = [(3, 4), (5, 6)])
+
+        self.nodes[1].update({
+            'media': 'hitec',
+            't': 430,
+            'p': 0.857,
+            'mdot': 3
+        })
+
+        # Free outlet, found from the pinch
+        self.nodes[3].update({
+            'media': 'kalina',
+            'y': 0.7,
+            't': self.cond.get('t_cold', 85),
+            'p': 100,
+            'mdot': 1
+        })
+
+        # Specified outlet
+        self.nodes[5].update({
+            'media': 'kalina',
+            'y': 0.5,
+            't': 60,
+            'p': 20,
+            'mdot': 0.5
+        })
+
+        self.nodes[6]['t'] = self.cond.get('t6', 200)
+
+        heatex.calc(Nseg = 11, dTmin = 5)
+
+        return self
+
+    def plot(self):
+        import matplotlib.pyplot as plt
+
+        print('Plotting...')
+
+        result = self.result['heatex']
+        _title = '{0} - Pinch: {1:.2f}, Q: {2:.2f} [kW]'.format('heatex'.capitalize(), result['dTmin'], result['Q'])
+
+        # Plot
+        miny = round_down(min(min(result['Tc']), min(result['Th']))-1, 10)
+        maxy = round_up(max(max(result['Tc']), max(result['Th']))+1, 10)
+        plt.plot(result['x'], result['Th'], 'r->', label = 'Hot')
+        plt.plot(result['x'], result['Tc'], 'b-<', label = 'Cold')
+        plt.xlabel('Duty fraction')
+        plt.ylabel(r'Temperature [$^\circ$C]')
+        plt.title(_title)
+        plt.ylim(miny, maxy)
+        plt.grid(True)
+        plt.savefig('../output/multiStreamHexTest.png')
+        plt.close()
+
+        return self
+
+    def analyse(self):
+        n = self.nodes
+
+        print('Hot inlet: ', n[1])
+        print('Hot outlet: ', n[2])
+        print('Energy difference: ', n[1]['mdot'] * (n[2]['h'] - n[1]['h']))
+
+        cold = n[3]['mdot'] * (n[4]['h'] - n[3]['h']) + n[5]['mdot'] * (n[6]['h'] - n[5]['h'])
+
+        print('Cold outlets: ', n[4], n[6])
+        print('Energy difference: ', cold, '(expected equal and opposite)')
+        print('Pinch: ', self.result['heatex']['dTmin'], '(expected 5)')
+
+        return self
+
+def balance(model):
+    n = model.nodes
+
+    hot = n[1]['mdot'] * (n[1]['h'] - n[2]['h'])
+    cold = n[3]['mdot'] * (n[4]['h'] - n[3]['h']) + n[5]['mdot'] * (n[6]['h'] - n[5]['h'])
+
+    return hot - cold
+
+def test_pinch():
+    model = MultiStreamHexTest({'t_cold': 250, 't6': 100}).run()
+
+    assert abs(balance(model)) < 1e-9
+    assert abs(model.result['heatex']['dTmin'] - 5) < 0.01
+    assert model.nodes[6]['t'] == 100
+
+def test_tmin():
+    # The salt reaches its tmin before the pinch closes
+    model = MultiStreamHexTest({}).run()
+
+    assert abs(balance(model)) < 1e-9
+    assert abs(model.nodes[2]['t'] - 180) < 1e-9
+    assert model.result['heatex']['dTmin'] > 5
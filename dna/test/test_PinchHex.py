@@ -0,0 +1,170 @@
+import numpy as np
+
+from dna.components import PinchHex
+from dna import states
+from dna.components.heatex import PinchCalc, memo, pinchMemo
+from dna.engine import InputError
+from dna.model import DnaModel
+from dna.test.shared import PinchHexTest
+
+class SaltTest(DnaModel):
+    '''
+    Ammonia-water heating molten salt, like the storage test
+    '''
+    def run(self):
+        heatex = self.addComponent(PinchHex, 'heatex').nodes(1, 2, 3, 4)
+
+        self.nodes[1].update({
+            'media': 'kalina',
+            'y': 0.7,
+            'mdot': 1,
+            't': 450,
+            'p': 100
+        })
+
+        self.nodes[3].update({
+            'media': self.cond['media'],
+            't': self.cond['t_cold'],
+            'p': 1,
+            'mdot': 2
+        })
+
+        heatex.calc(Nseg = 11, dTmin = 5)
+
+        return self
+
+class SaltFlowTest(DnaModel):
+    '''
+    Molten salt of unknown mass flow rate heating ammonia-water to t4
+    '''
+    def run(self):
+        heatex = self.addComponent(PinchHex, 'heatex').nodes(1, 2, 3, 4)
+
+        self.nodes[1].update({
+            'media': 'hitec',
+            't': 450,
+            'p': 1
+        })
+
+        self.nodes[3].update({
+            'media': 'kalina',
+            'y': 0.7,
+            't': self.cond['t_cold'],
+            'p': 100,
+            'mdot': 1
+        })
+
+        self.nodes[4].update({
+            't': self.cond['t4']
+        })
+
+        heatex.calc(Nseg = 11, dTmin = 5)
+
+        return self
+
+def pinch(model, Nseg = 2000):
+    '''
+    Pinch of the solved exchanger from a fine uniform profile
+    '''
+    n = model.nodes
+
+    return PinchCalc(n[1], n[2], n[3], n[4], Nseg, 5).check(n[1], n[2], n[3], n[4])['dTmin']
+
+def test_adaptive():
+    fine = PinchHexTest({'calc': {'Nseg': 400, 'dTmin': 5}}).run()
+    adaptive = PinchHexTest({'calc': {'Nseg': 5, 'dTmin': 5, 'adaptive': True}}).run()
+
+    # The phase boundaries and the pinch are resolved from 5 segments. A
+    # uniform profile only approaches the pinch from above at the bubble point
+    assert abs(adaptive.result['heatex']['dTmin'] - 5) < 0.05
+    assert abs(pinch(adaptive) - 5) < 0.05
+    assert abs(adaptive.result['heatex']['Q'] - fine.result['heatex']['Q']) < 2e-3 * fine.result['heatex']['Q']
+
+    # Where a uniform profile of 5 segments misses the pinch
+    coarse = PinchHexTest({'calc': {'Nseg': 5, 'dTmin': 5}}).run()
+
+    assert pinch(coarse) < 4.5
+
+def test_memo():
+    expected = PinchHexTest({}).run()
+    other = PinchHexTest({'t_hot': 150}).run()
+
+    with pinchMemo(clear = True):
+        PinchHexTest({}).run()
+
+        # Exact hits restore the recomputed nodes and result
+        model = PinchHexTest({}).run()
+
+        assert memo.info()['hits'] == 1
+
+        for i, node in expected.nodes.items():
+            np.testing.assert_equal(dict(model.nodes[i]), dict(node))
+
+        np.testing.assert_equal(model.result['heatex'], expected.result['heatex'])
+
+        # Near hits only warm start the solve
+        model = PinchHexTest({'t_hot': 150}).run()
+
+        assert memo.info()['near'] == 1
+        assert abs(model.result['heatex']['Q'] - other.result['heatex']['Q']) < 1e-4 * other.result['heatex']['Q']
+
+    assert not memo.enabled
+
+def test_rating():
+    design = PinchHexTest({}).run()
+
+    assert abs(design.nodes[2]['t'] - 92.843) < 1e-3
+    assert abs(design.nodes[4]['t'] - 120.057) < 1e-3
+
+    # The design UA reproduces the design outlets
+    model = PinchHexTest({'calc': {'UA': design.result['heatex']['UA']}}).run()
+
+    assert abs(model.nodes[2]['t'] - design.nodes[2]['t']) < 0.05
+    assert abs(model.nodes[4]['t'] - design.nodes[4]['t']) < 0.05
+    assert abs(model.result['heatex']['UA'] - design.result['heatex']['UA']) < 1e-3 * design.result['heatex']['UA']
+
+    # As do the sections of the design profile
+    model = PinchHexTest({'calc': {'UA': design.result['heatex']['UAseg']}}).run()
+
+    assert abs(model.nodes[2]['t'] - design.nodes[2]['t']) < 0.05
+    assert abs(model.nodes[4]['t'] - design.nodes[4]['t']) < 0.05
+
+    # Off design, the distribution matters a little
+    total = PinchHexTest({'t_hot': 140, 'calc': {'UA': design.result['heatex']['UA']}}).run()
+    sections = PinchHexTest({'t_hot': 140, 'calc': {'UA': design.result['heatex']['UAseg']}}).run()
+
+    assert abs(sections.nodes[4]['t'] - total.nodes[4]['t']) < 2
+    assert abs(sections.result['heatex']['Q'] - total.result['heatex']['Q']) < 0.02 * total.result['heatex']['Q']
+
+def test_exergy():
+    # Entropy of cp based media, ds = cp dT/T
+    node = states.state({'media': 'hitec', 't': 300, 'p': 1})
+
+    assert abs(node['s'] - 1.5617 * np.log(573.15 / 273.15)) < 1e-12
+    assert abs(states.state({'media': 'hitec', 's': node['s'], 'p': 1})['t'] - 300) < 1e-9
+
+    # No exergy is created in any segment
+    for media, t in (('hitec', 180), ('hitecxl', 130), ('solarsalt', 260)):
+        result = SaltTest({'media': media, 't_cold': t}).run().result['heatex']
+
+        assert np.all(result['Exdseg'] >= 0), media
+
+    result = SaltTest({'media': 'hitec', 't_cold': 180}).run().result['heatex']
+
+    assert abs(result['Exd'] - 9.686) < 0.01
+
+def test_find_mdot():
+    for t_cold, t4 in ((200, 440), (50, 440)):
+        model = SaltFlowTest({'t_cold': t_cold, 't4': t4}).run()
+        n = model.nodes
+
+        assert abs(n[1]['mdot'] * (n[1]['h'] - n[2]['h']) - n[3]['mdot'] * (n[4]['h'] - n[3]['h'])) < 1e-9
+        assert n[2]['mdot'] == n[1]['mdot']
+
+        if t_cold > 180:
+            # As little salt as the pinch allows
+            assert abs(model.result['heatex']['dTmin'] - 5) < 0.01
+        else:
+            # Salt does not leave below tmin
+            assert abs(n[2]['t'] - 180) < 1e-9
+            assert model.result['heatex']['dTmin'] > 5
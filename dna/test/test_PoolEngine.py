@@ -0,0 +1,53 @@
+import numpy as np
+
+from dna import states
+from dna.engines.ammoniawater import AmmoniaWater
+from dna.engines.cpbased import CpBased
+from dna.engines.pool import PoolEngine
+from dna.test.shared import runThreads
+
+def test_pool():
+    engine = AmmoniaWater()
+
+    p = np.linspace(5, 50, 101)
+    h = np.linspace(0, 300, 101)
+    y = np.full(101, 0.5)
+
+    with PoolEngine(AmmoniaWater, workers = 2, capacity = 16) as pool:
+        # Takes over the setup of the engine in the workers
+        assert pool.name == engine.name
+        assert pool.fingerprint() == engine.fingerprint()
+        assert pool.cacheable
+
+        with states.useEngine(pool):
+            result = states.states_array(p, h, y)
+
+        expected = engine.stateArray(p, h, y)
+
+        for k, v in expected.items():
+            assert np.allclose(result[k], v, equal_nan = True), k
+
+        node = {'t': 60, 'p': 10, 'y': 0.5}
+
+        assert pool.flash(node) == engine.flash(node)
+
+    # Pools of other engines do not share cached states
+    with PoolEngine(CpBased, workers = 1) as pool:
+        assert pool.fingerprint() == CpBased().fingerprint()
+        assert pool.fingerprint() != engine.fingerprint()
+        assert not pool.cacheable
+
+def test_pool_threads():
+    engine = AmmoniaWater()
+
+    # Other inputs per thread, so mixed up results show
+    inputs = [(np.full(200, 5 + 5 * i), np.linspace(0, 300, 200), np.full(200, 0.5)) for i in range(4)]
+    expected = [engine.stateArray(*args)['t'] for args in inputs]
+
+    with PoolEngine(AmmoniaWater, workers = 2, capacity = 64) as pool:
+        def target(i):
+            for repeat in range(5):
+                assert np.allclose(pool.stateArray(*inputs[i])['t'], expected[i], equal_nan = True)
+                np.testing.assert_equal(pool.flash({'t': 60, 'p': 5 + 5 * i, 'y': 0.5}), engine.flash({'t': 60, 'p': 5 + 5 * i, 'y': 0.5}))
+
+        runThreads(target, 4)
@@ -0,0 +1,73 @@
+import numpy as np
+
+from dna import states
+from dna.engines.ammoniawater import AmmoniaWater
+from dna.engines.table import PropertyTable
+
+engine = AmmoniaWater()
+
+def buildTable(p, h, y, **kwargs):
+    '''
+    ph table of the ammonia-water correlation, flashed in one call
+    '''
+    P, H, Y = np.meshgrid(p, h, y, indexing = 'ij')
+    result = engine.stateArray(P.ravel(), H.ravel(), Y.ravel(), mode = 'ph')
+    data = dict((k, np.asarray(v).reshape(P.shape)) for k, v in result.items() if k in PropertyTable.props)
+
+    return PropertyTable('ph', p, h, y, data, fingerprint = engine.fingerprint(), **kwargs)
+
+def test_ttse_within_maxerr():
+    checkWithinMaxerr('ttse')
+
+def test_cubic_within_maxerr():
+    checkWithinMaxerr('cubic')
+
+def checkWithinMaxerr(method):
+    table = buildTable(np.linspace(5, 50, 31), np.linspace(-100, 400, 51), np.linspace(0.3, 0.6, 25), method = method)
+
+    rng = np.random.default_rng(1)
+    p = rng.uniform(5, 50, 2000)
+    h = rng.uniform(-100, 400, 2000)
+    y = rng.uniform(0.3, 0.6, 2000)
+
+    result, ok = table.lookupArray(p, h, y)
+    exact = engine.stateArray(p, h, y, mode = 'ph')
+
+    err = np.abs(result['t'] - exact['t'])
+
+    print('Served from the {} table: {:.1%}, max error {:.4f} K'.format(method, ok.mean(), err[ok].max()))
+
+    assert err[ok].max() <= table.maxerr
+    assert ok.mean() > 0.5
+
+    # Single nodes take the same route
+    i = np.flatnonzero(ok)[0]
+    node = table.lookup({'p': p[i], 'h': h[i], 'y': y[i]})
+
+    assert abs(node['t'] - exact['t'][i]) <= table.maxerr
+
+def test_fingerprint(tmpdir):
+    table = buildTable(np.linspace(5, 50, 10), np.linspace(-100, 400, 21), np.linspace(0.3, 0.6, 7))
+
+    # Offset the temperatures, so lookups are told apart from flashes
+    table.data['t'] = table.data['t'] + 10
+
+    filename = str(tmpdir.join('table.npz'))
+    table.save(filename)
+    table = PropertyTable.load(filename, maxerr = 1)
+
+    node = {'p': 20, 'h': 0, 'y': 0.5}
+    exact = engine.state(dict(node))['t']
+
+    with states.useEngine(engine), states.useTable(table):
+        assert abs(states.state(dict(node))['t'] - exact - 10) < 1
+
+    # The table is not used under an engine of another setup
+    other = AmmoniaWater()
+    other.fingerprint = lambda: 'ammoniawater:other'
+
+    with states.useEngine(other), states.useTable(table):
+        assert states.state(dict(node))['t'] == exact
+
+        result = states.states_array(np.array([20.0]), np.array([0.0]), np.array([0.5]))
+        assert result['t'][0] == exact
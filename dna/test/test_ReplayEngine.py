@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+import numpy as np
+
+from dna import states
+from dna.engine import EngineError
+from dna.engines.replay import recording, replaying
+from dna.test.shared import PinchHexTest
+
+def test_replay():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'test.rec')
+
+        with recording(path):
+            recorded = PinchHexTest({'t_hot': 148.95}).run()
+            p = states.states_array([5, 10], [100, 200], 0.5)['t']
+
+        with replaying(path) as engine:
+            replayed = PinchHexTest({'t_hot': 148.95}).run()
+
+            # Bit for bit
+            for i, node in recorded.nodes.items():
+                assert replayed.nodes[i].keys() == node.keys()
+
+                for k, v in node.items():
+                    assert replayed.nodes[i][k] == v or (v != v and replayed.nodes[i][k] != replayed.nodes[i][k]), k
+
+            assert np.array_equal(states.states_array([5, 10], [100, 200], 0.5)['t'], p)
+
+            try:
+                states.state({'t': 60, 'p': 12.345, 'y': 0.5})
+            except EngineError:
+                pass
+            else:
+                assert False, 'state outside the recording in strict mode'
+
+        # Nearest recorded state for small deviations
+        node = recorded.nodes[2]
+
+        with replaying(path, strict = False, tol = 1e-3):
+            near = states.state({'p': node['p'], 'h': node['h'] * (1 + 1e-6), 'y': node['y']})
+
+        assert abs(near['t'] - node['t']) < 0.01
@@ -0,0 +1,31 @@
+import numpy as np
+
+from dna.engines.ammoniawater import AmmoniaWater
+from dna.engines.table import SaturationTable
+
+engine = AmmoniaWater()
+
+def test_saturation_within_bounds():
+    table = SaturationTable.build(np.geomspace(1, 100, 41), np.linspace(0.3, 0.9, 25), engine = engine)
+
+    rng = np.random.default_rng(1)
+    p = np.exp(rng.uniform(0, np.log(100), 500))
+    y = rng.uniform(0.3, 0.9, 500)
+
+    for kind, q in table.kinds.items():
+        exact = engine.stateArray(p, np.full(len(p), q), y, mode = 'pq')['t']
+
+        t = table.temperature(kind, p, y)
+        ok = ~np.isnan(t)
+
+        print('{}: temperatures served {:.0%}, max error {:.4f} K'.format(kind, ok.mean(), np.abs(t - exact)[ok].max()))
+
+        assert np.abs(t - exact)[ok].max() <= table.maxerr
+        assert ok.mean() > 0.5
+
+        # Pressures at the exact temperatures should give p back
+        _p = table.pressure(kind, exact, y)
+        ok = ~np.isnan(_p)
+
+        assert np.abs(_p / p - 1)[ok].max() <= table.maxrel
+        assert ok.any()
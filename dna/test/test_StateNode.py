@@ -0,0 +1,71 @@
+import pickle
+
+from dna import states
+from dna.engine import flashMode
+from dna.node import StateNode, mask
+
+def test_mapping():
+    node = StateNode(p = 10, h = 300, y = 0.5)
+    node['from'] = 'pump'
+
+    assert node['p'] == 10 and node['from'] == 'pump'
+    assert 't' not in node and 'to' not in node
+    assert len(node) == 4
+    assert dict(node) == {'p': 10, 'h': 300, 'y': 0.5, 'from': 'pump'}
+    assert node == {'p': 10, 'h': 300, 'y': 0.5, 'from': 'pump'}
+    assert node.get('t') is None
+
+    del node['h']
+    del node['from']
+
+    assert dict(node) == {'p': 10, 'y': 0.5}
+
+    try:
+        node['h']
+    except KeyError:
+        pass
+    else:
+        assert False, 'deleted key still readable'
+
+def test_known():
+    node = StateNode()
+    node['p'] = 10
+    node.h = 300
+
+    assert node.known == mask('p', 'h')
+
+    del node['p']
+
+    assert node.known == mask('h')
+
+def test_copy():
+    node = StateNode(p = 10, h = 300, y = 0.5, media = 'kalina')
+    node['from'] = 'pump'
+
+    copy = node.copy()
+    copy['h'] = 200
+    copy['from'] = 'turbine'
+
+    assert type(copy) is StateNode
+    assert copy.known == node.known
+    assert node['h'] == 300 and node['from'] == 'pump'
+
+def test_pickle():
+    node = StateNode(t = 60, p = 10, y = 0.5)
+    node['to'] = 'condenser'
+
+    copy = pickle.loads(pickle.dumps(node))
+
+    assert copy == node and copy.known == node.known
+
+def test_flash_mode():
+    # Same mode as for a plain dict, with all inputs given
+    for inputs in ({'p': 10, 'h': 300}, {'t': 60, 'p': 10}, {'p': 10, 'q': 0}, {'t': 60, 'p': 10, 'h': 300}, {'t': 60}):
+        assert flashMode(StateNode(inputs, y = 0.5)) == flashMode(dict(inputs, y = 0.5))
+
+def test_state():
+    node = states.state(StateNode(t = 60, p = 10, y = 0.5))
+    plain = states.state({'t': 60, 'p': 10, 'y': 0.5})
+
+    for k, v in plain.items():
+        assert node[k] == v
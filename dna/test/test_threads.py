@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+
+from dna import states
+from dna.components.heatex import memo, pinchMemo
+from dna.profile import profile, profiling
+from dna.test.shared import PinchHexTest, runThreads
+
+def test_state_cache_eviction():
+    cache = states.StateCache(maxsize = 8)
+
+    def target(i):
+        for k in range(20000):
+            key = (i, k % 13)
+
+            if cache.get(key) is None:
+                cache.put(key, {'t': k})
+
+    runThreads(target, 8)
+
+    info = cache.info()
+
+    assert info['hits'] + info['misses'] == 8 * 20000
+    assert info['size'] <= 8
+
+def test_flags_per_thread():
+    entered = threading.Barrier(2)
+    left = threading.Event()
+
+    seen = {}
+
+    def target(i):
+        if i == 0:
+            # Leaves its blocks while the other thread is still inside
+            with states.stateCache(), pinchMemo(), profiling(clear = False):
+                entered.wait()
+
+            left.set()
+        else:
+            with states.stateCache(), pinchMemo(), profiling(clear = False):
+                entered.wait()
+                left.wait()
+
+                seen['inside'] = (states.cache.enabled, memo.enabled, profile.enabled)
+
+            seen['outside'] = (states.cache.enabled, memo.enabled, profile.enabled)
+
+    runThreads(target, 2)
+
+    assert seen['inside'] == (True, True, True)
+    assert seen['outside'] == (False, False, False)
+
+    # Not enabled in this thread
+    assert not states.cache.enabled and not memo.enabled and not profile.enabled
+
+def test_models():
+    hot = [130, 140, 148.95, 160]
+
+    expected = [PinchHexTest({'t_hot': t}).run().result['heatex']['Q'] for t in hot]
+
+    results = {}
+
+    def target(i):
+        with states.stateCache(), pinchMemo(), profiling(clear = False):
+            for repeat in range(2):
+                for j in range(len(hot)):
+                    model = PinchHexTest({'t_hot': hot[(i + j) % len(hot)]}).run()
+                    results.setdefault((i + j) % len(hot), []).append(model.result['heatex']['Q'])
+
+    runThreads(target, 4)
+
+    # Warm starts from the memo converge within the pinch tolerance, so they
+    # are not identical
+    for j, Q in enumerate(expected):
+        assert np.allclose(results[j], Q, rtol = 1e-4)
+
+    assert memo.info()['hits'] > 0
+    assert states.cache.info()['hits'] > 0
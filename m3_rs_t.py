@@ -1,5 +1,5 @@
 import dna.components as com
-from dna.states import state
+from dna.states import state, tbub, tdew, pbub
 from dna.model import DnaModel
 
 class MyModel(DnaModel):
@@ -98,22 +98,11 @@ class MyModel(DnaModel):
 
         # Simulation params
         t_sat = cond['t_con'] + cond['pinch_con']
-        p_lo = state({
-            'media': 'kalina',
-            'y': cond['molefrac_lpp'],
-            't': t_sat,
-            'q': 0
-        })['p']
-
-        p_me = state({
-            'media': 'kalina',
-            'y': max(cond['molefrac_n15'], cond['molefrac_n44']),
-            't': t_sat,
-            'q': 0
-        })['p']
+        p_lo = pbub(t_sat, cond['molefrac_lpp'], media = 'kalina')
+        p_me = pbub(t_sat, max(cond['molefrac_n15'], cond['molefrac_n44']), media = 'kalina')
 
-        t_sat_stor = state({'p': p_me, 'y': cond['molefrac_n44'], 'q': 0})['t']
-        t_sat_rcvr = state({'p': p_me, 'y': cond['molefrac_n15'], 'q': 0})['t']
+        t_sat_stor = tbub(p_me, cond['molefrac_n44'])
+        t_sat_rcvr = tbub(p_me, cond['molefrac_n15'])
 
         # Receiver conditions:
         self.nodes['18.1'].update({
@@ -123,7 +112,7 @@ class MyModel(DnaModel):
         })
 
         # y does not have the right value
-        self.nodes['18.1']['t'] = state({'p': p_lo, 'y': cond['molefrac_n15'], 'q': 1})['t'] - 10
+        self.nodes['18.1']['t'] = tdew(p_lo, cond['molefrac_n15']) - 10
 
         if cond['t_node18.1'] is not False:
             self.nodes['18.1']['t'] = cond['t_node18.1']
@@ -146,7 +135,7 @@ class MyModel(DnaModel):
         })
 
         # y does not have the right value
-        self.nodes['47.1']['t'] = state({'p': p_lo, 'y': cond['molefrac_n44'], 'q': 1})['t'] - 10
+        self.nodes['47.1']['t'] = tdew(p_lo, cond['molefrac_n44']) - 10
 
         if cond['t_node47.1'] is not False:
             self.nodes['47.1']['t'] = cond['t_node47.1']
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 
 import m3_rs_t
 from dna.model import IterateModel
+from dna.profile import profile
 
 def round_down(num, divisor):
     return num - (num%divisor)
@@ -47,7 +48,7 @@ if len(sys.argv) > 1:
     print(sys.argv)
     _args = sys.argv.copy()
     _args.pop(0)
-    optlist, args = getopt.getopt(_args, '', ['pressure=', 'y-rcvr=', 'y-stor=', 'y-lpp='])
+    optlist, args = getopt.getopt(_args, '', ['pressure=', 'y-rcvr=', 'y-stor=', 'y-lpp=', 'profile'])
 
     for i, opt in enumerate(optlist):
 
@@ -59,6 +60,9 @@ if len(sys.argv) > 1:
             cond['molefrac_stor'] = float(opt[1])
         elif opt[0] == '--y-lpp':
             cond['molefrac_lpp'] = float(opt[1])
+        elif opt[0] == '--profile':
+            # Report property calls after the run
+            profile.enabled = True
 
 # Simulation guesses (iterate!!):
 cond['molefrac_n15'] = cond['molefrac_rcvr']
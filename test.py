@@ -29,6 +29,9 @@ hx = DischargeTest({}).run().analyse().plot()
 #from test_ThreeStepDischarge import ThreeStepDischargeTest
 #hx = ThreeStepDischargeTest({}).run().analyse().plot()
 
+#from test_MultiStreamHex import MultiStreamHexTest
+#hx = MultiStreamHexTest({}).run().analyse().plot()
+
 #from test_Condenser import CondenserTest
 #hx = CondenserTest({}).run().analyse().plot()
 